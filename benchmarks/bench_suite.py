@@ -0,0 +1,265 @@
+"""Time the hot paths of loading, showing, searching and copying query results, filtering tables and highlighting.
+
+Run from the repository root with ``python -m benchmarks.bench_suite``; ``--help`` lists the payload options. Timings
+are printed as the best and median of ``--repeat`` runs. ``--output`` saves them as JSON, and ``--baseline`` compares
+them with an earlier file, flagging benchmarks that got slower by more than ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+
+from models import salesforce_connector
+from models.column_sort import SortIndex
+from models.result_search import ResultIndex
+from models.result_store import ResultStore
+from models.transport import TransportOptions
+from tests.mock_salesforce import QueryApiStub, SyntheticSalesforce, make_query_page, stub_salesforce
+
+BENCHMARKS = OrderedDict()
+# Widget benchmarks need a QApplication, kept here for the whole run.
+_app = None
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _time(func, repeat, setup=None):
+    """Run ``func(setup())`` ``repeat`` times and return the durations in seconds; ``setup`` is not timed."""
+    durations = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _page(args):
+    return make_query_page(args.rows, args.columns, args.relationships, args.depth)
+
+
+def _store(args):
+    page = _page(args)
+    flattener = salesforce_connector._RelationshipExpander(page['records'])
+    results = salesforce_connector._clean_results(page, flattener)
+    return ResultStore.from_rows(results.headers, results.records)
+
+
+def _connector(args, **kwargs):
+    sf_lib = partial(SyntheticSalesforce, total_size=args.rows, page_size=args.page_size, field_count=args.columns,
+                     relationship_count=args.relationships, nesting_depth=args.depth)
+    return salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=sf_lib, metadata_cache=False,
+                                                query_cache=False, **kwargs)
+
+
+def _query_all(connector):
+    results = connector.query('SELECT Id FROM Sample_Transaction_vod__c')
+    while not results.done:
+        results = connector.query_more()
+    connector.close()
+
+
+@benchmark('flatten_record_value')
+def bench_flatten_record_value(args):
+    records = _page(args)['records']
+    flatten = salesforce_connector._flatten_record_value
+    return _time(lambda _: [[flatten(val) for val in record.values()] for record in records], args.repeat)
+
+
+@benchmark('flatten_compiled')
+def bench_flatten_compiled(args):
+    page = _page(args)
+    records = [OrderedDict((key, val) for key, val in record.items() if key != 'attributes')
+               for record in page['records']]
+    flattener = salesforce_connector._RecordFlattener(page['records'][0])
+    return _time(lambda _: flattener.flatten(records), args.repeat)
+
+
+@benchmark('flatten_expanded')
+def bench_flatten_expanded(args):
+    page = _page(args)
+    expander = salesforce_connector._RelationshipExpander(page['records'])
+    return _time(lambda _: expander.flatten(page['records']), args.repeat)
+
+
+@benchmark('clean_results')
+def bench_clean_results(args):
+    def setup():
+        page = _page(args)
+        return page, salesforce_connector._RelationshipExpander(page['records'])
+    return _time(lambda arg: salesforce_connector._clean_results(*arg), args.repeat, setup)
+
+
+@benchmark('query_loop')
+def bench_query_loop(args):
+    return _time(_query_all, args.repeat, partial(_connector, args, prefetch_depth=0))
+
+
+@benchmark('query_loop_prefetch')
+def bench_query_loop_prefetch(args):
+    return _time(_query_all, args.repeat, partial(_connector, args, prefetch_depth=1))
+
+
+@benchmark('query_loop_http')
+def bench_query_loop_http(args):
+    stub = QueryApiStub(args.rows, args.page_size, args.columns, relationship_count=args.relationships,
+                        nesting_depth=args.depth)
+    try:
+        def setup():
+            return salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=stub_salesforce(stub),
+                                                        prefetch_depth=1, metadata_cache=False, query_cache=False,
+                                                        transport=TransportOptions())
+        return _time(_query_all, args.repeat, setup)
+    finally:
+        stub.close()
+
+
+@benchmark('sort_cold')
+def bench_sort_cold(args):
+    return _time(lambda index: index.order(1, 'string'), args.repeat, lambda: SortIndex(_store(args)))
+
+
+@benchmark('search_index_build')
+def bench_search_index_build(args):
+    return _time(lambda index: index.update(), args.repeat, lambda: ResultIndex(_store(args)))
+
+
+@benchmark('search')
+def bench_search(args):
+    index = ResultIndex(_store(args))
+    index.update()
+    return _time(lambda _: index.search('text 1 Field2__c=true'), args.repeat)
+
+
+@benchmark('results_table_set_data')
+def bench_results_table_set_data(args):
+    from utils.custom_widgets import ResultsTable
+    store = _store(args)
+    table = ResultsTable()
+    return _time(lambda _: table.set_store(store), args.repeat, table.clear_data)
+
+
+@benchmark('selection_to_text')
+def bench_selection_to_text(args):
+    from utils.custom_widgets import ResultsTable
+    from views.window_main import _selection_to_mime_data
+    table = ResultsTable()
+    table.set_store(_store(args))
+    table.selectAll()
+    return _time(lambda _: _selection_to_mime_data(table.store, table.selected_cells(), True).text(), args.repeat)
+
+
+@benchmark('table_filter')
+def bench_table_filter(args):
+    from utils.custom_widgets import TableFilterProxyModel
+    words = ['Account', 'Sample', 'Transaction', 'Call2', 'Product', 'Territory', 'Address', 'Event', 'Detail']
+    names = ['{0}_{1}{2}_vod__c'.format(words[i % len(words)], words[i // len(words) % len(words)], i)
+             for i in range(max(args.rows // 5, 10))]
+    proxy = TableFilterProxyModel()
+    proxy.names = names
+    patterns = ['acc', 'stv', 'Sample_Tr', 'prodterr', '__c', 'zzz', '']
+
+    def run(_):
+        for pattern in patterns:
+            proxy.filter_text = pattern
+            proxy.rowCount()
+    return _time(run, args.repeat)
+
+
+@benchmark('highlighter')
+def bench_highlighter(args):
+    import PyQt5.QtWidgets as qtw
+    from utils.custom_widgets import SOQLHighlighter
+    editor = qtw.QTextEdit()
+    highlighter = SOQLHighlighter(editor)
+    fields = ',\n'.join("Field{0}__c, toLabel(Status{0}__c), 'literal {0}'".format(i) for i in range(args.columns * 50))
+    text = 'SELECT {0}\nFROM Sample_Transaction_vod__c\nWHERE Name LIKE \'%x%\' AND Amount > 10'.format(fields)
+
+    def run(_):
+        editor.setPlainText(text)
+        highlighter.find('Field1')
+    return _time(run, args.repeat, lambda: editor.clear())
+
+
+def run(args):
+    global _app
+    names = args.only or list(BENCHMARKS)
+    if {'results_table_set_data', 'selection_to_text', 'table_filter', 'highlighter'}.intersection(names):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        import PyQt5.QtWidgets as qtw
+        _app = qtw.QApplication.instance() or qtw.QApplication(sys.argv[:1])
+
+    results = OrderedDict()
+    for name in names:
+        durations = BENCHMARKS[name](args)
+        results[name] = OrderedDict([('min_ms', round(min(durations) * 1000, 3)),
+                                     ('median_ms', round(statistics.median(durations) * 1000, 3))])
+        print('{0:<24} min {1[min_ms]:>10.1f} ms   median {1[median_ms]:>10.1f} ms'.format(name, results[name]))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print how each benchmark moved against ``baseline`` and return the names that regressed."""
+    regressed = []
+    for name, timing in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before or not before['min_ms']:
+            continue
+        change = timing['min_ms'] / before['min_ms'] - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressed.append(name)
+        print('{0:<24} {1:>+8.1%}{2}'.format(name, change, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--columns', type=int, default=20, help='scalar fields per record')
+    parser.add_argument('--relationships', type=int, default=3, help='relationship fields per record')
+    parser.add_argument('--depth', type=int, default=2, help='nesting depth of each relationship')
+    parser.add_argument('--page-size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown flagged as a regression (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    report = OrderedDict([
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('params', OrderedDict((key, getattr(args, key)) for key in
+                               ('rows', 'columns', 'relationships', 'depth', 'page_size', 'repeat'))),
+        ('results', results),
+    ])
+
+    regressed = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('params') != report['params']:
+            print('Baseline was run with different parameters: {0}'.format(dict(baseline.get('params', {}))))
+        regressed = compare(results, baseline, args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
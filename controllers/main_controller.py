@@ -1,54 +1,316 @@
-import traceback
+from functools import partial
 
+from PyQt5.QtCore import QThreadPool
+
+from models import exporter, partitioning
 from models.salesforce_connector import SForceConnector
+from utils.search_index import SOQLCompletionIndex, query_table
+from utils.workers import Worker
 from views.window_main import MainWindow
 
+# Results with at least this many records can be exported through the Bulk API instead of paging with Query More.
+BULK_EXPORT_THRESHOLD = 50000
+# Exports of at least this many records, and Load All, split the query into Id ranges fetched by this many workers.
+PARALLEL_QUERY_THRESHOLD = 10000
+PARALLEL_QUERY_WORKERS = 4
+
 
 class MainController(object):
     def __init__(self, view: MainWindow, model: SForceConnector):
         self.model = model
         self.view = view
 
+        # Connector calls share query state, so they run one at a time off the GUI thread.
+        self._query_pool = QThreadPool()
+        self._query_pool.setMaxThreadCount(1)
+        self._query_worker = None
+        self._results_query = None
+        self._results_total = 0
+        self._completion_index = SOQLCompletionIndex()
+        self._completion_describes = set()
+        self._instrumentation = self.model.instrumentation
+        self.view.diagnostics_recording = self._instrumentation.enabled
+
         self.view.set_listener_run_query(self._run_query)
         self.view.set_listener_query_more(self._run_query_more)
+        self.view.set_listener_cancel_query(self._cancel_query)
+        self.view.set_listener_bulk_export(self._run_bulk_export)
+        self.view.set_listener_export_results(self._run_export)
+        self.view.set_listener_export_selection(self._run_export_selection)
+        self.view.set_listener_export_shown_rows(self._run_export_shown_rows)
+        self.view.set_listener_load_all(self._run_load_all)
+        self.view.set_listener_filter_results(self._filter_results)
         self.view.set_listener_table_selected(self._select_table)
         self.view.set_listener_filter_tables(self._filter_tables)
+        self.view.set_listener_reload_tables(self._reload_tables)
+        self.view.set_listener_complete(self._complete)
+        self.view.set_listener_show_diagnostics(self._show_diagnostics)
+        self.view.set_listener_record_diagnostics(self._record_diagnostics)
+        self.view.set_listener_export_diagnostics(self._export_diagnostics)
+        self.view.set_listener_clear_diagnostics(self._clear_diagnostics)
 
-        self.view.tables = self.model.get_tables()
+        # The global describe can take seconds, so the window starts with the last cached table list and updates once
+        # the describe returns.
+        self._set_tables(self.model.cached_tables())
+        self._load_tables()
 
     def show(self):
         self.view.show()
 
     def _run_query(self):
-        self.view.temp_status_text = 'Running Query...'
-        try:
-            query = self.view.query_text
-            results = self.model.query(query)
-            self.view.update_results_table(results.headers, results.records)
-            self.view.status_text = '{0} / {1} Results'.format(results.size, results.totalSize)
-            self.view.query_more_enabled = not results.done
-        except Exception as e:
-            print(traceback.format_exc())
-            self.view.error_message = str(e)
+        query = self.view.query_text
+        force_refresh = self.view.force_refresh_requested
+        worker = Worker(self.model.query, query, force_refresh=force_refresh, report_cancelled=True)
+        self._start_query_worker(worker, 'Running Query...', partial(self._show_results, query))
 
     def _run_query_more(self):
-        self.view.temp_status_text = 'Getting More Results...'
-        try:
-            results = self.model.query_more()
-            self.view.update_results_table(results.headers, results.records)
-            self.view.status_text = '{0} / {1} Results'.format(results.size, results.totalSize)
-            self.view.query_more_enabled = not results.done
-        except Exception as e:
-            print(traceback.format_exc())
-            self.view.error_message = str(e)
+        worker = Worker(self.model.query_more, report_cancelled=True)
+        self._start_query_worker(worker, 'Getting More Results...', self._append_results)
+
+    def _run_load_all(self):
+        if self._results_query is None:
+            return
+        query = self._results_query
+        worker = Worker(self.model.query_parallel, query, max_workers=PARALLEL_QUERY_WORKERS, report_progress=True,
+                        report_cancelled=True)
+        self._start_query_worker(worker, 'Loading All Results...', partial(self._show_results, query))
+
+    def _run_bulk_export(self):
+        if self._results_query is None:
+            return
+        path = self.view.ask_save_path('Bulk Export Results', 'CSV Files (*.csv)')
+        if not path:
+            return
+        worker = Worker(self.model.bulk_query, self._results_query, path, report_progress=True, report_cancelled=True)
+        self._start_query_worker(worker, 'Starting Bulk Export...', partial(self._show_export_result, path))
+
+    def _run_export(self):
+        if self._results_query is None:
+            return
+        path = self.view.ask_save_path('Export Results', ';;'.join(exporter.EXPORT_FORMATS.values()))
+        if not path:
+            return
+        query = self._results_query
+        parallel = self._results_total >= PARALLEL_QUERY_THRESHOLD and partitioning.is_partitionable(query)
+        worker = Worker(exporter.export_query, self.model, query, path, report_progress=True, report_cancelled=True,
+                        max_workers=PARALLEL_QUERY_WORKERS if parallel else 1)
+        self._start_query_worker(worker, 'Starting Export...', partial(self._show_export_result, path))
+
+    def _run_export_selection(self):
+        self._run_export_cells('Export Selected Cells', *self.view.selected_cells)
+
+    def _run_export_shown_rows(self):
+        self._run_export_cells('Export Shown Rows', *self.view.shown_cells)
+
+    def _run_export_cells(self, title, store, rows, cols):
+        if not rows:
+            return
+        path = self.view.ask_save_path(title, ';;'.join(exporter.EXPORT_FORMATS.values()))
+        if not path:
+            return
+        worker = Worker(exporter.export_store, store, path, rows, cols, report_progress=True, report_cancelled=True)
+        self._start_query_worker(worker, 'Starting Export...', partial(self._show_export_result, path))
+
+    def _cancel_query(self):
+        if self._query_worker is None:
+            return
+        worker = self._query_worker
+        worker.cancel()
+        self._query_worker = None
+        self.view.query_running = False
+        if worker.func in (self.model.query, self.model.query_more):
+            # The request in flight still completes, but the connector then stops paging, so the shown results can no
+            # longer be paged either.
+            self.view.query_more_enabled = False
+        self.view.temp_status_text = 'Cancelled'
+
+    def _start_query_worker(self, worker: Worker, status_text: str, on_result):
+        if self._query_worker is not None:
+            self.view.temp_status_text = 'A query is already running.'
+            return
+
+        worker.signals.result.connect(partial(self._show_query_result, worker, on_result))
+        worker.signals.error.connect(partial(self._show_query_error, worker))
+        worker.signals.progress.connect(partial(self._show_query_progress, worker))
+
+        self._query_worker = worker
+        self.view.query_running = True
+        self.view.temp_status_text = status_text
+        self._query_pool.start(worker)
+
+    def _finish_query_worker(self, worker: Worker) -> bool:
+        if worker is not self._query_worker:
+            return False
+        self._query_worker = None
+        self.view.query_running = False
+        return True
+
+    def _show_query_result(self, worker, on_result, result):
+        if self._finish_query_worker(worker):
+            on_result(result)
+            self._show_timings()
+
+    def _show_results(self, query, results):
+        self._results_query = query
+        self._results_total = results.totalSize
+        store = self.model.results_store
+        with self._instrumentation.operation('render', rows=len(store)):
+            self.view.update_results_table(store)
+        self.view.status_text = '{0} / {1} Results'.format(results.size, results.totalSize)
+        self.view.query_more_enabled = not results.done
+        self.view.load_all_enabled = partitioning.is_partitionable(query)
+        self.view.bulk_export_enabled = results.totalSize >= BULK_EXPORT_THRESHOLD
+        self._show_cache_stats()
+        self._load_column_types(query, results.headers)
+
+    def _append_results(self, results):
+        with self._instrumentation.operation('render', rows=len(results.records)):
+            self.view.append_results_table(self.model.results_store)
+        self.view.status_text = '{0} / {1} Results'.format(results.size, results.totalSize)
+        self.view.query_more_enabled = not results.done
+
+    def _load_column_types(self, query, headers):
+        # Field types let the results sort numbers, dates and booleans by value; describes may need the network.
+        table_name = query_table(query)
+        if table_name is None:
+            return
+        worker = Worker(self.model.get_column_types, table_name, headers)
+        worker.signals.result.connect(partial(self._set_column_types, query))
+        worker.signals.error.connect(self._show_column_types_error)
+        QThreadPool.globalInstance().start(worker)
+
+    def _set_column_types(self, query, column_types):
+        if query == self._results_query:
+            self.view.set_results_column_types(column_types)
+
+    def _show_column_types_error(self, message):
+        # The results still sort, only as text.
+        self.view.temp_status_text = 'Could not load column types: {0}'.format(message)
+
+    def _show_cache_stats(self):
+        cache = self.model.query_cache
+        if cache is not None:
+            self.view.cache_status_text = 'Cache: {0} Hits / {1} Misses'.format(cache.hits, cache.misses)
+
+    def _show_timings(self):
+        """Show where the last fetch and render spent their time, and refresh the diagnostics if they are open."""
+        if not self._instrumentation.enabled:
+            return
+        fetched = self._instrumentation.last('query', 'query_more', 'query_parallel', 'bulk_query')
+        rendered = self._instrumentation.last('render')
+        self.view.timing_status_text = ' | '.join(operation.summary() for operation in (fetched, rendered)
+                                                  if operation is not None)
+        if self.view.diagnostics_visible:
+            self.view.set_diagnostics(self._instrumentation.operations())
+
+    def _show_diagnostics(self):
+        self.view.set_diagnostics(self._instrumentation.operations())
+        self.view.show_diagnostics()
+
+    def _record_diagnostics(self, recording):
+        self._instrumentation.enabled = recording
+        if not recording:
+            self.view.timing_status_text = ''
+
+    def _export_diagnostics(self):
+        path = self.view.ask_save_path('Export Diagnostics Log', 'JSON Lines (*.jsonl)')
+        if not path:
+            return
+        self._instrumentation.export(path)
+        self.view.temp_status_text = 'Diagnostics Exported To {0}'.format(path)
+
+    def _clear_diagnostics(self):
+        self._instrumentation.clear()
+        self.view.set_diagnostics([])
+        self.view.timing_status_text = ''
+
+    def _show_export_result(self, path, record_count):
+        self.view.temp_status_text = 'Exported {0} Records To {1}'.format(record_count, path)
+
+    def _show_query_error(self, worker, message):
+        if not self._finish_query_worker(worker):
+            return
+        self.view.error_message = message
+        self._show_timings()
+
+    def _show_query_progress(self, worker, message):
+        if worker is self._query_worker:
+            self.view.temp_status_text = message
 
     def _select_table(self):
         table_name = self.view.selected_table
+        if not table_name:
+            return
         self.view.temp_status_text = 'Generating Query For Table: {0} ...'.format(table_name)
         fields = sorted(self.model.get_table_fields(table_name))
         self.view.query_text = 'SELECT {0} FROM {1}'.format(', '.join(fields), table_name)
 
-    def _filter_tables(self):
-        filter_text = self.view.filter_text
-        table_names = (name for name in self.model.get_tables() if filter_text.lower() in name.lower())
+    def _reload_tables(self):
+        self.view.temp_status_text = 'Reloading Tables...'
+        self.model.invalidate_metadata()
+        self._completion_index = SOQLCompletionIndex()
+        self._load_tables()
+
+    def _load_tables(self):
+        worker = Worker(self.model.get_tables)
+        worker.signals.result.connect(self._show_loaded_tables)
+        worker.signals.error.connect(self._show_tables_error)
+        QThreadPool.globalInstance().start(worker)
+
+    def _show_loaded_tables(self, table_names):
+        # Keep the list (and its selection) when the cached tables were already up to date.
+        if table_names != self.view.all_tables:
+            self.view.tables = table_names
+        self._completion_index.set_tables(table_names)
+        self._warm_up_fields()
+
+    def _show_tables_error(self, message):
+        self.view.error_message = 'Could Not Load Tables: {0}'.format(message)
+
+    def _set_tables(self, table_names):
         self.view.tables = table_names
+        self._completion_index.set_tables(table_names)
+
+    def _complete(self, text_before_cursor, query_text):
+        while True:
+            prefix, candidates, missing_table = self._completion_index.complete(text_before_cursor, query_text)
+            if missing_table is None:
+                return prefix, candidates
+            if missing_table not in self.model.loaded_fields:
+                self._describe_for_completion(missing_table)
+                return prefix, candidates
+            self._completion_index.set_fields(missing_table, self.model.loaded_fields[missing_table])
+
+    def _describe_for_completion(self, table_name):
+        if table_name in self._completion_describes:
+            return
+        self._completion_describes.add(table_name)
+        worker = Worker(self.model.get_table_fields, table_name)
+        worker.signals.result.connect(partial(self._add_completion_fields, table_name))
+        # Without this a table that failed to describe (e.g. a typo) would never be tried again.
+        worker.signals.error.connect(partial(self._completion_describe_failed, table_name))
+        QThreadPool.globalInstance().start(worker)
+
+    def _add_completion_fields(self, table_name, fields):
+        self._completion_describes.discard(table_name)
+        self._completion_index.set_fields(table_name, fields)
+        self.view.refresh_completion()
+
+    def _completion_describe_failed(self, table_name, message):
+        self._completion_describes.discard(table_name)
+
+    def _warm_up_fields(self):
+        # Describe the recently used tables in the background so _select_table rarely waits on the network for them.
+        worker = Worker(self.model.warm_up_fields)
+        worker.signals.result.connect(self._show_warm_up_result)
+        QThreadPool.globalInstance().start(worker)
+
+    def _show_warm_up_result(self, described):
+        if described:
+            self.view.temp_status_text = 'Field Metadata Loaded For {0} Tables'.format(described)
+
+    def _filter_tables(self):
+        self.view.table_filter = self.view.filter_text
+
+    def _filter_results(self):
+        self.view.results_filter = self.view.results_filter_text
@@ -1,22 +1,77 @@
+import time
+
+# Taken before the other imports so that --startup-time includes them.
+LAUNCHED = time.perf_counter()
+
+import argparse
+import importlib
 import sys
+import threading
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication, QDialog
 
-from controllers.main_controller import MainController
 from utils import utils
+from utils.instrumentation import StartupTimer
 from views.window_login import LoginWindow
-from views.window_main import MainWindow
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Browse Salesforce tables and run SOQL queries.')
+    parser.add_argument('--diagnostics', action='store_true',
+                        help='record the timing of every query and view update from the start (Ctrl+Shift+D)')
+    parser.add_argument('--diagnostics-log', metavar='PATH',
+                        help='also append every timed operation to PATH as JSON lines')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='print how long the launch took up to a usable window, leaving out time spent typing '
+                             'in the login dialog')
+    # Anything else is left for Qt.
+    return parser.parse_known_args(argv[1:])
+
+
+def preload(*module_names):
+    """Import ``module_names`` on a background thread while the login dialog waits for the user."""
+    def run():
+        for name in module_names:
+            importlib.import_module(name)
+    threading.Thread(target=run, daemon=True).start()
+
+
+def show_startup_time(startup, instrumentation):
+    operation = startup.finish('first_paint')
+    print('Startup: {0}'.format(operation.summary()), file=sys.stderr)
+    if instrumentation.enabled:
+        instrumentation.record(operation)
+
 
 if __name__ == '__main__':
+    startup = StartupTimer(LAUNCHED)
+    startup.mark('imports')
+    args, qt_args = parse_args(sys.argv)
     logins = utils.load_config()
 
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
 
     login = LoginWindow(saved_logins=logins)
+    preload('models.salesforce_connector', 'controllers.main_controller')
+    # Runs once the dialog's event loop has shown it.
+    QTimer.singleShot(0, lambda: startup.mark('login_window'))
 
     if login.exec_() == QDialog.Accepted:
+        startup.skip()
+        startup.add('login', login.login_seconds)
+        from controllers.main_controller import MainController
+        from views.window_main import MainWindow
+
         sf_con = login.get_login()
+        sf_con.instrumentation.enabled = args.diagnostics or bool(args.diagnostics_log)
+        sf_con.instrumentation.log_path = args.diagnostics_log
         window = MainWindow()
         controller = MainController(window, sf_con)
         controller.show()
+        startup.mark('main_window')
+        if args.startup_time:
+            QTimer.singleShot(0, lambda: show_startup_time(startup, sf_con.instrumentation))
+        # The session may have been renewed while the app ran. It is saved while the event loop still runs.
+        app.aboutToQuit.connect(lambda: login.remember_session(quiet=True))
         sys.exit(app.exec_())
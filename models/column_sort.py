@@ -0,0 +1,149 @@
+import threading
+
+from models.result_store import format_value
+
+# Salesforce describe types that sort as numbers, booleans and ISO dates. Every other type sorts as text.
+NUMBER_TYPES = {'int', 'long', 'double', 'currency', 'percent'}
+BOOLEAN_TYPES = {'boolean'}
+DATE_TYPES = {'date', 'datetime', 'time'}
+# Columns without describe metadata get their type from this many leading non-blank values.
+_INFER_SAMPLE_SIZE = 1000
+
+
+def _number_key(value):
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _boolean_key(value):
+    if value is None or value == '':
+        return None
+    return value is True or str(value).lower() == 'true'
+
+
+def _date_key(value):
+    if value is None or value == '':
+        return None
+    # ISO 8601, and always UTC for datetimes, so the text sorts chronologically.
+    return str(value)
+
+
+def _text_key(value):
+    return None if value is None else format_value(value)
+
+
+def sort_key(field_type):
+    """Key function for values of a describe ``field_type``. Blank or unparseable values get ``None``."""
+    if field_type in NUMBER_TYPES:
+        return _number_key
+    if field_type in BOOLEAN_TYPES:
+        return _boolean_key
+    if field_type in DATE_TYPES:
+        return _date_key
+    return _text_key
+
+
+def infer_type(values) -> str:
+    """Guess a describe type for raw JSON ``values``: 'boolean', 'double' or 'string'."""
+    sample = []
+    for value in values:
+        if value is not None:
+            sample.append(value)
+            if len(sample) >= _INFER_SAMPLE_SIZE:
+                break
+    if sample and all(type(value) is bool for value in sample):
+        return 'boolean'
+    if sample and all(type(value) in (int, float) for value in sample):
+        return 'double'
+    return 'string'
+
+
+class SortIndex(object):
+    """Sort permutations over the columns of a ``ResultStore``.
+
+    The sort keys and ascending permutation of each column are kept, so sorting a column again (in either direction)
+    is a list copy, and rows appended since the last sort are sorted on their own and merged into the kept run.
+    Blank values always come last. ``order`` may be called from a worker thread.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        # (column, field type) -> (keys, ascending rows with non-blank keys, rows with blank keys, key function)
+        self._sorted = {}
+
+    def is_sorted(self, col, field_type, row_count) -> bool:
+        entry = self._sorted.get((col, field_type))
+        return entry is not None and len(entry[0]) >= row_count
+
+    def order(self, col, field_type=None, descending=False, row_count=None) -> list:
+        """Return the store row indexes of the first ``row_count`` rows (default: all) sorted by column ``col``."""
+        if row_count is None:
+            row_count = len(self.store)
+        with self._lock:
+            keys, ascending, blanks, _ = self._update(col, field_type, row_count)
+        if len(keys) > row_count:
+            ascending = [row for row in ascending if row < row_count]
+            blanks = [row for row in blanks if row < row_count]
+        return (ascending[::-1] if descending else list(ascending)) + blanks
+
+    def rows_between(self, col, field_type=None, row_count=None, low=None, high=None, low_inclusive=True,
+                     high_inclusive=True) -> list:
+        """Return the store rows whose column ``col`` lies between ``low`` and ``high``, found by bisecting the kept
+        ascending permutation. Bounds are raw values such as typed filter text; a missing bound is unbounded.
+        """
+        if row_count is None:
+            row_count = len(self.store)
+        with self._lock:
+            keys, ascending, _, key = self._update(col, field_type, row_count)
+        start, end = 0, len(ascending)
+        if low is not None:
+            start = _bisect(ascending, keys, _bound_key(key, low), not low_inclusive)
+        if high is not None:
+            end = _bisect(ascending, keys, _bound_key(key, high), high_inclusive)
+        return [row for row in ascending[start:end] if row < row_count]
+
+    def _update(self, col, field_type, row_count):
+        values = self.store.column(col)
+        entry = self._sorted.get((col, field_type))
+        if entry is None:
+            entry = [], [], [], sort_key(field_type or infer_type(values[:row_count]))
+        keys, ascending, blanks, key = entry
+        start = len(keys)
+        if start >= row_count:
+            return entry
+
+        keys = keys + [key(value) for value in values[start:row_count]]
+        added = [row for row in range(start, row_count) if keys[row] is not None]
+        added.sort(key=keys.__getitem__)
+        # Both runs are already sorted, so this sort only has to merge them.
+        ascending = sorted(ascending + added, key=keys.__getitem__) if ascending else added
+        blanks = blanks + [row for row in range(start, row_count) if keys[row] is None]
+        entry = self._sorted[(col, field_type)] = keys, ascending, blanks, key
+        return entry
+
+
+def _bound_key(key, value):
+    bound = key(value)
+    if bound is None:
+        raise Exception('Cannot compare with {0!r}.'.format(value))
+    return bound
+
+
+def _bisect(rows, keys, bound, after_equal):
+    """Position in ``rows`` (ascending by ``keys``) before the first key not less than ``bound``, or after the last
+    key equal to it if ``after_equal`` is set.
+    """
+    lo, hi = 0, len(rows)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = keys[rows[mid]]
+        if key < bound or (after_equal and key == bound):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
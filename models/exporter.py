@@ -0,0 +1,167 @@
+import csv
+import json
+import os
+
+from models.result_store import format_value
+
+EXPORT_FORMATS = {
+    'csv': 'CSV Files (*.csv)',
+    'jsonl': 'JSON Lines Files (*.jsonl)',
+    'parquet': 'Parquet Files (*.parquet)',
+}
+
+
+class _ExportCancelled(Exception):
+    pass
+
+
+def format_for_path(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+    return extension if extension in EXPORT_FORMATS else 'csv'
+
+
+class _CsvWriter(object):
+    def __init__(self, file, headers):
+        self._writer = csv.writer(file)
+        self._writer.writerow(headers)
+
+    def write_rows(self, rows):
+        self._writer.writerows([format_value(val) for val in row] for row in rows)
+
+    def close(self):
+        pass
+
+
+class _JsonlWriter(object):
+    def __init__(self, file, headers):
+        self._file = file
+        self._headers = headers
+
+    def write_rows(self, rows):
+        headers = self._headers
+        self._file.writelines(json.dumps(dict(zip(headers, row)), default=str) + '\n' for row in rows)
+
+    def close(self):
+        pass
+
+
+class _ParquetWriter(object):
+    """Writes each batch of rows as one Parquet row group. Values are stored as (nullable) text columns."""
+
+    def __init__(self, path, headers):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception('Parquet export requires the pyarrow package.')
+        self._pa = pyarrow
+        self._headers = headers
+        self._schema = pyarrow.schema([(header, pyarrow.string()) for header in headers])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='snappy')
+
+    def write_rows(self, rows):
+        if not rows:
+            return
+        columns = [[None if row[i] is None else format_value(row[i]) for row in rows]
+                   for i in range(len(self._headers))]
+        self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def _open_writer(path, file_format, headers):
+    if file_format == 'parquet':
+        return None, _ParquetWriter(path, headers)
+    file = open(path, 'w', newline='', encoding='utf-8')
+    writer_class = _JsonlWriter if file_format == 'jsonl' else _CsvWriter
+    return file, writer_class(file, headers)
+
+
+def export_rows(headers, row_batches, path, file_format=None, progress=None, cancelled=None, total=None) -> int:
+    """Write every batch from ``row_batches`` to ``path`` and return the number of rows written.
+
+    ``row_batches`` is consumed lazily, so only one batch is held in memory at a time. The format is taken from the
+    file extension unless ``file_format`` is given. ``progress`` receives a status message after each batch and
+    ``cancelled`` is polled between batches; a cancelled export removes the partial file.
+    """
+    file_format = file_format or format_for_path(path)
+    file, writer = _open_writer(path, file_format, headers)
+    row_count = 0
+    try:
+        for rows in row_batches:
+            if cancelled is not None and cancelled():
+                raise _ExportCancelled()
+            writer.write_rows(rows)
+            row_count += len(rows)
+            if progress is not None:
+                progress('Exported {0} / {1} Records'.format(row_count, '?' if total is None else total))
+        writer.close()
+    except BaseException as ex:
+        if file is not None:
+            file.close()
+        if os.path.exists(path):
+            os.remove(path)
+        if isinstance(ex, _ExportCancelled):
+            raise Exception('Export cancelled.')
+        raise
+    if file is not None:
+        file.close()
+    return row_count
+
+
+def export_store(store, path, rows=None, cols=None, file_format=None, progress=None, cancelled=None,
+                 batch_size=10000) -> int:
+    """Write the ``rows`` x ``cols`` cells of a ``ResultStore`` to ``path``, every row and column by default."""
+    cols = list(range(len(store.headers))) if cols is None else list(cols)
+    rows = range(len(store)) if rows is None else rows
+
+    def batches():
+        for start in range(0, len(rows), batch_size):
+            yield list(store.iter_rows(rows[start:start + batch_size], cols))
+
+    return export_rows([store.headers[col] for col in cols], batches(), path, file_format=file_format,
+                       progress=progress, cancelled=cancelled, total=len(rows))
+
+
+def export_query(connector, query, path, file_format=None, progress=None, cancelled=None, max_workers=1) -> int:
+    """Stream every record of ``query`` from ``connector`` into ``path``, one result page at a time.
+
+    The export pages through the query on its own, so it neither needs nor disturbs the results shown in the window.
+    With ``max_workers`` above 1 the query is split into partitions fetched concurrently (see
+    ``SForceConnector.iter_query_parallel``) and rows are written in the order their pages arrive.
+    """
+    if max_workers > 1:
+        pages = connector.iter_query_parallel(query, max_workers=max_workers, cancelled=cancelled)
+        first_page = next(pages, None)
+        if first_page is None:
+            raise Exception('This Query Returns No Results')
+
+        def page_batches():
+            yield first_page.records
+            for page in pages:
+                yield page.records
+
+        return export_rows(first_page.headers, page_batches(), path, file_format, progress, cancelled,
+                           first_page.totalSize)
+
+    pages = []
+    records = connector.iter_query(query, page_callback=pages.append)
+
+    first = next(records, None)
+    if first is None:
+        raise Exception('This Query Returns No Results')
+    headers = pages[0].headers
+
+    def row_batches():
+        batch = [first]
+        for record in records:
+            if len(pages) > 1:
+                # A new page has started; hand over the previous one before buffering more.
+                yield batch
+                batch = []
+                del pages[:-1]
+            batch.append(record)
+        yield batch
+
+    return export_rows(headers, row_batches(), path, file_format, progress, cancelled, pages[0].totalSize)
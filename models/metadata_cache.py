@@ -0,0 +1,68 @@
+import json
+import os
+import re
+import time
+from email.utils import formatdate
+
+from utils import utils
+
+
+class MetadataCache(object):
+    """Per-org on-disk store for describe results, one JSON file per entry.
+
+    Entries younger than ``ttl`` seconds are served as-is. Older entries are still returned by ``get`` so the caller can
+    revalidate them with ``If-Modified-Since`` instead of downloading them again.
+    """
+
+    def __init__(self, org_key: str, directory=None, ttl: float = 24 * 60 * 60):
+        self.ttl = ttl
+        self.directory = os.path.join(utils.cache_dir(directory), re.sub(r'[^\w.@-]', '_', org_key))
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r') as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value, fetched=None):
+        entry = {'fetched': time.time() if fetched is None else fetched, 'value': value}
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as json_file:
+            json.dump(entry, json_file)
+        os.replace(temp_path, path)
+        return entry
+
+    def keys(self, prefix='') -> list:
+        """Keys of the stored entries starting with ``prefix``, most recently fetched first."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.startswith(prefix) and name.endswith('.json')]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name)), reverse=True)
+        return [name[:-len('.json')] for name in names]
+
+    def touch(self, key, entry):
+        return self.put(key, entry['value'])
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched'] < self.ttl
+
+    @staticmethod
+    def if_modified_since(entry):
+        return formatdate(entry['fetched'], usegmt=True)
+
+    def invalidate(self, key=None):
+        if not os.path.isdir(self.directory):
+            return
+        if key is not None:
+            paths = [self._path(key)]
+        else:
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,151 @@
+import re
+from datetime import datetime
+
+# Salesforce Ids count up in base 62 over an alphabet in ASCII order, so comparing Ids as strings compares them as
+# numbers and an Id range can be cut into equal parts arithmetically.
+_BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+_ID_SUFFIX = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ012345'
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+_TOP_LEVEL_FROM = re.compile(r'\bfrom\b', re.IGNORECASE)
+_WHERE = re.compile(r'\bwhere\b', re.IGNORECASE)
+# Clauses that may follow WHERE, in the order SOQL allows them.
+_AFTER_WHERE = re.compile(r'\b(?:with|group\s+by|order\s+by|limit|offset|for\s+(?:view|reference|update)|'
+                          r'update\s+(?:tracking|viewstat))\b', re.IGNORECASE)
+_UNPARTITIONABLE = re.compile(r'\b(?:group\s+by|order\s+by|limit|offset)\b', re.IGNORECASE)
+_AGGREGATE = re.compile(r'\b(?:count|count_distinct|sum|avg|min|max)\s*\(', re.IGNORECASE)
+
+
+def mask_nested(query: str) -> str:
+    """``query`` with string literals and parenthesised parts (subqueries, function calls) blanked out, so keyword
+    searches only see the top level. Positions are unchanged."""
+    masked = _STRING_LITERAL.sub(lambda match: ' ' * len(match.group(0)), query)
+    chars = list(masked)
+    depth = 0
+    for i, char in enumerate(chars):
+        if char == '(':
+            depth += 1
+        if depth:
+            chars[i] = ' '
+        if char == ')':
+            depth = max(depth - 1, 0)
+    return ''.join(chars)
+
+
+def _split(query: str):
+    """Return the positions of the top-level FROM, of the WHERE condition (or ``None``) and of the clause after it."""
+    masked = mask_nested(query)
+    from_match = _TOP_LEVEL_FROM.search(masked)
+    if from_match is None:
+        raise Exception('Only SELECT ... FROM queries can be run in parallel.')
+    where_match = _WHERE.search(masked, from_match.end())
+    after_match = _AFTER_WHERE.search(masked, where_match.end() if where_match else from_match.end())
+    where_start = where_match.end() if where_match else None
+    return from_match.start(), where_start, after_match.start() if after_match else len(query)
+
+
+def check_partitionable(query: str):
+    """Raise an exception explaining why ``query`` cannot be split into partitions whose results can be merged."""
+    masked = mask_nested(query)
+    from_match = _TOP_LEVEL_FROM.search(masked)
+    if from_match is None:
+        raise Exception('Only SELECT ... FROM queries can be run in parallel.')
+    clause = _UNPARTITIONABLE.search(masked, from_match.end())
+    if clause is not None:
+        raise Exception('Queries with {0} cannot be run in parallel.'.format(' '.join(clause.group(0).upper().split())))
+    if _AGGREGATE.search(query[:from_match.start()]):
+        raise Exception('Aggregate queries cannot be run in parallel.')
+
+
+def is_partitionable(query: str) -> bool:
+    try:
+        check_partitionable(query)
+    except Exception:
+        return False
+    return True
+
+
+def from_and_where(query: str) -> str:
+    """The FROM clause of ``query`` with its WHERE condition, if any, to build count and boundary queries on."""
+    from_start, _, after = _split(query)
+    return query[from_start:after].strip()
+
+
+def add_condition(query: str, condition: str) -> str:
+    """Return ``query`` with ``condition`` ANDed into its top-level WHERE clause."""
+    _, where_start, after = _split(query)
+    if where_start is None:
+        return '{0} WHERE {1} {2}'.format(query[:after].rstrip(), condition, query[after:]).strip()
+    return '{0} {1} AND ({2}) {3}'.format(query[:where_start], condition, query[where_start:after].strip(),
+                                          query[after:]).strip()
+
+
+def range_condition(field: str, low=None, high=None) -> str:
+    """SOQL condition for ``low <= field < high``; either bound, but not both, may be ``None``."""
+    if low is None and high is None:
+        raise Exception('A partition needs at least one bound.')
+    parts = []
+    if low is not None:
+        parts.append('{0} >= {1}'.format(field, low))
+    if high is not None:
+        parts.append('{0} < {1}'.format(field, high))
+    return ' AND '.join(parts)
+
+
+def _id_to_int(record_id: str) -> int:
+    number = 0
+    for char in record_id[:15]:
+        number = number * 62 + _BASE62.index(char)
+    return number
+
+
+def _int_to_id(number: int) -> str:
+    chars = []
+    for _ in range(15):
+        number, digit = divmod(number, 62)
+        chars.append(_BASE62[digit])
+    record_id = ''.join(reversed(chars))
+    # The 18 character form adds a checksum of which characters are upper case.
+    suffix = ''
+    for block in range(3):
+        flags = sum(1 << i for i, char in enumerate(record_id[block * 5:block * 5 + 5]) if 'A' <= char <= 'Z')
+        suffix += _ID_SUFFIX[flags]
+    return record_id + suffix
+
+
+def _parse_date(value: str):
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d'), '%Y-%m-%d'
+    # Salesforce returns datetimes in UTC, e.g. 2016-06-01T18:12:29.000+0000.
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'), '%Y-%m-%dT%H:%M:%SZ'
+
+
+def boundaries(first: str, last: str, partitions: int) -> list:
+    """Split the values from ``first`` to ``last`` of an Id, date or datetime field into ``partitions`` ranges.
+
+    Returns SOQL literals ``[(None, b1), (b1, b2), ..., (bn, None)]``; the open ends also cover values added after
+    the boundaries were read. Returns ``[]`` when there is nothing to split, e.g. when ``first`` equals ``last``.
+    """
+    try:
+        if len(first) in (15, 18) and first[:3] == last[:3] and first.isalnum() and last.isalnum():
+            low, high = _id_to_int(first), _id_to_int(last)
+            cuts = [low + (high - low + 1) * i // partitions for i in range(1, partitions)]
+            literals = ["'{0}'".format(_int_to_id(cut)) for cut in sorted(set(cuts)) if low < cut <= high]
+        else:
+            (low, date_format), (high, _) = _parse_date(first), _parse_date(last)
+            step = (high - low) / partitions
+            cuts = {(low + step * i).replace(microsecond=0) for i in range(1, partitions)}
+            if date_format == '%Y-%m-%d':
+                cuts = {cut.replace(hour=0, minute=0, second=0) for cut in cuts}
+            literals = [cut.strftime(date_format) for cut in sorted(cuts) if low < cut <= high]
+    except ValueError:
+        raise Exception('Only Id, date and datetime fields can partition a query, not {0!r}.'.format(first))
+    if not literals:
+        return []
+    bounds = [None] + literals + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def null_condition(field: str) -> str:
+    """SOQL condition for the partition of rows whose ``field`` is null, which no range covers."""
+    return '{0} = null'.format(field)
@@ -0,0 +1,92 @@
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_SOQL_KEYWORDS = {'and', 'asc', 'by', 'desc', 'excludes', 'first', 'from', 'group', 'having', 'in', 'includes', 'last',
+                  'like', 'limit', 'not', 'null', 'nulls', 'offset', 'or', 'order', 'select', 'where', 'with'}
+_STRING_LITERAL = re.compile(r"('(?:[^'\\]|\\.)*')")
+_WORD = re.compile(r'\w+')
+
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace and keyword case outside string literals so equivalent SOQL maps to one cache key."""
+    parts = _STRING_LITERAL.split(query.strip())
+    for i in range(0, len(parts), 2):
+        text = re.sub(r'\s+', ' ', parts[i])
+        text = re.sub(r'\s*([,()=<>!])\s*', r'\1', text)
+        parts[i] = _WORD.sub(lambda m: m.group(0).lower() if m.group(0).lower() in _SOQL_KEYWORDS else m.group(0),
+                             text)
+    return ''.join(parts)
+
+
+def estimate_size(rows) -> int:
+    """Rough number of bytes held by a list of rows, counting each cell's object plus the row lists."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for val in row:
+            size += sys.getsizeof(val)
+    return size
+
+
+class QueryCache(object):
+    """LRU cache of first-page query results with a time to live and a memory cap.
+
+    Entries are keyed by org and normalized SOQL. Once the estimated size of all entries exceeds ``max_bytes``, the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 5 * 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(org: str, query: str):
+        return org, normalize_query(query)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, size: int):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.time(), size, value)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
@@ -0,0 +1,179 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+from models.column_sort import SortIndex
+from models.result_store import format_value
+
+_WORD = re.compile(r'\w+')
+_TERM = re.compile(r'\s*(?:(?P<column>[\w.]+)\s*(?P<op>:|!=|>=|<=|=|>|<)\s*)?(?P<value>"[^"]*"?|\S+)')
+_RANGE_OPS = {'>': (False, None), '>=': (True, None), '<': (None, False), '<=': (None, True)}
+
+
+def parse_filter(expression: str, headers) -> list:
+    """Split a results filter into ``(column, op, value)`` terms that must all match.
+
+    ``Smith`` matches rows with a word starting with "smith" in any column, ``Name:"jo sm"`` restricts that to one
+    column, ``Status=Open`` and ``Status!=Open`` compare whole values case-insensitively and ``Amount>=100`` compares
+    by the column's type. ``column`` is ``None`` for terms that search every column.
+    """
+    columns = {header.lower(): col for col, header in enumerate(headers)}
+    terms = []
+    for match in _TERM.finditer(expression):
+        column, op, value = match.group('column'), match.group('op'), match.group('value')
+        if value.startswith('"'):
+            value = value[1:-1] if len(value) > 1 and value.endswith('"') else value[1:]
+        if column is None:
+            terms.append((None, ':', value))
+        elif column.lower() in columns:
+            terms.append((columns[column.lower()], op, value))
+        elif op == ':':
+            # Not a column (a time, a URL, ...), so search for the whole term.
+            terms.append((None, ':', match.group(0).strip()))
+        else:
+            raise Exception('Unknown column: {0}'.format(column))
+    return terms
+
+
+class ResultIndex(object):
+    """Inverted index from lower-cased words to the rows of a ``ResultStore`` that contain them, one per column.
+
+    Nothing is indexed up front: ``search`` indexes the columns its terms look at, so a ``Status=Open`` filter only
+    ever indexes Status and the other columns wait for a search over every column. ``update`` indexes only the rows
+    added since a column was last indexed, so the index follows the store page by page. Each distinct value is split
+    into words once per update, which keeps repeated picklist values cheap. ``update`` and ``search`` may be called
+    from worker threads.
+    """
+
+    def __init__(self, store, sort_index: SortIndex = None):
+        self.store = store
+        self.sort_index = sort_index or SortIndex(store)
+        self._lock = threading.RLock()
+        # Per column: rows indexed so far, word -> rows containing it (ascending), and the words in sorted order for
+        # prefix lookups.
+        self._row_counts = [0 for _ in store.headers]
+        self._postings = [{} for _ in store.headers]
+        self._words = [[] for _ in store.headers]
+        self._words_sorted = [True for _ in store.headers]
+
+    def indexed_rows(self, col) -> int:
+        """How many rows of column ``col`` have been indexed."""
+        return self._row_counts[col]
+
+    def update(self, row_count=None, cols=None):
+        """Index columns ``cols`` (default: all) of the store up to ``row_count`` rows (default: all)."""
+        if row_count is None:
+            row_count = len(self.store)
+        if cols is None:
+            cols = range(len(self.store.headers))
+        with self._lock:
+            for col in cols:
+                start = self._row_counts[col]
+                if row_count <= start:
+                    continue
+                values = self.store.column(col)
+                postings = self._postings[col]
+                words = self._words[col]
+                known_words = len(words)
+                split = {}
+                for row in range(start, row_count):
+                    value = values[row]
+                    if value is None:
+                        continue
+                    text = value if type(value) is str else format_value(value)
+                    value_words = split.get(text)
+                    if value_words is None:
+                        value_words = split[text] = set(_WORD.findall(text.lower()))
+                    for word in value_words:
+                        rows = postings.get(word)
+                        if rows is None:
+                            rows = postings[word] = array('l')
+                            words.append(word)
+                        rows.append(row)
+                if len(words) > known_words:
+                    self._words_sorted[col] = False
+                self._row_counts[col] = row_count
+
+    def search(self, expression: str, row_count=None, column_types=None, start=0) -> list:
+        """Return the ascending store rows from ``start`` up to ``row_count`` matching every term of the ``expression``.
+
+        A ``start`` past the rows already searched only looks at the rows added since, e.g. a new Query More page.
+        """
+        terms = parse_filter(expression, self.store.headers)
+        if row_count is None:
+            row_count = len(self.store)
+        column_types = column_types or {}
+        matches = None
+        with self._lock:
+            for column, op, value in terms:
+                # Range terms go through the sort index and need no words.
+                if op not in _RANGE_OPS:
+                    self.update(row_count, None if column is None else [column])
+                rows = self._match(column, op, value, start, row_count, column_types)
+                matches = rows if matches is None else matches & rows
+                if not matches:
+                    break
+        if matches is None:
+            return list(range(start, row_count))
+        return sorted(row for row in matches if start <= row < row_count)
+
+    def _match(self, column, op, value, start, row_count, column_types) -> set:
+        cols = range(len(self.store.headers)) if column is None else [column]
+        if op == ':':
+            words = _WORD.findall(value.lower())
+            if not words:
+                return self._scan(cols, start, row_count, lambda text: value.lower() in text)
+            rows = None
+            for word in words:
+                word_rows = set()
+                for col in cols:
+                    for rows_with_word in self._prefix_postings(col, word):
+                        word_rows.update(rows_with_word[bisect_left(rows_with_word, start):])
+                rows = word_rows if rows is None else rows & word_rows
+            return rows
+
+        field_type = column_types.get(self.store.headers[column])
+        if op in _RANGE_OPS:
+            low_inclusive, high_inclusive = _RANGE_OPS[op]
+            if low_inclusive is not None:
+                rows = self.sort_index.rows_between(column, field_type, row_count, low=value,
+                                                    low_inclusive=low_inclusive)
+            else:
+                rows = self.sort_index.rows_between(column, field_type, row_count, high=value,
+                                                    high_inclusive=high_inclusive)
+            return {row for row in rows if row >= start}
+
+        target = value.lower()
+        words = _WORD.findall(target)
+        if words:
+            # Only rows containing the first word can equal the value.
+            values = self.store.column(column)
+            candidates = self._postings[column].get(words[0], ())
+            equal = {row for row in candidates[bisect_left(candidates, start):]
+                     if format_value(values[row]).lower() == target}
+        else:
+            equal = self._scan(cols, start, row_count, lambda text: text == target)
+        if op == '=':
+            return equal
+        return set(range(start, row_count)) - equal
+
+    def _prefix_postings(self, col, prefix):
+        words = self._words[col]
+        if not self._words_sorted[col]:
+            words.sort()
+            self._words_sorted[col] = True
+        start = bisect_left(words, prefix)
+        postings = self._postings[col]
+        for i in range(start, len(words)):
+            if not words[i].startswith(prefix):
+                break
+            yield postings[words[i]]
+
+    def _scan(self, cols, start, row_count, predicate) -> set:
+        rows = set()
+        for col in cols:
+            values = self.store.column(col)
+            rows.update(row for row in range(start, row_count)
+                        if values[row] is not None and predicate(format_value(values[row]).lower()))
+        return rows
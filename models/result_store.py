@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+# Columns are sampled for this many values before deciding whether deduplicating their strings pays off.
+_DEDUP_SAMPLE_SIZE = 1000
+# Columns whose sample is more unique than this (Ids, names, ...) are stored without deduplication.
+_DEDUP_MAX_UNIQUE_RATIO = 0.5
+
+
+def format_value(value):
+    """Text shown for a cell value. Relationships that were not expanded into columns are formatted here, lazily."""
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        return ' '.join('[{0}: {1}]'.format(k, format_value(v) if isinstance(v, dict) else v)
+                        for k, v in value.items() if k != 'attributes')
+    return str(value)
+
+
+class ResultStore(object):
+    """Column-oriented storage for the records of one query, shared by the results view and exporters.
+
+    Each column is a single list of cell values. Repeated strings in low-cardinality columns (picklists, record types,
+    owner ids, ...) are deduplicated so every row points at one shared object instead of its own copy. Records are
+    only rebuilt as dictionaries when ``record`` is asked for one.
+    """
+
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.columns = [[] for _ in self.headers]
+        self.row_count = 0
+        self._dedup = [{} for _ in self.headers]
+
+    @classmethod
+    def from_rows(cls, headers, rows):
+        store = cls(headers)
+        store.append_rows(rows)
+        return store
+
+    def __len__(self):
+        return self.row_count
+
+    def append_rows(self, rows):
+        if not rows:
+            return
+        for col_i, column in enumerate(self.columns):
+            values = [row[col_i] for row in rows]
+            dedup = self._dedup[col_i]
+            if dedup is not None:
+                setdefault = dedup.setdefault
+                values = [setdefault(val, val) if type(val) is str else val for val in values]
+                if len(column) + len(values) >= _DEDUP_SAMPLE_SIZE and len(dedup) > _DEDUP_MAX_UNIQUE_RATIO * (
+                        len(column) + len(values)):
+                    self._dedup[col_i] = None
+            column.extend(values)
+        self.row_count += len(rows)
+
+    def cell(self, row, col):
+        return self.columns[col][row]
+
+    def row(self, row):
+        return [column[row] for column in self.columns]
+
+    def column(self, col):
+        return self.columns[col]
+
+    def iter_rows(self, rows=None, cols=None):
+        """Yield rows as lists, either every row or only the row indexes in ``rows``, optionally limited to ``cols``."""
+        columns = self.columns if cols is None else [self.columns[col] for col in cols]
+        if rows is None:
+            rows = range(self.row_count)
+        for row in rows:
+            yield [column[row] for column in columns]
+
+    def iter_text(self, rows, cols, include_headers=False, chunk_rows=10000, selected=None):
+        """Yield the ``rows`` x ``cols`` cells as tab separated text, ``chunk_rows`` lines at a time.
+
+        Cells are formatted a column at a time rather than cell by cell. ``selected`` optionally maps a row to the
+        set of its selected columns; the other cells of that row are left blank. Chunks after the first start with
+        the newline that ends the previous one, so joining them gives the whole text.
+        """
+        separator = ''
+        if include_headers:
+            yield '\t'.join(self.headers[col].replace('\t', ' ') for col in cols)
+            separator = '\n'
+        for start in range(0, len(rows), chunk_rows):
+            chunk = rows[start:start + chunk_rows]
+            texts = []
+            for col in cols:
+                values = self.columns[col]
+                if selected is None:
+                    cells = [format_value(values[row]) for row in chunk]
+                else:
+                    cells = [format_value(values[row]) if col in selected[row] else '' for row in chunk]
+                texts.append([cell.replace('\t', ' ') if '\t' in cell else cell for cell in cells])
+            yield separator + '\n'.join('\t'.join(line) for line in zip(*texts))
+            separator = '\n'
+
+    def record(self, row):
+        return OrderedDict(zip(self.headers, self.row(row)))
@@ -1,16 +1,38 @@
+import queue
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 
 from simple_salesforce import Salesforce
 from simple_salesforce import api
+from simple_salesforce.exceptions import SalesforceResourceNotFound
+
+from models import partitioning
+from models.metadata_cache import MetadataCache
+from models.query_cache import QueryCache, estimate_size
+from models.result_store import ResultStore
+from models.transport import TransportOptions, apply_headers, create_session
+from utils.instrumentation import Instrumentation
 
 Results = namedtuple('Results', 'totalSize size done headers records raw_records')
 
+# warm_up_fields describes at most this many of the most recently described tables.
+WARM_UP_TABLES = 50
+
+# Marks the end of one partition's pages in iter_query_parallel.
+_PARTITION_DONE = object()
 
-def _clean_results(raw_results):
+
+def _clean_results(raw_results, flattener=None):
     if raw_results['totalSize'] == 0:
         raise Exception('This Query Returns No Results')
 
+    if flattener is None:
+        flattener = _RecordFlattener(raw_results['records'][0])
+
     # Remove attributes column in records.
     for record in raw_results['records']:
         record.pop('attributes')
@@ -19,8 +41,8 @@ def _clean_results(raw_results):
         totalSize=raw_results['totalSize'],
         size=len(raw_results['records']),
         done=raw_results['done'],
-        headers=[header for header in raw_results['records'][0].keys()],
-        records=[[_flatten_record_value(val) for val in record.values()] for record in raw_results['records']],
+        headers=list(flattener.headers),
+        records=flattener.flatten(raw_results['records']),
         raw_records=raw_results['records']
     )
     return results
@@ -33,13 +55,188 @@ def _flatten_record_value(val):
         return ' '.join('[{0}: {1}]'.format(k, _flatten_record_value(val[k])) for k in val.keys() if k != 'attributes')
 
 
+def _compile_value_flattener(sample):
+    """Return a function that flattens values shaped like ``sample`` exactly as ``_flatten_record_value`` does."""
+    if not isinstance(sample, OrderedDict):
+        if sample is None:
+            # A null relationship tells us nothing about its shape, so later values go through the generic path.
+            return _flatten_record_value
+        # Scalar fields never turn into relationships in later records.
+        return None
+
+    keys = [k for k in sample.keys() if k != 'attributes']
+    if not keys:
+        return _flatten_record_value
+    converters = [(i, converter) for i, converter in enumerate(_compile_value_flattener(sample[k]) for k in keys)
+                  if converter]
+    template = ' '.join('[{0}: {{{1}}}]'.format(k.replace('{', '{{').replace('}', '}}'), i) for i, k in enumerate(keys))
+    format_values = template.format
+    get_values = itemgetter(*keys) if len(keys) > 1 else (lambda val: (val[keys[0]],))
+    size = len(sample)
+
+    def flatten(val):
+        if val.__class__ is not OrderedDict or len(val) != size:
+            return _flatten_record_value(val)
+        try:
+            values = list(get_values(val))
+        except KeyError:
+            return _flatten_record_value(val)
+        for i, convert in converters:
+            values[i] = convert(values[i])
+        return format_values(*values)
+
+    return flatten
+
+
+class _RecordFlattener(object):
+    """Turns records into rows using a plan compiled from the first record of a query.
+
+    Every record of a SOQL result has the same fields in the same order, so the plan fetches the values with one
+    ``itemgetter`` and only converts the columns that can hold relationships. Values that do not match the compiled
+    shape fall back to ``_flatten_record_value``, so the rows are always identical to flattening each value one by one.
+    """
+
+    def __init__(self, sample_record):
+        self.keys = [k for k in sample_record.keys() if k != 'attributes']
+        self.headers = self.keys
+        self._get_values = itemgetter(*self.keys) if len(self.keys) > 1 else (lambda record: (record[self.keys[0]],))
+        self._converters = [(i, converter) for i, converter in
+                            enumerate(_compile_value_flattener(sample_record[k]) for k in self.keys) if converter]
+
+    def flatten(self, records):
+        get_values = self._get_values
+        converters = self._converters
+        width = len(self.keys)
+
+        rows = []
+        for record in records:
+            try:
+                if len(record) != width:
+                    raise KeyError
+                row = list(get_values(record))
+            except KeyError:
+                rows.append([_flatten_record_value(val) for val in record.values()])
+                continue
+            for i, convert in converters:
+                row[i] = convert(row[i])
+            rows.append(row)
+        return rows
+
+
+# Marks a field that has only been seen as null, so it is not known yet whether it is a relationship.
+_UNKNOWN_SHAPE = object()
+# How many records of the first page are looked at to find the fields of relationships that are often null.
+_SHAPE_SAMPLE_SIZE = 200
+
+
+def _merge_relationship_shape(shape, value):
+    """Add the fields of relationship ``value`` to ``shape`` and return whether every field's kind is known now."""
+    for key, sub_value in value.items():
+        if key == 'attributes':
+            continue
+        if isinstance(sub_value, OrderedDict):
+            known = shape.get(key)
+            if not isinstance(known, OrderedDict):
+                known = shape[key] = OrderedDict()
+            _merge_relationship_shape(known, sub_value)
+        elif sub_value is None:
+            shape.setdefault(key, _UNKNOWN_SHAPE)
+        elif shape.get(key, _UNKNOWN_SHAPE) is _UNKNOWN_SHAPE:
+            shape[key] = None
+    return _shape_resolved(shape)
+
+
+def _shape_resolved(shape):
+    return all(known is not _UNKNOWN_SHAPE and (not isinstance(known, OrderedDict) or _shape_resolved(known))
+               for known in shape.values())
+
+
+def _shape_paths(shape, prefix=()):
+    for key, known in shape.items():
+        if isinstance(known, OrderedDict) and known:
+            yield from _shape_paths(known, prefix + (key,))
+        else:
+            yield prefix + (key,)
+
+
+def _compile_path_getter(paths):
+    """Return a function reading every ``paths`` entry from one relationship value, with None for missing links."""
+    def get_values(value):
+        if value is None:
+            return [None] * len(paths)
+        values = []
+        for path in paths:
+            node = value
+            for key in path:
+                node = node.get(key) if isinstance(node, dict) else None
+            values.append(node)
+        return values
+
+    return get_values
+
+
+class _RelationshipExpander(object):
+    """Turns records into rows with every relationship field in its own dotted column (``Account__r.Name``).
+
+    The columns come from the first page: for each relationship up to ``_SHAPE_SAMPLE_SIZE`` records are scanned until
+    it, and any nested relationship, has been seen with a value. A relationship that is null in every sampled record
+    stays a single column holding the raw value. Values are kept as they are; turning them into text is left to
+    whoever shows them, so only visible cells are ever formatted.
+    """
+
+    def __init__(self, sample_records):
+        self.keys = [k for k in sample_records[0].keys() if k != 'attributes']
+        self.headers = []
+        self._plan = []
+
+        for key in self.keys:
+            shape = OrderedDict()
+            for record in sample_records[:_SHAPE_SAMPLE_SIZE]:
+                value = record.get(key)
+                if not isinstance(value, OrderedDict):
+                    if value is None:
+                        continue
+                    shape = None
+                    break
+                if _merge_relationship_shape(shape, value):
+                    break
+
+            if not shape:
+                self.headers.append(key)
+                self._plan.append(None)
+            else:
+                paths = list(_shape_paths(shape))
+                self.headers.extend('.'.join((key,) + path) for path in paths)
+                self._plan.append(_compile_path_getter(paths))
+
+        self._get_values = itemgetter(*self.keys) if len(self.keys) > 1 else (lambda record: (record[self.keys[0]],))
+
+    def flatten(self, records):
+        get_values = self._get_values
+        plan = list(enumerate(self._plan))
+        if all(expand is None for expand in self._plan):
+            return [list(get_values(record)) for record in records]
+
+        rows = []
+        for record in records:
+            values = get_values(record)
+            row = []
+            for i, expand in plan:
+                if expand is None:
+                    row.append(values[i])
+                else:
+                    row.extend(expand(values[i]))
+            rows.append(row)
+        return rows
+
+
 class AbstractSForceConnector(metaclass=ABCMeta):
     @abstractmethod
     def query_raw(self, query):
         pass
 
     @abstractmethod
-    def query(self, query):
+    def query(self, query, force_refresh=False, cancelled=None):
         pass
 
     @abstractmethod
@@ -47,7 +244,15 @@ class AbstractSForceConnector(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def query_more(self):
+    def query_more(self, cancelled=None):
+        pass
+
+    @abstractmethod
+    def iter_query(self, query, page_callback=None, max_records=None):
+        pass
+
+    @abstractmethod
+    def bulk_query(self, query, out_file, poll_interval=2.0, page_size=50000, progress=None, cancelled=None):
         pass
 
     @abstractmethod
@@ -68,45 +273,430 @@ class AbstractSForceConnector(metaclass=ABCMeta):
 
 
 class SForceConnector(AbstractSForceConnector):
-    def __init__(self, username: str, password: str, sandbox: bool, security_token: str = '', _sf_lib=Salesforce):
-        self.session = _sf_lib(username=username, password=password, security_token=security_token, sandbox=sandbox)
+    def __init__(self, username: str, password: str, sandbox: bool, security_token: str = '', _sf_lib=Salesforce,
+                 prefetch_depth: int = 1, prefetch_max_records: int = 10000, metadata_cache: bool = True,
+                 metadata_cache_dir: str = None, metadata_ttl: float = 24 * 60 * 60, expand_relationships: bool = True,
+                 query_cache: bool = True, query_cache_max_bytes: int = 64 * 1024 * 1024,
+                 query_cache_ttl: float = 5 * 60, transport: TransportOptions = TransportOptions(),
+                 instrumentation: Instrumentation = None, session_id: str = None, instance_url: str = None):
+        """Log in to Salesforce, or reuse ``session_id`` on ``instance_url`` from an earlier login when given.
+
+        A reused session is not checked up front: the first request rejected with ``INVALID_SESSION_ID`` logs in again
+        with the credentials and is sent once more, and so is any request made after the session expires.
+        """
+        self._sf_lib = _sf_lib
+        self._transport = transport
+        self._credentials = {'username': username, 'password': password, 'security_token': security_token,
+                             'domain': 'test' if sandbox else 'login'}
+        self._login_lock = threading.Lock()
+        self._renewing = threading.local()
+        # Without transport options the library sets up its own default requests session.
+        requests_session = None if transport is None else create_session(transport)
+        if session_id and instance_url:
+            self.session = self._connect(requests_session, session_id=session_id, instance_url=instance_url)
+        else:
+            self.session = self._connect(requests_session, **self._credentials)
+        # Disabled unless the caller turns it on; the response hook then adds network time and bytes to whichever
+        # operation is running on the requesting thread.
+        self.instrumentation = instrumentation or Instrumentation()
+        self.session.session.hooks['response'].append(self.instrumentation.response_hook)
+        self.session.session.hooks['response'].append(self._renew_expired_session)
+        self.org_key = '{0}@{1}'.format(username, self.session.sf_instance)
         self.next_record_url = None
-        self.prev_results = None
         self.prev_size = None
+        self.results_store = None
+        self._flattener = None
+        self.expand_relationships = expand_relationships
         self.loaded_tables = []
         self.loaded_fields = {}
+        # Tables described before the last invalidate_metadata, still worth warming up after a reload.
+        self._recent_tables = []
+        self.metadata_cache = None
+        if metadata_cache:
+            self.metadata_cache = MetadataCache(self.org_key, directory=metadata_cache_dir, ttl=metadata_ttl)
+        self.query_cache = QueryCache(query_cache_max_bytes, query_cache_ttl) if query_cache else None
+
+        # Query More pages fetched ahead of time, keyed by their nextRecordsUrl.
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_max_records = prefetch_max_records
+        self._prefetch_lock = threading.Condition()
+        self._prefetch_pages = OrderedDict()
+        self._prefetch_url = None
+        self._prefetch_generation = 0
+        self._prefetch_active = None
+        self._prefetch_executor = None
+
+    @property
+    def session_id(self) -> str:
+        return self.session.session_id
+
+    @property
+    def instance_url(self) -> str:
+        return 'https://{0}'.format(self.session.sf_instance)
+
+    def _connect(self, requests_session, **kwargs):
+        sf_kwargs = {} if requests_session is None else {'session': requests_session}
+        session = self._sf_lib(**kwargs, **sf_kwargs)
+        if self._transport is not None:
+            apply_headers(session.headers, self._transport)
+        return session
+
+    def _renew_expired_session(self, response, *args, **kwargs):
+        """``requests`` response hook that logs in again when Salesforce rejects the session id and resends the
+        request once with the new one."""
+        if response.status_code != 401 or getattr(self._renewing, 'active', False):
+            return None
+        try:
+            if response.json()[0]['errorCode'] != 'INVALID_SESSION_ID':
+                return None
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None
+
+        request = response.request.copy()
+        self._renewing.active = True
+        try:
+            with self._login_lock:
+                expired = self.session
+                # Another thread may already have logged in again while this request was in flight.
+                if request.headers.get('Authorization') == expired.headers['Authorization']:
+                    self.session = self._connect(expired.session, **self._credentials)
+            request.headers['Authorization'] = self.session.headers['Authorization']
+            if self.session.sf_instance != expired.sf_instance:
+                request.url = request.url.replace(expired.sf_instance, self.session.sf_instance, 1)
+            return self.session.session.send(request, **kwargs)
+        finally:
+            self._renewing.active = False
 
     def query_raw(self, query):
+        self._reset_prefetch()
         results = self.session.query(query)
-        self.next_record_url = None if results['done'] else results['nextRecordsUrl']
+        with self._prefetch_lock:
+            self.next_record_url = None if results['done'] else results['nextRecordsUrl']
+        self._start_prefetch()
         return results
 
-    def query(self, query):
-        try:
-            raw_results = self.query_raw(query)
-        except api.SalesforceError as ex:
-            raise Exception(ex.content[0]['message'])
-        results = _clean_results(raw_results)
-        self.prev_results = results.records
+    def query(self, query, force_refresh=False, cancelled=None):
+        """Run ``query`` and return its first page.
+
+        Repeated queries are answered from ``query_cache`` unless ``force_refresh`` is set. A cached page restores the
+        Query More position it had, and its ``raw_records`` is empty. If the ``cancelled`` callable returns true once
+        the page has arrived, the page is dropped, paging stops and ``None`` is returned.
+        """
+        instrumentation = self.instrumentation
+        with instrumentation.operation('query'):
+            cache_key = None
+            if self.query_cache is not None:
+                cache_key = QueryCache.key(self.org_key, query)
+                cached = None if force_refresh else self.query_cache.get(cache_key)
+                if cached is not None:
+                    instrumentation.count('cache_hits')
+                    instrumentation.count('rows', cached[0].size)
+                    return self._restore_cached_query(*cached)
+
+            try:
+                with instrumentation.phase('fetch'):
+                    raw_results = self.query_raw(query)
+            except api.SalesforceError as ex:
+                raise Exception(ex.content[0]['message'])
+            if cancelled is not None and cancelled():
+                self._stop_paging()
+                return None
+            with instrumentation.phase('clean'):
+                # Every page of this query shares the first page's shape, so the flattener is compiled once here.
+                self._flattener = self._compile_flattener(raw_results['records'])
+                results = _clean_results(raw_results, self._flattener)
+            with instrumentation.phase('store'):
+                self.prev_size = results.size
+                self.results_store = ResultStore.from_rows(results.headers, results.records)
+            instrumentation.count('rows', results.size)
+
+            if cache_key is not None:
+                self.query_cache.put(cache_key, (results._replace(raw_records=[]), self.next_record_url,
+                                                 self._flattener), estimate_size(results.records))
+            return results
+
+    def _restore_cached_query(self, results, next_record_url, flattener):
+        self._reset_prefetch()
+        with self._prefetch_lock:
+            self.next_record_url = next_record_url
+        self._flattener = flattener
         self.prev_size = results.size
+        self.results_store = ResultStore.from_rows(results.headers, results.records)
+        self._start_prefetch()
         return results
 
     def query_more_raw(self):
         if self.next_record_url is None:
             raise Exception('You must run a query first.')
-        results = self.session.query_more(self.next_record_url, True)
-        self.next_record_url = None if results['done'] else results['nextRecordsUrl']
+        with self.instrumentation.phase('prefetch_wait'):
+            results = self._take_prefetched(self.next_record_url)
+        if results is None:
+            with self.instrumentation.phase('fetch'):
+                results = self.session.query_more(self.next_record_url, True)
+        with self._prefetch_lock:
+            self.next_record_url = None if results['done'] else results['nextRecordsUrl']
+        self._start_prefetch()
         return results
 
-    def query_more(self):
+    def query_more(self, cancelled=None):
+        """Fetch the next page of the last query into ``results_store``; ``cancelled`` works as for ``query``."""
+        instrumentation = self.instrumentation
+        with instrumentation.operation('query_more'):
+            try:
+                raw_results = self.query_more_raw()
+            except api.SalesforceError as ex:
+                raise Exception(ex.content[0]['message'])
+            if cancelled is not None and cancelled():
+                self._stop_paging()
+                return None
+            with instrumentation.phase('clean'):
+                results = _clean_results(raw_results, self._flattener)
+            with instrumentation.phase('store'):
+                self.prev_size += results.size
+                self.results_store.append_rows(results.records)
+            instrumentation.count('rows', results.size)
+            # Only the new page's records are returned; size counts every record fetched so far and results_store
+            # holds all of them.
+            return results._replace(size=self.prev_size)
+
+    def iter_query(self, query, page_callback=None, max_records=None):
+        """Yield the cleaned records of ``query`` one at a time, following ``nextRecordsUrl`` until done.
+
+        Pages are only fetched as the generator is consumed, so at most one page is held in memory, and the Query More
+        state used by ``query_more`` is left untouched. ``page_callback`` receives each page's ``Results`` before its
+        records are yielded. No more than ``max_records`` records are yielded when it is given.
+        """
         try:
-            raw_results = self.query_more_raw()
+            raw_results = self.session.query(query)
         except api.SalesforceError as ex:
             raise Exception(ex.content[0]['message'])
-        results = _clean_results(raw_results)
-        self.prev_results.extend(results.records)
-        self.prev_size += results.size
-        return results._replace(records=self.prev_results, size=self.prev_size)
+        if raw_results['totalSize'] == 0:
+            return
+
+        record_count = 0
+        flattener = self._compile_flattener(raw_results['records'])
+        while raw_results['records']:
+            results = _clean_results(raw_results, flattener)
+            if page_callback is not None:
+                page_callback(results)
+            for record in results.records:
+                if max_records is not None and record_count >= max_records:
+                    return
+                yield record
+                record_count += 1
+
+            if raw_results['done'] or (max_records is not None and record_count >= max_records):
+                return
+            try:
+                raw_results = self.session.query_more(raw_results['nextRecordsUrl'], True)
+            except api.SalesforceError as ex:
+                raise Exception(ex.content[0]['message'])
+
+    def partition_query(self, query, partitions: int = 8, partition_field: str = 'Id') -> list:
+        """Split ``query`` into ``partitions`` queries over ranges of ``partition_field`` that together return its rows.
+
+        The range ends come from the lowest and highest ``partition_field`` values the query matches: Ids are cut
+        into equal numeric ranges (PK chunking), dates and datetimes into equal time spans. Rows with a null date get
+        a partition of their own.
+        """
+        partitioning.check_partitionable(query)
+        source = partitioning.from_and_where(query)
+        bounds = []
+        try:
+            for direction in ('ASC', 'DESC'):
+                records = self.session.query('SELECT {0} {1} ORDER BY {0} {2} NULLS LAST LIMIT 1'.format(
+                    partition_field, source, direction))['records']
+                bounds.append(records[0][partition_field] if records else None)
+        except api.SalesforceError as ex:
+            raise Exception(ex.content[0]['message'])
+
+        # With no values, or a single one, there is nothing to split and the query runs as it is.
+        ranges = [] if bounds[0] is None else partitioning.boundaries(bounds[0], bounds[1], partitions)
+        if not ranges:
+            return [query]
+        conditions = [partitioning.range_condition(partition_field, low, high) for low, high in ranges]
+        if partition_field != 'Id':
+            conditions.append(partitioning.null_condition(partition_field))
+        return [partitioning.add_condition(query, condition) for condition in conditions]
+
+    def iter_query_parallel(self, query, max_workers: int = 4, partitions: int = None, partition_field: str = 'Id',
+                            cancelled=None):
+        """Yield the ``Results`` pages of ``query``, running its partitions (see ``partition_query``) concurrently.
+
+        At most ``max_workers`` partitions are paged through at once and their pages are merged in arrival order, so
+        rows are not in any particular order. Each yielded page has the query's ``totalSize``, the cumulative
+        ``size`` and the headers of the first page. A few pages are buffered at most; workers wait while the consumer
+        catches up. ``cancelled`` is polled while waiting for pages.
+        """
+        queries = self.partition_query(query, partitions or max_workers * 2, partition_field)
+        try:
+            total_size = self.session.query('SELECT COUNT() ' + partitioning.from_and_where(query))['totalSize']
+        except api.SalesforceError as ex:
+            raise Exception(ex.content[0]['message'])
+
+        pages = queue.Queue(maxsize=max_workers * 2)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def run(partition):
+            try:
+                if stop.is_set():
+                    return
+                raw_results = self.session.query(partition)
+                while not stop.is_set():
+                    if raw_results['records']:
+                        put(raw_results)
+                    if raw_results['done']:
+                        break
+                    raw_results = self.session.query_more(raw_results['nextRecordsUrl'], True)
+            except api.SalesforceError as ex:
+                put(Exception(ex.content[0]['message']))
+            except Exception as ex:
+                put(ex)
+            finally:
+                put(_PARTITION_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for partition in queries:
+                executor.submit(run, partition)
+            remaining = len(queries)
+            flattener = None
+            size = 0
+            while remaining:
+                if cancelled is not None and cancelled():
+                    raise Exception('Query cancelled.')
+                try:
+                    raw_results = pages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if raw_results is _PARTITION_DONE:
+                    remaining -= 1
+                    continue
+                if isinstance(raw_results, Exception):
+                    raise raw_results
+                with self.instrumentation.phase('clean'):
+                    if flattener is None:
+                        flattener = self._compile_flattener(raw_results['records'])
+                    results = _clean_results(raw_results, flattener)
+                size += len(results.records)
+                yield results._replace(totalSize=total_size, size=size, done=size >= total_size)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def query_parallel(self, query, max_workers: int = 4, partitions: int = None, partition_field: str = 'Id',
+                       progress=None, cancelled=None):
+        """Load every row of ``query`` into ``results_store`` with ``iter_query_parallel``.
+
+        Returns a ``Results`` summary with no records; there is nothing left for ``query_more``.
+        """
+        store = None
+        results = None
+        with self.instrumentation.operation('query_parallel', workers=max_workers):
+            for results in self.iter_query_parallel(query, max_workers, partitions, partition_field, cancelled):
+                if store is None:
+                    store = ResultStore(results.headers)
+                with self.instrumentation.phase('store'):
+                    store.append_rows(results.records)
+                self.instrumentation.count('rows', len(results.records))
+                if progress is not None:
+                    progress('Loaded {0} / {1} Records'.format(results.size, results.totalSize))
+        if results is None:
+            raise Exception('This Query Returns No Results')
+
+        self._reset_prefetch()
+        with self._prefetch_lock:
+            self.next_record_url = None
+        self.prev_size = results.size
+        self.results_store = store
+        return results._replace(done=True, records=[], raw_records=[])
+
+    def bulk_query(self, query, out_file, poll_interval=2.0, page_size=50000, progress=None, cancelled=None):
+        """Run ``query`` as a Bulk API 2.0 query job and stream its CSV results into ``out_file``.
+
+        ``out_file`` is a path or a binary file object. The job is polled every ``poll_interval`` seconds and its
+        results are downloaded ``page_size`` records at a time, with the header row written only once. ``progress``
+        receives status messages and ``cancelled`` is polled to abort the job early. Returns the number of records
+        written.
+        """
+        if isinstance(out_file, str):
+            with open(out_file, 'wb') as file:
+                return self.bulk_query(query, file, poll_interval, page_size, progress, cancelled)
+
+        with self.instrumentation.operation('bulk_query'):
+            job_url = self.session.base_url + 'jobs/query'
+            job = self._bulk_request('POST', job_url, json={'operation': 'query', 'query': query}).json()
+            job_url = '{0}/{1}'.format(job_url, job['id'])
+
+            while job['state'] not in ('JobComplete', 'Failed', 'Aborted'):
+                if cancelled is not None and cancelled():
+                    self._bulk_request('PATCH', job_url, json={'state': 'Aborted'})
+                    raise Exception('Bulk query cancelled.')
+                if progress is not None:
+                    progress('Bulk Query {0}...'.format(job['state']))
+                time.sleep(poll_interval)
+                job = self._bulk_request('GET', job_url).json()
+            if job['state'] != 'JobComplete':
+                raise Exception(job.get('errorMessage') or 'Bulk query {0}.'.format(job['state'].lower()))
+
+            record_count = 0
+            locator = None
+            while True:
+                params = {'maxRecords': page_size}
+                if locator is not None:
+                    params['locator'] = locator
+                response = self._bulk_request('GET', job_url + '/results', params=params, stream=True,
+                                              headers={'Accept': 'text/csv'})
+                # Every result page repeats the CSV header row; keep it only from the first page.
+                skip_header = locator is not None
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if skip_header:
+                        header_end = chunk.find(b'\n')
+                        if header_end < 0:
+                            continue
+                        chunk = chunk[header_end + 1:]
+                        skip_header = False
+                    out_file.write(chunk)
+
+                page_records = int(response.headers.get('Sforce-NumberOfRecords', 0))
+                record_count += page_records
+                self.instrumentation.count('rows', page_records)
+                if progress is not None:
+                    progress('Downloaded {0} / {1} Records'.format(record_count,
+                                                                   job.get('numberRecordsProcessed', '?')))
+                locator = response.headers.get('Sforce-Locator')
+                if locator in (None, '', 'null'):
+                    return record_count
+                if cancelled is not None and cancelled():
+                    raise Exception('Bulk query cancelled.')
+
+    def _bulk_request(self, method, url, headers=None, **kwargs):
+        request_headers = dict(self.session.headers)
+        if headers is not None:
+            request_headers.update(headers)
+        response = self.session.session.request(method, url, headers=request_headers, **kwargs)
+        if response.status_code >= 300:
+            try:
+                message = response.json()[0]['message']
+            except (ValueError, KeyError, IndexError, TypeError):
+                message = response.text
+            raise Exception(message)
+        return response
+
+    def _compile_flattener(self, records):
+        if not records:
+            return None
+        if self.expand_relationships:
+            return _RelationshipExpander(records)
+        return _RecordFlattener(records[0])
 
     def insert_into_table(self, table_name, insert_dict):
         response = getattr(self.session, table_name).create(insert_dict)
@@ -114,14 +704,190 @@ class SForceConnector(AbstractSForceConnector):
 
     def get_table_fields(self, table_name, reload=False):
         if table_name not in self.loaded_fields or reload:
-            self.loaded_fields[table_name] = {field['name']: field
-                                              for field in getattr(self.session, table_name).describe()['fields']}
+            def fetch(headers):
+                sobject = getattr(self.session, table_name)
+                return {field['name']: field for field in sobject.describe(headers=headers)['fields']}
+            self.loaded_fields[table_name] = self._cached_describe('sobject.{0}'.format(table_name), fetch, reload)
         return self.loaded_fields[table_name]
 
     def get_tables(self, reload=False) -> list:
         if len(self.loaded_tables) == 0 or reload:
-            self.loaded_tables = [obj['name'] for obj in self.session.describe()['sobjects'] if obj['searchable']]
+            def fetch(headers):
+                return [obj['name'] for obj in self.session.describe(headers=headers)['sobjects'] if obj['searchable']]
+            self.loaded_tables = self._cached_describe('describe', fetch, reload)
         return self.loaded_tables
 
+    def cached_tables(self) -> list:
+        """The table list from memory or the metadata cache, however old, without touching the network.
+
+        Returns an empty list when the tables have never been loaded for this org.
+        """
+        if self.loaded_tables or self.metadata_cache is None:
+            return self.loaded_tables
+        entry = self.metadata_cache.get('describe')
+        return [] if entry is None else entry['value']
+
+    def recent_tables(self) -> list:
+        """Tables described in this session or found in the metadata cache, most recently described first."""
+        names = list(reversed(list(self.loaded_fields)))
+        if self.metadata_cache is not None:
+            names += [key[len('sobject.'):] for key in self.metadata_cache.keys('sobject.')]
+        return list(OrderedDict.fromkeys(names + self._recent_tables))
+
+    def warm_up_fields(self, table_names=None, max_workers: int = 4) -> int:
+        """Describe ``table_names`` concurrently into ``loaded_fields``.
+
+        By default these are the ``WARM_UP_TABLES`` most recent of ``recent_tables`` that still exist, which are
+        usually fresh in the metadata cache. At most ``max_workers`` describes are in flight at once to stay well inside
+        the org's concurrent request limit. A table that fails to describe is skipped. Returns the number of tables
+        that were described.
+        """
+        if table_names is None:
+            tables = set(self.get_tables())
+            table_names = [name for name in self.recent_tables() if name in tables][:WARM_UP_TABLES]
+        pending = [name for name in table_names if name not in self.loaded_fields]
+        if not pending:
+            return 0
+
+        described = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.get_table_fields, name) for name in pending]
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    described += 1
+        return described
+
+    def get_column_types(self, table_name, headers) -> dict:
+        """Map result ``headers`` to the describe types of their fields on ``table_name``.
+
+        Dotted headers such as ``Owner.Name`` follow the relationship's ``referenceTo`` table. Headers that do not
+        name a field (aggregate aliases, unknown relationships, ...) are left out.
+        """
+        column_types = {}
+        table_fields = self.get_table_fields(table_name)
+        for header in headers:
+            *path, field_name = header.split('.')
+            fields = table_fields
+            try:
+                for relationship in path:
+                    reference = next(field for field in fields.values()
+                                     if (field.get('relationshipName') or '').lower() == relationship.lower())
+                    fields = self.get_table_fields(reference['referenceTo'][0])
+            except (StopIteration, IndexError, SalesforceResourceNotFound):
+                # Not a relationship of the table, or one to a table this user cannot describe.
+                continue
+            field = fields.get(field_name) or next(
+                (field for name, field in fields.items() if name.lower() == field_name.lower()), None)
+            if field is not None:
+                column_types[header] = field.get('type')
+        return column_types
+
+    def invalidate_metadata(self):
+        self._recent_tables = self.recent_tables()[:WARM_UP_TABLES]
+        self.loaded_tables = []
+        self.loaded_fields = {}
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate()
+
+    def _cached_describe(self, cache_key, fetch, reload=False):
+        """Return ``fetch(headers)`` through the on-disk metadata cache.
+
+        Fresh entries skip the network entirely. Stale entries are revalidated with If-Modified-Since, and a
+        ``304 Not Modified`` answer keeps the cached value. ``reload`` always fetches and overwrites the entry.
+        """
+        with self.instrumentation.operation(cache_key):
+            # simple_salesforce merges the extra headers into its own, so "none" has to be an empty dict.
+            if self.metadata_cache is None:
+                with self.instrumentation.phase('fetch'):
+                    return fetch({})
+
+            entry = None if reload else self.metadata_cache.get(cache_key)
+            if entry is not None and self.metadata_cache.is_fresh(entry):
+                self.instrumentation.count('cache_hits')
+                return entry['value']
+
+            headers = {} if entry is None else {'If-Modified-Since': self.metadata_cache.if_modified_since(entry)}
+            try:
+                with self.instrumentation.phase('fetch'):
+                    value = fetch(headers)
+            except api.SalesforceError as ex:
+                if entry is not None and ex.status == 304:
+                    self.instrumentation.count('cache_hits')
+                    return self.metadata_cache.touch(cache_key, entry)['value']
+                raise
+            return self.metadata_cache.put(cache_key, value)['value']
+
     def close(self):
-        self.session.close()
\ No newline at end of file
+        self._reset_prefetch()
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown(wait=False)
+        self.session.session.close()
+
+    def _stop_paging(self):
+        """Forget the Query More position and drop its prefetched pages, e.g. when a query is cancelled."""
+        self._reset_prefetch()
+        with self._prefetch_lock:
+            self.next_record_url = None
+
+    def _reset_prefetch(self):
+        """Discard buffered pages. Prefetches still in flight belong to an old generation and are dropped."""
+        with self._prefetch_lock:
+            self._prefetch_generation += 1
+            self._prefetch_pages.clear()
+            self._prefetch_url = None
+            self._prefetch_lock.notify_all()
+
+    def _start_prefetch(self):
+        if self.prefetch_depth <= 0 or self.next_record_url is None:
+            return
+        with self._prefetch_lock:
+            if self._prefetch_active == self._prefetch_generation:
+                return
+            self._prefetch_active = self._prefetch_generation
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=2)
+            self._prefetch_executor.submit(self._run_prefetch, self._prefetch_generation)
+
+    def _next_prefetch_url(self):
+        url = self.next_record_url
+        while url in self._prefetch_pages:
+            page = self._prefetch_pages[url]
+            url = None if page['done'] else page['nextRecordsUrl']
+        return url
+
+    def _run_prefetch(self, generation):
+        while True:
+            with self._prefetch_lock:
+                url = self._next_prefetch_url()
+                buffered_records = sum(len(page['records']) for page in self._prefetch_pages.values())
+                if (generation != self._prefetch_generation or url is None
+                        or len(self._prefetch_pages) >= self.prefetch_depth
+                        or buffered_records >= self.prefetch_max_records):
+                    if self._prefetch_active == generation:
+                        self._prefetch_active = None
+                    return
+                self._prefetch_url = url
+
+            try:
+                with self.instrumentation.operation('prefetch'), self.instrumentation.phase('fetch'):
+                    results = self.session.query_more(url, True)
+            except Exception:
+                # Query More will fetch the page itself and surface the error.
+                results = None
+
+            with self._prefetch_lock:
+                if generation == self._prefetch_generation:
+                    self._prefetch_url = None
+                    if results is not None:
+                        self._prefetch_pages[url] = results
+                self._prefetch_lock.notify_all()
+                if results is None:
+                    if self._prefetch_active == generation:
+                        self._prefetch_active = None
+                    return
+
+    def _take_prefetched(self, url):
+        with self._prefetch_lock:
+            while self._prefetch_url is not None and self._prefetch_url == url:
+                self._prefetch_lock.wait()
+            return self._prefetch_pages.pop(url, None)
\ No newline at end of file
@@ -0,0 +1,50 @@
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TransportOptions = namedtuple('TransportOptions', 'pool_size keep_alive compress compact_json retries backoff timeout')
+# Query pages are large JSON bodies: gzip them, and drop the pretty-printing simple_salesforce asks for by default.
+# GETs failing with a connection error or a transient 5xx are retried with exponential backoff. ``timeout`` is the
+# (connect, read) timeout in seconds applied to every request that does not set its own.
+TransportOptions.__new__.__defaults__ = (10, True, True, True, 3, 0.5, (10.0, 300.0))
+
+# Gateway and availability errors that are worth retrying; everything else goes straight back to simple_salesforce.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class _TransportAdapter(HTTPAdapter):
+    """``HTTPAdapter`` with a default timeout, since ``requests`` waits forever unless every call passes one."""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def create_session(options: TransportOptions = TransportOptions()) -> requests.Session:
+    """Build the ``requests.Session`` the Salesforce session sends every request through.
+
+    One adapter serves both http and https with a connection pool of ``options.pool_size``, so the prefetch and
+    describe threads reuse warm connections instead of opening new TLS sessions.
+    """
+    retry = Retry(total=options.retries, backoff_factor=options.backoff, status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = _TransportAdapter(timeout=options.timeout, pool_connections=options.pool_size,
+                                pool_maxsize=options.pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate' if options.compress else 'identity'
+    if not options.keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def apply_headers(sf_headers: dict, options: TransportOptions = TransportOptions()):
+    """Adjust the per-request headers of a ``simple_salesforce.Salesforce`` session for ``options``."""
+    if options.compact_json:
+        sf_headers.pop('X-PrettyPrint', None)
@@ -0,0 +1,462 @@
+import gzip
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from simple_salesforce import Salesforce
+
+
+def make_record(index, table_name='Account'):
+    return OrderedDict([
+        ('attributes', OrderedDict([
+            ('type', table_name),
+            ('url', '/services/data/v29.0/sobjects/{0}/{1:018d}'.format(table_name, index))
+        ])),
+        ('Id', '{0:018d}'.format(index)),
+        ('Name', 'Record {0}'.format(index))
+    ])
+
+
+def make_relationship(index, depth, field_count=2, table_name='Account'):
+    fields = [('attributes', OrderedDict([
+        ('type', table_name),
+        ('url', '/services/data/v29.0/sobjects/{0}/{1:018d}'.format(table_name, index))
+    ]))]
+    fields.extend(('Field{0}__c'.format(i), 'Value {0}-{1}'.format(index, i)) for i in range(field_count))
+    if depth > 1:
+        fields.append(('Owner', make_relationship(index, depth - 1, field_count, 'User')))
+    return OrderedDict(fields)
+
+
+def make_query_page(record_count, field_count=10, relationship_count=2, nesting_depth=1, total_size=None, start=0,
+                    done=True):
+    """Build a ``session.query`` payload with ``record_count`` records shaped like a typical SOQL result.
+
+    Each record has ``field_count`` scalar fields (strings, numbers, booleans, dates and some nulls) plus
+    ``relationship_count`` relationship fields nested ``nesting_depth`` levels deep.
+    """
+    records = []
+    for index in range(start, start + record_count):
+        fields = [
+            ('attributes', OrderedDict([
+                ('type', 'Sample_Transaction_vod__c'),
+                ('url', '/services/data/v29.0/sobjects/Sample_Transaction_vod__c/{0:018d}'.format(index))
+            ])),
+            ('Id', '{0:018d}'.format(index)),
+        ]
+        for i in range(field_count):
+            kind = i % 5
+            if kind == 0:
+                value = 'Text {0} {1}'.format(index, i)
+            elif kind == 1:
+                value = float(index * i)
+            elif kind == 2:
+                value = index % 2 == 0
+            elif kind == 3:
+                value = '2016-06-{0:02d}T18:12:29.000+0000'.format(index % 28 + 1)
+            else:
+                value = None if index % 3 else 'Status {0}'.format(index % 4)
+            fields.append(('Field{0}__c'.format(i), value))
+        for i in range(relationship_count):
+            fields.append(('Relation{0}__r'.format(i), make_relationship(index, nesting_depth) if index % 10 else None))
+        records.append(OrderedDict(fields))
+
+    return OrderedDict([
+        ('totalSize', start + record_count if total_size is None else total_size),
+        ('done', done),
+        ('records', records)
+    ])
+
+
+MOCK_TABLES = {
+    'Account': ['Id', 'Name', 'OwnerId', 'AnnualRevenue', 'IsDeleted'],
+    'Contact': ['Id', 'FirstName', 'LastName', 'AccountId'],
+}
+MOCK_FIELD_TYPES = {'AnnualRevenue': 'currency', 'IsDeleted': 'boolean'}
+
+
+def _mock_field(name):
+    if name.endswith('Id') and name != 'Id':
+        return {'name': name, 'type': 'reference', 'relationshipName': name[:-2], 'referenceTo': [name[:-2]]}
+    return {'name': name, 'type': 'id' if name == 'Id' else MOCK_FIELD_TYPES.get(name, 'string')}
+
+
+def _check_headers(headers):
+    # simple_salesforce 1.12 merges extra headers into its own with dict.update, which fails on None.
+    if not isinstance(headers, dict):
+        raise TypeError("'{0}' object is not iterable".format(type(headers).__name__))
+
+
+class MockSFType(object):
+    def __init__(self, salesforce, table_name):
+        self.salesforce = salesforce
+        self.table_name = table_name
+
+    def describe(self, headers=None):
+        _check_headers(headers)
+        self.salesforce.describe_calls += 1
+        return {'name': self.table_name, 'fields': [_mock_field(name) for name in MOCK_TABLES[self.table_name]]}
+
+
+class MockSalesforce(object):
+    """Stands in for ``simple_salesforce.Salesforce``, serving ``total_size`` records in pages of ``page_size``."""
+
+    def __init__(self, username=None, password=None, security_token=None, domain=None, total_size=5, page_size=2,
+                 base_url='https://mock.my.salesforce.com/services/data/v52.0/', **kwargs):
+        self.sf_instance = 'mock.my.salesforce.com'
+        self.base_url = base_url
+        self.session_id = 'mock-session'
+        self.headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer mock-session'}
+        self.session = kwargs.get('session') or requests.Session()
+        self.total_size = total_size
+        self.page_size = page_size
+        self.query_calls = 0
+        self.query_more_calls = 0
+        self.describe_calls = 0
+
+    def __getattr__(self, name):
+        if name in MOCK_TABLES:
+            return MockSFType(self, name)
+        raise AttributeError(name)
+
+    def describe(self, headers=None):
+        _check_headers(headers)
+        self.describe_calls += 1
+        return {'sobjects': [{'name': name, 'searchable': True} for name in MOCK_TABLES]}
+
+    def _page(self, start):
+        end = min(start + self.page_size, self.total_size)
+        page = OrderedDict([
+            ('totalSize', self.total_size),
+            ('done', end >= self.total_size),
+            ('records', [make_record(i) for i in range(start, end)])
+        ])
+        if not page['done']:
+            page['nextRecordsUrl'] = '/services/data/v29.0/query/01g-{0}'.format(end)
+        return page
+
+    def query(self, query):
+        self.query_calls += 1
+        return self._page(0)
+
+    def query_more(self, next_records_identifier, identifier_is_url=False):
+        self.query_more_calls += 1
+        return self._page(int(next_records_identifier.rsplit('-', 1)[1]))
+
+    def close(self):
+        self.session.close()
+
+
+def _base62(number, width):
+    digits = []
+    for _ in range(width):
+        number, digit = divmod(number, 62)
+        digits.append('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'[digit])
+    return ''.join(reversed(digits))
+
+
+class SyntheticSalesforce(MockSalesforce):
+    """``MockSalesforce`` serving ``make_query_page`` records, for timing realistic payloads.
+
+    Every page is generated up front, so building the payloads does not count towards timings of the query loop.
+    """
+
+    def __init__(self, *args, field_count=10, relationship_count=2, nesting_depth=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pages = {}
+        for start in range(0, max(self.total_size, 1), self.page_size):
+            count = min(self.page_size, self.total_size - start)
+            page = make_query_page(count, field_count, relationship_count, nesting_depth, total_size=self.total_size,
+                                   start=start, done=start + count >= self.total_size)
+            if not page['done']:
+                page['nextRecordsUrl'] = '/services/data/v29.0/query/01g-{0}'.format(start + count)
+            self._pages[start] = page
+
+    def _page(self, start):
+        return self._pages[start]
+
+
+class PartitionedMockSalesforce(MockSalesforce):
+    """``MockSalesforce`` that answers the queries of ``SForceConnector.partition_query``.
+
+    It understands ``SELECT COUNT()``, ``ORDER BY Id ... LIMIT 1`` and ``Id >= '...'`` / ``Id < '...'`` conditions
+    over ``total_size`` records with realistic 18 character Ids. Every call takes ``latency`` seconds; ``queries``
+    records the SOQL received and ``max_concurrent`` the most calls that overlapped.
+    """
+
+    def __init__(self, *args, latency=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+        self.ids = ['001x0000{0}AAA'.format(_base62(i * 7, 7)) for i in range(self.total_size)]
+        self.queries = []
+        self.max_concurrent = 0
+        self._running = 0
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def _call(self, func, *args):
+        with self._lock:
+            self._running += 1
+            self.max_concurrent = max(self.max_concurrent, self._running)
+        try:
+            time.sleep(self.latency)
+            return func(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def query(self, query):
+        with self._lock:
+            self.query_calls += 1
+            self.queries.append(query)
+        return self._call(self._query, query)
+
+    def _query(self, query):
+        ids = self.ids
+        low = re.search(r"Id >= '(\w+)'", query)
+        high = re.search(r"Id < '(\w+)'", query)
+        if low:
+            ids = [record_id for record_id in ids if record_id[:15] >= low.group(1)[:15]]
+        if high:
+            ids = [record_id for record_id in ids if record_id[:15] < high.group(1)[:15]]
+        if 'COUNT()' in query:
+            return OrderedDict([('totalSize', len(ids)), ('done', True), ('records', [])])
+        bound = re.search(r'ORDER BY Id (ASC|DESC) NULLS LAST LIMIT 1', query)
+        if bound:
+            ids = ids[:1] if bound.group(1) == 'ASC' else ids[-1:]
+        with self._lock:
+            cursor = len(self._cursors)
+            self._cursors[cursor] = ids
+        return self._cursor_page(cursor, 0)
+
+    def query_more(self, next_records_identifier, identifier_is_url=False):
+        with self._lock:
+            self.query_more_calls += 1
+        cursor, start = next_records_identifier.rsplit('01g', 1)[1].split('-')
+        return self._call(self._cursor_page, int(cursor), int(start))
+
+    def _cursor_page(self, cursor, start):
+        ids = self._cursors[cursor]
+        end = min(start + self.page_size, len(ids))
+        records = []
+        for record_id in ids[start:end]:
+            record = make_record(0)
+            record['Id'] = record_id
+            record['Name'] = 'Record {0}'.format(record_id)
+            records.append(record)
+        page = OrderedDict([('totalSize', len(ids)), ('done', end >= len(ids)), ('records', records)])
+        if not page['done']:
+            page['nextRecordsUrl'] = '/services/data/v29.0/query/01g{0}-{1}'.format(cursor, end)
+        return page
+
+
+class BulkApiStub(object):
+    """Local HTTP server answering the Bulk API 2.0 query endpoints with ``total_size`` CSV records.
+
+    Jobs report ``InProgress`` for ``polls_until_complete`` status checks before completing. Use ``base_url`` as the
+    ``MockSalesforce`` base URL and stop the server with ``close``.
+    """
+
+    def __init__(self, total_size=5, polls_until_complete=1):
+        self.total_size = total_size
+        self.polls_until_complete = polls_until_complete
+        self.jobs = {}
+        self.requests = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                stub._handle(self, 'POST')
+
+            def do_GET(self):
+                stub._handle(self, 'GET')
+
+            def do_PATCH(self):
+                stub._handle(self, 'PATCH')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:{0}/services/data/v52.0/'.format(self.server.server_port)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        # Drop the /services/data/vXX.X prefix, leaving e.g. ['jobs', 'query', <job id>, 'results'].
+        parts = url.path.strip('/').split('/')[3:]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = json.loads(handler.rfile.read(length)) if length else None
+        self.requests.append((method, url.path, params))
+
+        if method == 'POST' and parts == ['jobs', 'query']:
+            job_id = '750{0:015d}'.format(len(self.jobs))
+            self.jobs[job_id] = {'id': job_id, 'state': 'UploadComplete', 'query': body['query'], 'polls': 0}
+            return self._send_json(handler, 200, self._job_info(job_id))
+
+        job_id = parts[2] if len(parts) > 2 else None
+        if job_id not in self.jobs:
+            return self._send_json(handler, 404, [{'errorCode': 'NOT_FOUND', 'message': 'Unknown job'}])
+        job = self.jobs[job_id]
+
+        if method == 'PATCH':
+            job['state'] = body['state']
+            return self._send_json(handler, 200, self._job_info(job_id))
+        if len(parts) == 3:
+            job['polls'] += 1
+            if job['state'] != 'Aborted':
+                job['state'] = 'JobComplete' if job['polls'] > self.polls_until_complete else 'InProgress'
+            return self._send_json(handler, 200, self._job_info(job_id))
+
+        start = int(params.get('locator', 0))
+        end = min(start + int(params.get('maxRecords', self.total_size)), self.total_size)
+        lines = ['"Id","Name"'] + ['"{0:018d}","Record {0}"'.format(i) for i in range(start, end)]
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/csv')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.send_header('Sforce-NumberOfRecords', str(end - start))
+        handler.send_header('Sforce-Locator', str(end) if end < self.total_size else 'null')
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _job_info(self, job_id):
+        job = self.jobs[job_id]
+        info = {'id': job_id, 'operation': 'query', 'state': job['state']}
+        if job['state'] == 'JobComplete':
+            info['numberRecordsProcessed'] = self.total_size
+        return info
+
+    @staticmethod
+    def _send_json(handler, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+class QueryApiStub(object):
+    """Local HTTP/1.1 server answering the REST query endpoints with ``total_size`` records in pages of ``page_size``.
+
+    It behaves like Salesforce on the wire: bodies are pretty-printed when asked for with ``X-PrettyPrint`` and gzipped
+    when the client accepts it, and connections are kept alive. The first ``failures`` requests get a 503, and requests
+    without the current ``session_id`` get a 401 ``INVALID_SESSION_ID``. It counts ``requests``, TCP ``connections``,
+    body ``bytes_sent`` and ``logins``. Connect to it with ``stub_salesforce``.
+    """
+
+    def __init__(self, total_size=5, page_size=2, field_count=10, failures=0, relationship_count=2, nesting_depth=1):
+        self.total_size = total_size
+        self.page_size = page_size
+        self.field_count = field_count
+        self.relationship_count = relationship_count
+        self.nesting_depth = nesting_depth
+        self.failures = failures
+        self.session_id = 'stub-session'
+        self.requests = []
+        self.connections = 0
+        self.bytes_sent = 0
+        self.logins = 0
+        self._lock = threading.Lock()
+        # Page bodies are built once, so timings over the stub mostly measure the client.
+        self._bodies = {}
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connections += 1
+
+            def do_GET(self):
+                stub._handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.instance_url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, handler):
+        url = urlparse(handler.path)
+        with self._lock:
+            self.requests.append(dict(handler.headers))
+            failed = len(self.requests) <= self.failures
+        if failed:
+            return self._send(handler, 503, b'[{"errorCode": "SERVER_UNAVAILABLE"}]')
+        if handler.headers.get('Authorization') != 'Bearer {0}'.format(self.session_id):
+            return self._send(handler, 401, b'[{"errorCode": "INVALID_SESSION_ID", '
+                                            b'"message": "Session expired or invalid"}]')
+
+        # .../query/?q=... starts the query and .../query/01g-<offset> continues it.
+        locator = url.path.rstrip('/').rsplit('/', 1)[1]
+        start = int(locator.rsplit('-', 1)[1]) if locator.startswith('01g-') else 0
+        pretty = handler.headers.get('X-PrettyPrint') == '1'
+        query_url = url.path.rsplit('/query', 1)[0] + '/query'
+        body = self._bodies.get((start, pretty, query_url))
+        if body is None:
+            count = min(self.page_size, self.total_size - start)
+            page = make_query_page(count, self.field_count, self.relationship_count, self.nesting_depth,
+                                   total_size=self.total_size, start=start, done=start + count >= self.total_size)
+            if not page['done']:
+                page['nextRecordsUrl'] = '{0}/01g-{1}'.format(query_url, start + count)
+            body = json.dumps(page, indent=4 if pretty else None, separators=None if pretty else (',', ':'))
+            body = self._bodies[(start, pretty, query_url)] = body.encode('utf-8')
+        self._send(handler, 200, body)
+
+    def _send(self, handler, status, body):
+        gzipped = 'gzip' in handler.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self._lock:
+            self.bytes_sent += len(body)
+
+
+class _HttpSalesforce(Salesforce):
+    """The real simple_salesforce client, sending its https URLs to a plain http stub."""
+
+    def _call_salesforce(self, method, url, *args, **kwargs):
+        return super()._call_salesforce(method, url.replace('https://', 'http://', 1), *args, **kwargs)
+
+
+def stub_salesforce(stub: QueryApiStub):
+    """``_sf_lib`` for ``SForceConnector`` that connects simple_salesforce to ``stub``.
+
+    A login gets the stub's current ``session_id``; a given ``session_id`` is used as it is.
+    """
+    def connect(username=None, password=None, security_token=None, domain=None, session=None, session_id=None,
+                instance_url=None, **kwargs):
+        if session_id is None:
+            stub.logins += 1
+            session_id = stub.session_id
+        return _HttpSalesforce(instance_url=instance_url or stub.instance_url, session_id=session_id, session=session)
+    return connect
@@ -1,8 +1,19 @@
+import json
+import os
+import threading
+import time
 from collections import OrderedDict
+from functools import partial
 
+import pytest
 from hypothesis import given, strategies as strats
 
-from models import salesforce_connector
+from models import column_sort, exporter, partitioning, query_cache, result_search, result_store, salesforce_connector
+from models.transport import TransportOptions
+from tests.mock_salesforce import BulkApiStub, MockSalesforce, PartitionedMockSalesforce, QueryApiStub, \
+    stub_salesforce
+from utils import search_index, utils
+from utils.instrumentation import Instrumentation
 
 STATIC_RESULT = OrderedDict([
     ('totalSize', 2),
@@ -67,6 +78,14 @@ HYPOTHESIS_RESULT = OrderedDict([
 ])
 
 
+@pytest.fixture(scope='module')
+def qapp():
+    # The widgets need an application, and there is no display to show them on.
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
 def test_clean_results():
     raw_results = STATIC_RESULT
     expected = salesforce_connector.Results(
@@ -98,3 +117,814 @@ def test_flatten_record():
 @given(strats.fixed_dictionaries(HYPOTHESIS_RESULT))
 def test_clean_results_hypothesis(mapping):
     salesforce_connector._clean_results(mapping)
+
+
+def test_bench_suite_records_json(tmp_path):
+    from benchmarks import bench_suite
+    output = tmp_path / 'bench.json'
+    # Every benchmark runs, if only on a tiny payload, so one whose hot path was renamed or removed fails here.
+    args = ['--rows', '50', '--page-size', '20', '--columns', '3', '--relationships', '1', '--depth', '1',
+            '--repeat', '1']
+
+    assert bench_suite.main(args + ['--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert list(report['results']) == list(bench_suite.BENCHMARKS)
+    assert report['params']['rows'] == 50
+
+    # Comparing a run with itself is no regression, however noisy single runs over 50 rows are.
+    assert bench_suite.compare(report['results'], report, 0.2) == []
+
+
+def test_bench_suite_compare_flags_slowdowns(capsys):
+    from benchmarks import bench_suite
+    baseline = {'results': {'clean_results': {'min_ms': 10.0}, 'search': {'min_ms': 10.0}, 'sort_cold': {'min_ms': 0}}}
+    results = OrderedDict([('clean_results', {'min_ms': 11.0}), ('search', {'min_ms': 13.0}),
+                           ('sort_cold', {'min_ms': 5.0}), ('highlighter', {'min_ms': 1.0})])
+
+    assert bench_suite.compare(results, baseline, 0.2) == ['search']
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines] == ['clean_results', 'search']
+    assert lines[1].endswith('REGRESSION') and not lines[0].endswith('REGRESSION')
+
+
+def test_query_more_returns_only_new_page():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce)
+
+    first = connector.query('SELECT Id, Name FROM Account')
+    second = connector.query_more()
+
+    assert [row[0] for row in first.records] == ['{0:018d}'.format(i) for i in range(2)]
+    assert [row[0] for row in second.records] == ['{0:018d}'.format(i) for i in range(2, 4)]
+    assert second.size == 4
+    assert not second.done
+
+
+def test_iter_query_streams_all_pages():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce)
+    pages = []
+
+    records = list(connector.iter_query('SELECT Id, Name FROM Account', page_callback=pages.append))
+
+    assert [row[0] for row in records] == ['{0:018d}'.format(i) for i in range(5)]
+    assert [page.size for page in pages] == [2, 2, 1]
+    assert connector.next_record_url is None
+
+
+def test_iter_query_stops_at_max_records():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce)
+
+    records = list(connector.iter_query('SELECT Id, Name FROM Account', max_records=3))
+
+    assert len(records) == 3
+    assert connector.session.query_more_calls == 1
+
+
+def test_query_more_served_from_prefetch():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=2)
+
+    connector.query('SELECT Id, Name FROM Account')
+    deadline = time.time() + 5
+    while len(connector._prefetch_pages) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert connector.session.query_more_calls == 2
+
+    second = connector.query_more()
+    third = connector.query_more()
+
+    assert [row[0] for row in second.records + third.records] == ['{0:018d}'.format(i) for i in range(2, 5)]
+    assert third.done
+    assert connector.session.query_more_calls == 2
+
+
+def test_new_query_discards_prefetched_pages():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=2)
+
+    connector.query('SELECT Id, Name FROM Account')
+    connector._prefetch_pages['stale'] = {}
+    connector.query('SELECT Id, Name FROM Account')
+
+    assert 'stale' not in connector._prefetch_pages
+
+
+def test_metadata_cache_persists_across_connectors(tmp_path):
+    first = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                 metadata_cache_dir=str(tmp_path))
+    assert first.get_tables() == ['Account', 'Contact']
+    assert sorted(first.get_table_fields('Contact')) == ['AccountId', 'FirstName', 'Id', 'LastName']
+
+    second = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                  metadata_cache_dir=str(tmp_path))
+    assert second.get_tables() == ['Account', 'Contact']
+    assert sorted(second.get_table_fields('Contact')) == ['AccountId', 'FirstName', 'Id', 'LastName']
+    assert second.session.describe_calls == 0
+
+    second.get_tables(reload=True)
+    assert second.session.describe_calls == 1
+
+    second.invalidate_metadata()
+    second.get_table_fields('Contact')
+    assert second.session.describe_calls == 2
+
+
+def test_cached_tables_skip_the_network(tmp_path):
+    first = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                 metadata_cache_dir=str(tmp_path))
+    assert first.cached_tables() == []
+    first.get_tables()
+
+    # Even a stale cache entry is shown at startup while the describe is refreshed in the background.
+    second = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                  metadata_cache_dir=str(tmp_path), metadata_ttl=0)
+    assert second.cached_tables() == ['Account', 'Contact']
+    assert second.session.describe_calls == 0
+
+
+def test_warm_up_fields_describes_recent_tables(tmp_path):
+    first = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                 metadata_cache_dir=str(tmp_path))
+    assert first.warm_up_fields() == 0
+    first.get_table_fields('Contact')
+
+    second = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                  metadata_cache_dir=str(tmp_path))
+    assert second.warm_up_fields() == 1
+    assert list(second.loaded_fields) == ['Contact']
+    assert second.session.describe_calls == 0
+
+    # A reload still warms up the tables used before it, and one failing describe does not stop the others.
+    second.invalidate_metadata()
+    assert second.recent_tables() == ['Contact']
+    assert second.warm_up_fields() == 1
+    assert second.warm_up_fields(['Unknown__c', 'Account']) == 1
+    assert sorted(second.loaded_fields) == ['Account', 'Contact']
+    assert second.session.describe_calls == 3
+
+
+def test_query_parallel_merges_id_partitions(tmp_path):
+    connector = salesforce_connector.SForceConnector(
+        'user', 'pass', False, _sf_lib=partial(PartitionedMockSalesforce, total_size=1000, page_size=50, latency=0.005),
+        prefetch_depth=0, metadata_cache=False, query_cache=False)
+    session = connector.session
+
+    with pytest.raises(Exception, match='ORDER BY'):
+        connector.query_parallel('SELECT Id FROM Account ORDER BY Name')
+    results = connector.query_parallel("SELECT Id, Name FROM Account WHERE Name != 'x'", max_workers=4)
+
+    assert (results.totalSize, results.size, results.done) == (1000, 1000, True)
+    assert sorted(connector.results_store.column(0)) == session.ids
+    assert connector.results_store.headers == ['Id', 'Name']
+    assert session.max_concurrent == 4
+    partitions = [query for query in session.queries if "Id >= '" in query or "Id < '" in query]
+    assert len(partitions) == 8 and all(query.endswith("AND (Name != 'x')") for query in partitions)
+
+    path = tmp_path / 'parallel.csv'
+    assert exporter.export_query(connector, 'SELECT Id, Name FROM Account', str(path), max_workers=3) == 1000
+    assert sorted(path.read_text().splitlines()[1:]) == ['{0},Record {0}'.format(i) for i in session.ids]
+
+
+def test_partition_query_keeps_queries_with_nothing_to_split():
+    connector = salesforce_connector.SForceConnector(
+        'user', 'pass', False, _sf_lib=partial(PartitionedMockSalesforce, total_size=1, page_size=50),
+        prefetch_depth=0, metadata_cache=False, query_cache=False)
+    query = "SELECT Id, Name FROM Account WHERE Name != 'x'"
+
+    # The lowest and highest Id are the same record.
+    assert connector.partition_query(query) == [query]
+    assert connector.query_parallel(query).size == 1
+    assert partitioning.boundaries('2020-01-01', '2020-01-01', 8) == []
+    assert partitioning.boundaries('001x00000000001AAA', '001x00000000009AAA', 1) == []
+    assert partitioning.is_partitionable(query)
+    assert not partitioning.is_partitionable('SELECT Id FROM Account LIMIT 10')
+
+    ranges = partitioning.boundaries('2020-01-01', '2020-01-09', 2)
+    conditions = [partitioning.range_condition('CloseDate', low, high) for low, high in ranges]
+    assert conditions == ['CloseDate < 2020-01-05', 'CloseDate >= 2020-01-05']
+    assert partitioning.null_condition('CloseDate') == 'CloseDate = null'
+    with pytest.raises(Exception):
+        partitioning.range_condition('CloseDate')
+
+
+def test_bulk_query_streams_csv_pages(tmp_path):
+    stub = BulkApiStub(total_size=5)
+    try:
+        connector = salesforce_connector.SForceConnector('user', 'pass', False, prefetch_depth=0,
+                                                         _sf_lib=partial(MockSalesforce, base_url=stub.base_url))
+        out_path = tmp_path / 'export.csv'
+
+        record_count = connector.bulk_query('SELECT Id, Name FROM Account', str(out_path), poll_interval=0.01,
+                                            page_size=2)
+    finally:
+        stub.close()
+
+    lines = out_path.read_text().splitlines()
+    assert record_count == 5
+    assert lines[0] == '"Id","Name"'
+    assert lines[1:] == ['"{0:018d}","Record {0}"'.format(i) for i in range(5)]
+    assert [req for req in stub.requests if req[1].endswith('/results')][-1][2] == {'maxRecords': '2', 'locator': '4'}
+
+
+def _query_over_stub(stub, transport):
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=stub_salesforce(stub),
+                                                     prefetch_depth=0, metadata_cache=False, query_cache=False,
+                                                     transport=transport)
+    try:
+        pages = [connector.query('SELECT Id FROM Sample_Transaction_vod__c')]
+        while not pages[-1].done:
+            pages.append(connector.query_more())
+    finally:
+        connector.close()
+    return pages
+
+
+def test_transport_pools_and_compresses_query_pages():
+    plain_stub = QueryApiStub(total_size=600, page_size=200)
+    stub = QueryApiStub(total_size=600, page_size=200, failures=1)
+    try:
+        plain = _query_over_stub(plain_stub, TransportOptions(keep_alive=False, compress=False, compact_json=False))
+        pooled = _query_over_stub(stub, TransportOptions(backoff=0))
+    finally:
+        plain_stub.close()
+        stub.close()
+
+    assert [page.size for page in plain] == [page.size for page in pooled] == [200, 400, 600]
+    assert pooled[-1].records[-1][0] == '{0:018d}'.format(599)
+    # Three pages plus one retried 503 over a single kept-alive connection, against one connection per page.
+    assert (len(stub.requests), stub.connections) == (4, 1)
+    assert (len(plain_stub.requests), plain_stub.connections) == (3, 3)
+    assert 'X-PrettyPrint' not in stub.requests[-1] and 'gzip' in stub.requests[-1]['Accept-Encoding']
+    assert stub.bytes_sent * 5 < plain_stub.bytes_sent
+
+
+def test_instrumentation_records_query_phases(tmp_path):
+    log_path = tmp_path / 'timings.jsonl'
+    instrumentation = Instrumentation(history_size=3, log_path=str(log_path))
+    assert instrumentation.operation('query') is instrumentation.phase('fetch')  # the shared no-op while disabled
+
+    stub = QueryApiStub(total_size=400, page_size=200)
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=stub_salesforce(stub),
+                                                     prefetch_depth=0, metadata_cache=False, query_cache=False,
+                                                     instrumentation=instrumentation)
+    try:
+        connector.query('SELECT Id FROM Sample_Transaction_vod__c')
+        assert not instrumentation.history
+        instrumentation.enabled = True
+        connector.query('SELECT Id FROM Sample_Transaction_vod__c')
+        connector.query_more()
+    finally:
+        connector.close()
+        stub.close()
+
+    query, query_more = instrumentation.operations()
+    assert (query.name, query_more.name) == ('query', 'query_more')
+    assert list(query.phases) == ['network', 'decode', 'clean', 'store']
+    assert query.counters['rows'] == query_more.counters['rows'] == 200
+    assert 0 < query.counters['bytes'] <= stub.bytes_sent
+    assert sum(query.phases.values()) <= query.duration
+    assert instrumentation.last('query', 'query_more') is query_more
+    assert '200 rows' in query.summary()
+    assert [json.loads(line)['name'] for line in log_path.read_text().splitlines()] == ['query', 'query_more']
+
+
+def test_reused_session_logs_in_again_when_expired():
+    stub = QueryApiStub(total_size=400, page_size=200)
+    stub.session_id = 'fresh-session'
+    try:
+        connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=stub_salesforce(stub),
+                                                         prefetch_depth=0, metadata_cache=False, query_cache=False,
+                                                         session_id='expired-session', instance_url=stub.instance_url)
+        assert stub.logins == 0
+        assert connector.query('SELECT Id FROM Sample_Transaction_vod__c').size == 200
+        assert connector.query_more().size == 400
+        assert (stub.logins, connector.session_id) == (1, 'fresh-session')
+        connector.close()
+
+        reused = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=stub_salesforce(stub),
+                                                      prefetch_depth=0, metadata_cache=False, query_cache=False,
+                                                      session_id=connector.session_id,
+                                                      instance_url=connector.instance_url)
+        reused.query('SELECT Id FROM Sample_Transaction_vod__c')
+        reused.close()
+    finally:
+        stub.close()
+    assert stub.logins == 1
+    # The rejected first query and its retry after logging in, the next page, then the reused connector's query.
+    assert len(stub.requests) == 4
+
+
+def test_session_saved_per_login(tmp_path, monkeypatch):
+    path = str(tmp_path / 'config.json')
+    monkeypatch.setattr(utils, 'keyring', None)
+    logins = {'PROD - user': {'username': 'user', 'password': 'pass', 'sandbox': False, 'security_token': ''}}
+    assert utils.load_session(logins, 'PROD - user') == (None, None)
+
+    # Without a keyring the session is not kept at all.
+    utils.save_session(logins, 'PROD - user', 'session-1', 'https://org.my.salesforce.com', path)
+    assert 'session' not in logins['PROD - user']
+
+    class FakeKeyring(object):
+        priority = 1
+        passwords = {}
+
+        def get_keyring(self):
+            return self
+
+        def set_password(self, service, name, password):
+            self.passwords[(service, name)] = password
+
+        def get_password(self, service, name):
+            return self.passwords.get((service, name))
+
+        def delete_password(self, service, name):
+            del self.passwords[(service, name)]
+
+    fake_keyring = FakeKeyring()
+    monkeypatch.setattr(utils, 'keyring', fake_keyring)
+    utils.save_session(logins, 'PROD - user', 'session-2', 'https://org.my.salesforce.com', path)
+    assert 'session-2' not in open(path).read()
+    assert utils.load_session(utils.load_config(path), 'PROD - user') == (
+        'session-2', 'https://org.my.salesforce.com')
+    assert utils.load_session(utils.load_config(path), '') == (None, None)
+
+    utils.delete_session(logins, 'PROD - user')
+    assert fake_keyring.passwords == {} and 'session' not in logins['PROD - user']
+
+    # A keyring without a usable backend.
+    fake_keyring.priority = 0
+    utils.save_session(logins, 'PROD - user', 'session-3', 'https://org.my.salesforce.com', path)
+    assert fake_keyring.passwords == {}
+
+    fake_keyring.priority = 1
+    fake_keyring.set_password = None
+    with pytest.raises(Exception, match='keyring'):
+        utils.save_session(logins, 'PROD - user', 'session-4', 'https://org.my.salesforce.com', path)
+
+
+def test_result_store_columns_and_dedup():
+    # Build each status string separately so only deduplication can make them share one object.
+    rows = [['{0:018d}'.format(i), ''.join(list(['Open', 'Closed'][i % 2])), None] for i in range(2000)]
+    store = result_store.ResultStore.from_rows(['Id', 'Status', 'Amount'], rows)
+    store.append_rows([['x', 'Open', 1.5]])
+
+    assert len(store) == 2001
+    assert store.row(2000) == ['x', 'Open', 1.5]
+    assert store.column(1)[:2] == ['Open', 'Closed']
+    assert store.column(1)[0] is store.column(1)[2] is store.column(1)[2000]
+    assert store.column(0)[0] is rows[0][0]
+    assert list(store.iter_rows([1, 2000])) == [rows[1], ['x', 'Open', 1.5]]
+    assert store.record(0) == OrderedDict([('Id', '{0:018d}'.format(0)), ('Status', 'Open'), ('Amount', None)])
+
+
+def test_result_store_selection_text_and_export(tmp_path):
+    store = result_store.ResultStore.from_rows(['Id', 'Name', 'Owner'], [
+        ['1', 'A\tB', None], ['2', 'C', {'Name': 'Jo'}], ['3', 'D', 'x']])
+
+    chunks = list(store.iter_text([2, 0], [0, 1], include_headers=True, chunk_rows=1))
+    assert chunks == ['Id\tName', '\n3\tD', '\n1\tA B']
+    assert ''.join(store.iter_text([0, 1], [1, 2], selected={0: {1}, 1: {1, 2}})) == 'A B\t\nC\t[Name: Jo]'
+
+    path = tmp_path / 'selection.csv'
+    assert exporter.export_store(store, str(path), rows=[2, 1], cols=[1], batch_size=1) == 2
+    assert path.read_text().splitlines() == ['Name', 'D', 'C']
+
+
+def test_sort_index_orders_by_type_and_reuses_sorted_runs():
+    store = result_store.ResultStore.from_rows(['Amount', 'Flag'], [['10', True], [None, False], ['9', None]])
+    index = column_sort.SortIndex(store)
+
+    assert index.order(0) == [0, 2, 1]
+    assert index.order(0, 'currency') == [2, 0, 1]
+    assert index.order(0, 'string') == [0, 2, 1]
+    assert index.order(0, 'double', descending=True) == [0, 2, 1]
+    assert index.order(1) == [1, 0, 2]
+
+    store.append_rows([['9.5', True], ['-1', False]])
+    assert not index.is_sorted(0, 'double', 5)
+    assert index.order(0, 'double') == [4, 2, 3, 0, 1]
+    assert index.is_sorted(0, 'double', 5)
+    assert index.order(0, 'double', row_count=3) == [2, 0, 1]
+
+    dates = result_store.ResultStore.from_rows(['CloseDate'], [['2020-03-01'], [''], ['2019-12-31'], [None]])
+    date_index = column_sort.SortIndex(dates)
+    assert date_index.order(0, 'date') == [2, 0, 1, 3]
+    assert date_index.rows_between(0, 'date', low='2020-01-01') == [0]
+
+
+def test_result_index_filters_incrementally():
+    headers = ['Name', 'Status', 'Amount']
+    store = result_store.ResultStore.from_rows(headers, [['John Smith', 'Open', 10], ['Jane Doe', 'Closed', 200]])
+    index = result_search.ResultIndex(store)
+
+    assert result_search.parse_filter('smith amount>=5 at 10:30 Name:"jo sm"', headers) == [
+        (None, ':', 'smith'), (2, '>=', '5'), (None, ':', 'at'), (None, ':', '10:30'), (0, ':', 'jo sm')]
+    with pytest.raises(Exception, match='Unknown column'):
+        result_search.parse_filter('Owner=me', headers)
+
+    # Columns are only indexed once a search looks at them.
+    assert index.search('status=open') == [0]
+    assert [index.indexed_rows(col) for col in range(3)] == [0, 2, 0]
+    assert index.search('Amount>5') == [0, 1]
+    assert index.indexed_rows(2) == 0
+    assert index.search('SMI') == [0]
+    assert [index.indexed_rows(col) for col in range(3)] == [2, 2, 2]
+    store.append_rows([['Bob Smithers', 'Open', None], ['x@y.com', 'Open Now', 5]])
+    assert index.search('smith', row_count=2) == [0]
+    assert index.search('smith') == [0, 2]
+    # Searching only the rows of a new page.
+    assert index.search('smith', start=2) == [2]
+    assert index.search('Status!=Open', start=2) == [3]
+    assert index.search('Amount>=5', start=1) == [1, 3]
+    assert index.search('', start=3) == [3]
+    assert index.search('Name:"jo sm"') == [0]
+    assert index.search('status=OPEN') == [0, 2]
+    assert index.search('Status!=Open') == [1, 3]
+    assert index.search('Amount<100') == [0, 3]
+    assert index.search('status:open amount>5') == [0]
+    assert index.search('@y.') == [3]
+    assert index.search('') == [0, 1, 2, 3]
+
+
+def test_get_column_types_follows_relationships(tmp_path):
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                     metadata_cache_dir=str(tmp_path))
+
+    assert connector.get_column_types('Contact', ['Id', 'account.annualrevenue', 'Account.IsDeleted', 'expr0']) == {
+        'Id': 'id', 'account.annualrevenue': 'currency', 'Account.IsDeleted': 'boolean'}
+    # Only unknown relationships are left out; failing to describe the table itself is an error.
+    with pytest.raises(Exception):
+        connector.get_column_types('Unknown__c', ['Id'])
+
+
+def test_query_fills_result_store():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce)
+
+    connector.query('SELECT Id, Name FROM Account')
+    connector.query_more()
+
+    assert connector.results_store.headers == ['Id', 'Name']
+    assert connector.results_store.column(0) == ['{0:018d}'.format(i) for i in range(4)]
+
+
+def test_cancelled_query_stops_paging():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, query_cache=False)
+    connector.query('SELECT Id, Name FROM Account')
+
+    # The page that was on its way is dropped and nothing more is fetched for it.
+    assert connector.query('SELECT Id FROM Contact', cancelled=lambda: True) is None
+    assert (connector.results_store.headers, len(connector.results_store)) == (['Id', 'Name'], 2)
+    assert connector.next_record_url is None and not connector._prefetch_pages
+
+    connector.query('SELECT Id, Name FROM Account')
+    assert connector.query_more(cancelled=lambda: True) is None
+    assert len(connector.results_store) == 2 and connector.next_record_url is None
+    connector.close()
+
+
+def test_compiled_flattener_matches_generic_flatten():
+    def relationship(**fields):
+        return OrderedDict([('attributes', OrderedDict([('type', 'Account')]))] + list(fields.items()))
+
+    records = [
+        OrderedDict([('Id', '1'), ('Account_vod__r', relationship(Name='A', Owner=relationship(Alias='x'))),
+                     ('Parent__r', None)]),
+        OrderedDict([('Id', '2'), ('Account_vod__r', None), ('Parent__r', relationship(Name='P'))]),
+        OrderedDict([('Id', '3'), ('Account_vod__r', relationship(Name='B', Owner=None)), ('Parent__r', None)]),
+        OrderedDict([('Id', '4'), ('Account_vod__r', relationship(Name='C', Extra=1, Owner=relationship(Alias='y'))),
+                     ('Parent__r', None)]),
+    ]
+
+    flattener = salesforce_connector._RecordFlattener(records[0])
+
+    assert flattener.flatten(records) == [[salesforce_connector._flatten_record_value(val) for val in record.values()]
+                                          for record in records]
+    assert flattener.flatten(records)[0] == ['1', '[Name: A] [Owner: [Alias: x]]', None]
+
+
+def test_relationship_expander_builds_dotted_columns():
+    def relationship(**fields):
+        return OrderedDict([('attributes', OrderedDict([('type', 'Account')]))] + list(fields.items()))
+
+    records = [
+        OrderedDict([('Id', '1'), ('Account_vod__r', None), ('Parent__r', None)]),
+        OrderedDict([('Id', '2'), ('Account_vod__r', relationship(Name='A', Owner=None)), ('Parent__r', None)]),
+        OrderedDict([('Id', '3'), ('Account_vod__r', relationship(Name='B', Owner=relationship(Alias='x'))),
+                     ('Parent__r', None)]),
+    ]
+
+    expander = salesforce_connector._RelationshipExpander(records)
+
+    assert expander.headers == ['Id', 'Account_vod__r.Name', 'Account_vod__r.Owner.Alias', 'Parent__r']
+    assert expander.flatten(records) == [['1', None, None, None], ['2', 'A', None, None], ['3', 'B', 'x', None]]
+
+    later = [OrderedDict([('Id', '4'), ('Account_vod__r', None), ('Parent__r', relationship(Name='P'))])]
+    row = expander.flatten(later)[0]
+    assert result_store.format_value(row[3]) == '[Name: P]'
+
+
+def test_normalize_query():
+    assert query_cache.normalize_query("  SELECT Id,  Name\nfrom Account WHERE Name = 'A  b' ") == \
+        "select Id,Name from Account where Name='A  b'"
+
+
+def test_query_cache_hits_and_evicts():
+    cache = query_cache.QueryCache(max_bytes=100, ttl=60)
+    cache.put('a', 'A', 60)
+    cache.put('b', 'B', 30)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 30)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.ttl = -1
+    assert cache.get('a') is None
+
+
+def test_query_uses_cache_unless_forced():
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=0)
+
+    first = connector.query('SELECT Id, Name FROM Account')
+    connector.query_more()
+    cached = connector.query('select Id, Name  FROM Account')
+
+    assert connector.session.query_calls == 1
+    assert cached.records == first.records
+    assert len(connector.results_store) == 2
+    assert [row[0] for row in connector.query_more().records] == ['{0:018d}'.format(i) for i in range(2, 4)]
+
+    connector.query('SELECT Id, Name FROM Account', force_refresh=True)
+    assert connector.session.query_calls == 2
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_export_query_streams_every_page(tmp_path, file_format):
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=0)
+    path = str(tmp_path / 'export.{0}'.format(file_format))
+    messages = []
+
+    assert exporter.export_query(connector, 'SELECT Id, Name FROM Account', path, progress=messages.append) == 5
+
+    with open(path) as file:
+        lines = file.read().splitlines()
+    if file_format == 'csv':
+        assert lines == ['Id,Name'] + ['{0:018d},Record {0}'.format(i) for i in range(5)]
+    else:
+        assert [json.loads(line) for line in lines] == [{'Id': '{0:018d}'.format(i), 'Name': 'Record {0}'.format(i)}
+                                                        for i in range(5)]
+    assert messages == ['Exported 2 / 5 Records', 'Exported 4 / 5 Records', 'Exported 5 / 5 Records']
+    assert connector.next_record_url is None
+
+
+def test_export_cancel_removes_partial_file(tmp_path):
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=0)
+    path = tmp_path / 'export.csv'
+    messages = []
+
+    with pytest.raises(Exception, match='cancelled'):
+        exporter.export_query(connector, 'SELECT Id FROM Account', str(path), progress=messages.append,
+                              cancelled=lambda: len(messages) > 0)
+    assert not path.exists()
+
+
+def test_export_query_to_parquet(tmp_path):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce, prefetch_depth=0)
+    path = str(tmp_path / 'export.parquet')
+
+    exporter.export_query(connector, 'SELECT Id, Name FROM Account', path)
+
+    table = parquet.read_table(path)
+    assert table.num_rows == 5
+    assert parquet.ParquetFile(path).num_row_groups == 3
+    assert table.column('Name').to_pylist() == ['Record {0}'.format(i) for i in range(5)]
+
+
+def test_name_index_filters_by_substring_initials_and_fuzzy():
+    index = search_index.NameIndex(['Account', 'AccountHistory', 'Sample_Transaction_vod__c', 'Contact'])
+
+    assert search_index.name_initials('Sample_Transaction_vod__c') == 'stvc'
+    assert index.filter('hist') == ['AccountHistory']
+    assert index.filter('ah') == ['AccountHistory']
+    assert index.filter('stv') == ['Sample_Transaction_vod__c']
+    assert index.filter('cntc') == ['Contact']
+    assert index.filter('') == index.names
+
+
+def test_soql_completion_index_suggests_tables_fields_and_paths():
+    index = search_index.SOQLCompletionIndex()
+    index.set_tables(['Account', 'AccountHistory', 'Contact', 'User'])
+    index.set_fields('Contact', {'Id': {}, 'LastName': {},
+                                 'AccountId': {'relationshipName': 'Account', 'referenceTo': ['Account']}})
+
+    assert index.complete('SELECT Id FROM acc', 'SELECT Id FROM acc') == ('acc', ['Account', 'AccountHistory'], None)
+    query = 'SELECT La FROM Contact'
+    assert index.complete('SELECT La', query) == ('La', ['LastName'], None)
+    assert index.complete('SELECT Id, Acc', query) == ('Acc', ['Account', 'AccountId'], None)
+    assert index.complete('SELECT Account.Na', query) == ('Na', [], 'Account')
+
+    index.set_fields('Account', {'Id': {}, 'Name': {}})
+    assert index.complete('SELECT Account.Na', query) == ('Na', ['Name'], None)
+    assert index.complete('SELECT Na', 'SELECT Na') == ('Na', ['Name'], None)
+
+
+def test_prefix_index_lookup_only_visits_matches():
+    index = search_index.PrefixIndex('Field{0}__c'.format(i) for i in range(50000))
+    visited = []
+
+    class Keys(list):
+        def __getitem__(self, i):
+            visited.append(i)
+            return list.__getitem__(self, i)
+
+    index._keys = Keys(index._keys)
+    matches = index.lookup('field4999')
+
+    assert 'Field4999__c' in matches
+    assert len(matches) == 11
+    # The binary search and the matches themselves, plus the first key past them, rather than a scan of 50000 keys.
+    assert len(visited) <= 2 * (50000).bit_length() + len(matches) + 1
+
+
+def test_query_table_skips_subqueries():
+    assert search_index.query_table('SELECT Id, (SELECT Id FROM Contacts) FROM Account') == 'Account'
+    assert search_index.query_table("SELECT Id FROM Lead WHERE Name = 'from x'") == 'Lead'
+    assert search_index.query_table("SELECT 'from x', Id FROM Lead WHERE Name IN ('a)', 'b')") == 'Lead'
+    assert search_index.query_table('SELECT Id FROM') is None
+
+
+def _block_formats(document):
+    """Per line of ``document``: its block state and the (start, length, kind) of each highlighted range."""
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import QColor
+    kinds = {QColor(Qt.blue).name(): 'keyword', QColor(Qt.red).name(): 'symbol',
+             QColor(Qt.darkCyan).name(): 'quote'}
+    lines = []
+    block = document.firstBlock()
+    while block.isValid():
+        ranges = []
+        for fmt in block.layout().formats():
+            kind = 'search' if fmt.format.background().color() == QColor(Qt.green) else \
+                kinds[fmt.format.foreground().color().name()]
+            ranges.append((fmt.start, fmt.length, kind))
+        lines.append((block.userState(), ranges))
+        block = block.next()
+    return lines
+
+
+def test_highlighter_tracks_multi_line_literals(qapp):
+    from PyQt5.QtGui import QTextDocument
+    from utils.custom_widgets import SOQLHighlighter
+    document = QTextDocument()
+    highlighter = SOQLHighlighter(document)
+
+    document.setPlainText("SELECT Id FROM A WHERE Name = 'it\\'\nfrom\\'\nb' AND x = 'c\\\\'")
+    highlighter.rehighlight()
+    first, second, third = _block_formats(document)
+    assert first == (1, [(0, 6, 'keyword'), (10, 4, 'keyword'), (17, 5, 'keyword'), (28, 1, 'symbol'),
+                         (30, 5, 'quote')])
+    # A line ending with an escaped quote is still inside the literal.
+    assert second == (1, [(0, 6, 'quote')])
+    # An escaped backslash before the quote closes it.
+    assert third == (0, [(0, 2, 'quote'), (3, 3, 'keyword'), (9, 1, 'symbol'), (11, 5, 'quote')])
+
+
+def test_find_rehighlights_matching_lines(qapp):
+    from PyQt5.QtGui import QTextDocument
+    from PyQt5.QtTest import QTest
+    from utils.custom_widgets import FindDialog, SOQLHighlighter
+    document = QTextDocument()
+    highlighter = SOQLHighlighter(document)
+    document.setPlainText('SELECT Id\nFROM Account\nWHERE Id = null')
+    highlighter.rehighlight()
+
+    highlighter.find('id')
+    assert [(7, 2, 'search') in ranges or (6, 2, 'search') in ranges for _, ranges in _block_formats(document)] == [
+        True, False, True]
+    highlighter.find('account')
+    assert [any(kind == 'search' for _, _, kind in ranges) for _, ranges in _block_formats(document)] == [
+        False, True, False]
+
+    # The dialog searches for the literal text once typing pauses.
+    dialog = FindDialog(highlighter)
+    dialog._txt_find.setText('Id =')
+    assert highlighter._search_regex.pattern() == 'account'
+    QTest.qWait(300)
+    assert [any(kind == 'search' for _, _, kind in ranges) for _, ranges in _block_formats(document)] == [
+        False, False, True]
+    dialog.close()
+    assert highlighter._search_regex is None
+    assert not any(kind == 'search' for _, ranges in _block_formats(document) for _, _, kind in ranges)
+
+
+def test_selection_copies_as_utf8_mime_data(qapp):
+    from views.window_main import _selection_to_mime_data
+    store = result_store.ResultStore.from_rows(['Id', 'Name'], [['1', 'Zoë'], ['2', 'A\tB']])
+
+    mime_data = _selection_to_mime_data(store, ([1, 0], [0, 1], None), include_headers=True)
+    assert mime_data.text() == 'Id\tName\n2\tA B\n1\tZoë'
+    assert _selection_to_mime_data(store, ([0], [0, 1], {0: {1}})).text() == '\tZoë'
+    assert _selection_to_mime_data(store, ([], [], None)) is None
+
+
+def _wait_for(condition, timeout=5.0):
+    """Run the Qt event loop until ``condition()`` holds, so worker signals get delivered."""
+    from PyQt5.QtTest import QTest
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        QTest.qWait(10)
+    return condition()
+
+
+def test_results_table_shows_sorts_and_copies_the_store(qapp):
+    from PyQt5.QtCore import QItemSelection, QItemSelectionModel, Qt
+    from utils.custom_widgets import ResultsTable
+    from views.window_main import _selection_to_mime_data
+    table = ResultsTable()
+    table.set_data(['Id', 'Name'], [['1', 'b'], ['2', 'a'], ['3', None]])
+    model = table.model()
+
+    assert (model.rowCount(), model.columnCount()) == (3, 2)
+    assert [model.data(model.index(row, 1)) for row in range(3)] == ['b', 'a', '']
+    assert (model.headerData(1, Qt.Horizontal), model.headerData(0, Qt.Vertical)) == ('Name', 1)
+    table.store.append_rows([['4', 'c']])
+    table.sync_rows()
+    assert model.rowCount() == 4
+
+    model.sort(1, Qt.AscendingOrder)
+    assert [model.data(model.index(row, 1)) for row in range(4)] == ['a', 'b', 'c', '']
+
+    # A filter is searched again only over the rows of each new page.
+    table.set_filter('Name:c')
+    assert _wait_for(lambda: model.rowCount() == 1)
+    searches = []
+    search = model._search_index.search
+    model._search_index.search = lambda *args: searches.append(args) or search(*args)
+    table.store.append_rows([['5', 'cc'], ['6', 'd']])
+    table.sync_rows()
+    assert _wait_for(lambda: model.rowCount() == 2)
+    assert searches[-1][-1] == 4
+    assert model.loaded_row_count == 6
+    assert [model.data(model.index(row, 1)) for row in range(2)] == ['c', 'cc']
+    model._search_index.search = search
+    table.set_filter('')
+
+    selection_model = table.selectionModel()
+    selection_model.select(QItemSelection(model.index(0, 0), model.index(1, 1)), QItemSelectionModel.Select)
+    assert table.selected_cells() == ([1, 0], [0, 1], None)
+    assert _selection_to_mime_data(table.store, table.selected_cells(), True).text() == 'Id\tName\n2\ta\n1\tb'
+
+    selection_model.select(model.index(2, 0), QItemSelectionModel.Select)
+    assert table.selected_cells() == ([1, 0, 3], [0, 1], {1: {0, 1}, 0: {0, 1}, 3: {0}})
+    assert _selection_to_mime_data(table.store, table.selected_cells()).text() == '2\ta\n1\tb\n4\t'
+
+
+def test_cancel_and_finish_query_workers(qapp):
+    from controllers.main_controller import MainController
+    from utils.workers import Worker
+    from views.window_main import MainWindow
+    connector = salesforce_connector.SForceConnector('user', 'pass', False, _sf_lib=MockSalesforce,
+                                                     metadata_cache=False, query_cache=False, prefetch_depth=0)
+    view = MainWindow()
+    controller = MainController(view, connector)
+    shown = []
+
+    view.tables = ['Account', 'Contact', 'Sample_Transaction_vod__c']
+    view.table_filter = 'stv'
+    assert view.tables == ['Sample_Transaction_vod__c']
+    assert view.all_tables == ['Account', 'Contact', 'Sample_Transaction_vod__c']
+    view.table_filter = ''
+
+    release = threading.Event()
+    blocked = Worker(release.wait)
+    controller._start_query_worker(blocked, 'Running Query...', shown.append)
+    assert view.query_running
+    # Only one query runs at a time.
+    controller._start_query_worker(Worker(lambda: 'refused'), 'Running Query...', shown.append)
+    assert controller._query_worker is blocked
+
+    controller._cancel_query()
+    assert not view.query_running and controller._query_worker is None and blocked.is_cancelled()
+    release.set()
+    controller._start_query_worker(Worker(lambda: 'next'), 'Running Query...', shown.append)
+    assert _wait_for(lambda: shown)
+    # A late result of the cancelled worker is ignored.
+    controller._show_query_result(blocked, shown.append, 'stale')
+    assert shown == ['next'] and not view.query_running
+
+    view.query_text = 'SELECT Id, Name FROM Account'
+    controller._run_query()
+    assert _wait_for(lambda: not view.query_running)
+    assert view.query_more_enabled and view.load_all_enabled
+    # Hold the next page back until the user has cancelled.
+    page_sent = threading.Event()
+    query_more = connector.session.query_more
+    connector.session.query_more = lambda *args: page_sent.wait(5) and query_more(*args)
+    controller._run_query_more()
+    controller._cancel_query()
+    assert not view.query_running and not view.query_more_enabled
+    page_sent.set()
+    assert _wait_for(lambda: connector.next_record_url is None)
+    assert len(connector.results_store) == 2
+    view.close()
+    connector.close()
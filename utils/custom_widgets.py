@@ -1,54 +1,375 @@
 import re
+from functools import partial
 
 import PyQt5.QtGui as qtg
 import PyQt5.QtWidgets as qtw
-from PyQt5.QtCore import QRegExp, Qt
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QRegularExpression, QSortFilterProxyModel, \
+    QStringListModel, Qt, QThreadPool, QTimer, pyqtSignal
 
+from models.column_sort import SortIndex
+from models.result_search import ResultIndex
+from models.result_store import ResultStore, format_value
+from utils.search_index import NameIndex
+from utils.workers import Worker
 
-class ResultsTable(qtw.QTableWidget):
+
+# Results with at least this many rows are sorted on a worker thread.
+BACKGROUND_SORT_ROWS = 20000
+
+
+class ResultsModel(QAbstractTableModel):
+    """Read-only table model over a ``ResultStore``.
+
+    Only the first rows of the store are exposed; rows the connector appends later show up once ``sync_rows`` is
+    called on the GUI thread. Sorting goes through a ``SortIndex`` using the describe types given to
+    ``set_column_types``; large results are sorted on a worker thread and ``sorting`` is emitted around it.
+    ``set_filter`` limits the shown rows to those matching a filter expression, searched on a worker thread through a
+    ``ResultIndex`` that indexes the searched columns on first use.
+    """
+
+    sorting = pyqtSignal(bool)
+    filtered = pyqtSignal(int)
+    filter_failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._store = ResultStore([])
+        self._row_count = 0
+        self._order = None
+        self._rows = None
+        self._sort_index = SortIndex(self._store)
+        self._sort_worker = None
+        self._search_index = ResultIndex(self._store, self._sort_index)
+        self._filter_text = ''
+        self._filter_rows = None
+        self._filter_worker = None
+        self._column_types = {}
+
+    @property
+    def store(self) -> ResultStore:
+        return self._store
+
+    @property
+    def filter_text(self) -> str:
+        return self._filter_text
+
+    @property
+    def loaded_row_count(self) -> int:
+        """Store rows exposed so far, whether or not the filter shows them."""
+        return self._row_count
+
+    def set_store(self, store: ResultStore):
+        self._cancel_sort()
+        self._cancel_filter()
+        self.beginResetModel()
+        self._store = store
+        self._row_count = len(store)
+        self._order = None
+        self._filter_rows = None
+        self._rows = None
+        self._sort_index = SortIndex(store)
+        self._search_index = ResultIndex(store, self._sort_index)
+        self._column_types = {}
+        self.endResetModel()
+        if self._filter_text:
+            self._start_filter(None)
+
+    def set_column_types(self, column_types: dict):
+        """Describe types by header, used by later sorts and filters."""
+        self._column_types = dict(column_types)
+
+    def sync_rows(self):
+        first = self._row_count
+        last = len(self._store) - 1
+        if last < first:
+            return
+        self._cancel_sort()
+        filtering = self._filter_rows is not None or self._filter_worker is not None
+        if self._filter_rows is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+        self._row_count = last + 1
+        if self._order is not None:
+            # New rows go after the sorted ones until the user sorts again.
+            self._order.extend(range(first, self._row_count))
+        if self._filter_rows is None:
+            self.endInsertRows()
+
+        if filtering:
+            # Filtered rows are shown once the filter has been run over them.
+            self._start_filter(None if self._filter_worker is not None else first)
+
+    def clear_data(self):
+        self.set_store(ResultStore([]))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._row_count if self._rows is None else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._store.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.cell_text(index.row(), index.column())
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            return self.header_text(section)
+        return section + 1
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if not 0 <= column < self.columnCount():
+            return
+        self._cancel_sort()
+        field_type = self._column_types.get(self._store.headers[column])
+        args = (column, field_type, order == Qt.DescendingOrder, self._row_count)
+        if self._row_count < BACKGROUND_SORT_ROWS or self._sort_index.is_sorted(column, field_type, self._row_count):
+            self._apply_order(self._sort_index.order(*args))
+            return
+
+        worker = Worker(self._sort_index.order, *args)
+        worker.signals.result.connect(partial(self._show_sorted, worker))
+        worker.signals.error.connect(partial(self._show_sorted, worker, None))
+        self._sort_worker = worker
+        self.sorting.emit(True)
+        QThreadPool.globalInstance().start(worker)
+
+    def _show_sorted(self, worker, order):
+        if worker is not self._sort_worker:
+            return
+        self._sort_worker = None
+        self.sorting.emit(False)
+        if order is not None:
+            self._apply_order(order)
+
+    def _cancel_sort(self):
+        if self._sort_worker is not None:
+            self._sort_worker.cancel()
+            self._sort_worker = None
+            self.sorting.emit(False)
+
+    def _apply_order(self, order):
+        self.layoutAboutToBeChanged.emit()
+        self._order = order
+        self._update_rows()
+        self.layoutChanged.emit()
+
+    def set_filter(self, text: str):
+        """Show only the rows matching the filter expression ``text``; see ``parse_filter``. Empty text shows all."""
+        self._cancel_filter()
+        self._filter_text = text.strip()
+        if self._filter_text:
+            self._start_filter(None)
+            return
+        if self._filter_rows is not None:
+            self.beginResetModel()
+            self._filter_rows = None
+            self._update_rows()
+            self.endResetModel()
+        self.filtered.emit(self.rowCount())
+
+    def _start_filter(self, first):
+        """Search the filter over every row, or only over the rows from ``first`` on and add their matches to the shown
+        rows."""
+        self._cancel_filter()
+        worker = Worker(self._search_index.search, self._filter_text, self._row_count, self._column_types,
+                        first or 0)
+        worker.signals.result.connect(partial(self._show_filtered, worker, first))
+        worker.signals.error.connect(partial(self._show_filter_error, worker))
+        self._filter_worker = worker
+        QThreadPool.globalInstance().start(worker)
+
+    def _show_filtered(self, worker, first, rows):
+        if worker is not self._filter_worker:
+            return
+        self._filter_worker = None
+        if first is None:
+            self.beginResetModel()
+            self._filter_rows = set(rows)
+            self._update_rows()
+            self.endResetModel()
+        elif rows:
+            # Only the rows from ``first`` on were searched; their matches go after the ones already shown.
+            shown = len(self._rows)
+            self.beginInsertRows(QModelIndex(), shown, shown + len(rows) - 1)
+            self._filter_rows.update(rows)
+            self._rows.extend(rows)
+            self.endInsertRows()
+        self.filtered.emit(self.rowCount())
+
+    def _show_filter_error(self, worker, message):
+        if worker is self._filter_worker:
+            self._filter_worker = None
+            self.filter_failed.emit(message)
+
+    def _cancel_filter(self):
+        if self._filter_worker is not None:
+            self._filter_worker.cancel()
+            self._filter_worker = None
+
+    def _update_rows(self):
+        if self._filter_rows is None:
+            self._rows = self._order
+        elif self._order is None:
+            self._rows = sorted(self._filter_rows)
+        else:
+            self._rows = [row for row in self._order if row in self._filter_rows]
+
+    def header_text(self, col):
+        return self._store.headers[col]
+
+    def cell_text(self, row, col):
+        if self._rows is not None:
+            row = self._rows[row]
+        return format_value(self._store.cell(row, col))
+
+    def store_rows(self, rows):
+        """Store row indexes of the view ``rows``, following the current sort order and filter."""
+        if self._rows is None:
+            return list(rows)
+        shown = self._rows
+        return [shown[row] for row in rows]
+
+
+class ResultsTable(qtw.QTableView):
     def __init__(self, *args, parent=None):
         super().__init__(parent)
+        self._model = ResultsModel(self)
+        self.setModel(self._model)
         self.setSortingEnabled(True)
         self.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
 
         if len(args) >= 2:
             self.set_data(args[0], args[1])
 
     def set_data(self, headers, rows):
-        self.clear_data()
+        self.set_store(ResultStore.from_rows(headers, rows))
 
-        self.setColumnCount(len(headers))
-        self.setRowCount(len(rows))
-        self.setHorizontalHeaderLabels(headers)
-
-        for row_i, row in enumerate(rows):
-            for col_i, col in enumerate(row):
-                item = qtw.QTableWidgetItem(col)
-                self.setItem(row_i, col_i, item)
+    def set_store(self, store: ResultStore):
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self._model.set_store(store)
 
         self.resizeColumnsToContents()
-        for col_i in range(self.columnCount()):
+        for col_i in range(self._model.columnCount()):
             if self.columnWidth(col_i) > (self.width() / 4):
-                self.setColumnWidth(col_i, self.width() / 4)
+                self.setColumnWidth(col_i, self.width() // 4)
+
+    def sync_rows(self):
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self._model.sync_rows()
+
+    def set_column_types(self, column_types: dict):
+        self._model.set_column_types(column_types)
+
+    def set_filter(self, text: str):
+        self._model.set_filter(text)
+
+    def shown_rows(self):
+        """Store rows of every row shown, in view order."""
+        return self._model.store_rows(range(self._model.rowCount()))
 
     def clear_data(self):
-        while self.columnCount() > 0:
-            self.removeColumn(0)
-        while self.rowCount() > 0:
-            self.removeRow(0)
+        self._model.clear_data()
+
+    def selected_ranges(self):
+        return [(sel.top(), sel.bottom(), sel.left(), sel.right()) for sel in self.selectionModel().selection()]
+
+    @property
+    def store(self) -> ResultStore:
+        return self._model.store
+
+    def selected_cells(self):
+        """Return the store rows and columns spanned by every selected range, in view order.
+
+        The third value is ``None`` when each of those rows has all of those columns selected. Otherwise it maps each
+        store row to the set of columns selected in it.
+        """
+        ranges = self.selected_ranges()
+        if not ranges:
+            return [], [], None
+
+        spans = {(left, right) for _, _, left, right in ranges}
+        if len(spans) == 1:
+            left, right = spans.pop()
+            if len(ranges) == 1:
+                rows = range(ranges[0][0], ranges[0][1] + 1)
+            else:
+                rows = sorted({row for top, bottom, _, _ in ranges for row in range(top, bottom + 1)})
+            return self._model.store_rows(rows), list(range(left, right + 1)), None
+
+        row_columns = {}
+        for top, bottom, left, right in ranges:
+            span = range(left, right + 1)
+            for row in range(top, bottom + 1):
+                row_columns.setdefault(row, set()).update(span)
+        rows = sorted(row_columns)
+        cols = sorted(set().union(*row_columns.values()))
+        store_rows = self._model.store_rows(rows)
+        if all(len(row_columns[row]) == len(cols) for row in rows):
+            return store_rows, cols, None
+        return store_rows, cols, {store_row: row_columns[row] for store_row, row in zip(store_rows, rows)}
+
+    def header_text(self, col):
+        return self._model.header_text(col)
+
+    def cell_text(self, row, col):
+        return self._model.cell_text(row, col)
+
+
+class TableFilterProxyModel(QSortFilterProxyModel):
+    """Filters a ``QStringListModel`` of table names through a ``NameIndex`` built once per list of names."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._source = QStringListModel(self)
+        self._index = NameIndex([])
+        self._matches = self._index.matcher('')
+        self._filter_text = ''
+        self.setSourceModel(self._source)
+
+    @property
+    def names(self) -> list:
+        return self._index.names
+
+    @names.setter
+    def names(self, names):
+        self._index = NameIndex(names)
+        self._matches = self._index.matcher(self._filter_text)
+        self._source.setStringList(self._index.names)
+
+    @property
+    def filter_text(self) -> str:
+        return self._filter_text
+
+    @filter_text.setter
+    def filter_text(self, text: str):
+        self._filter_text = text
+        self._matches = self._index.matcher(text)
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self._matches(source_row)
 
 
 class SOQLHighlighter(qtg.QSyntaxHighlighter):
+    # Block states: whether a block ends inside a string literal that continues on the next line.
+    STATE_DEFAULT = 0
+    STATE_IN_QUOTE = 1
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.keywords = ['and', 'asc', 'desc', 'excludes', 'first', 'from', 'group', 'having', 'in', 'includes', 'last',
-                    'like', 'limit', 'not', 'null', 'nulls', 'or', 'select', 'where', 'with']
-        self.symbols = list('-=,') + r'\[,\],\(,\),!='.split(',')
-        self.quote_regex = r"'[^'\\]*(\\.[^'\\]*)*('|$)"
-
-        self.search_text = None
+                         'like', 'limit', 'not', 'null', 'nulls', 'or', 'select', 'where', 'with']
+        self.symbols = ['!=', '-', '=', ',', r'\[', r'\]', r'\(', r'\)']
+        # A literal ends at its closing quote or, when it continues on the next line, at the end of the line. Only the
+        # ``closed`` group tells them apart, since a line can also end with an escaped quote.
+        self.quote_regex = r"'[^'\\]*(?:\\.[^'\\]*)*(?:(?<closed>')|\\?$)"
 
         self.keyword_format = qtg.QTextCharFormat()
         self.keyword_format.setForeground(Qt.blue)
@@ -63,32 +384,76 @@ class SOQLHighlighter(qtg.QSyntaxHighlighter):
         self.search_format = qtg.QTextCharFormat()
         self.search_format.setBackground(Qt.green)
 
-        self.keyword_patterns = ['\\b{0}\\b'.format(word) for word in self.keywords]
-        self.highlight_rules = []
-        self._update_highlight_rules()
+        # Every rule is folded into one expression so each block is scanned once. Quotes come first so keywords and
+        # symbols inside string literals keep the quote format.
+        self._token_regex = QRegularExpression(
+            r'(?<quote>{0})|(?<keyword>\b(?:{1})\b)|(?<symbol>{2})'.format(
+                self.quote_regex, '|'.join(self.keywords), '|'.join(self.symbols)),
+            QRegularExpression.CaseInsensitiveOption)
+        self._token_formats = [('quote', self.quote_format), ('keyword', self.keyword_format),
+                               ('symbol', self.symbol_format)]
+        # Matches the rest of a string literal that was left open on a previous line.
+        self._quote_end_regex = QRegularExpression(r"^[^'\\]*(?:\\.[^'\\]*)*'")
+        self._search_regex = None
 
     def find(self, text):
-        self.search_text = text
-        self._update_highlight_rules()
-
-    def _update_highlight_rules(self):
-        self.highlight_rules = [(QRegExp(pattern, Qt.CaseInsensitive), self.keyword_format) for pattern in
-                                self.keyword_patterns]
-        self.highlight_rules.extend((QRegExp(pattern), self.symbol_format) for pattern in self.symbols)
-        self.highlight_rules.append((QRegExp(self.quote_regex), self.quote_format))
-        if self.search_text not in (None, ''):
-            self.highlight_rules.append((QRegExp(self.search_text, Qt.CaseInsensitive), self.search_format))
+        """Highlight matches of the regular expression ``text``, or clear the highlight when it is empty.
+
+        Only blocks that matched the previous search or match the new one are highlighted again.
+        """
+        old_regex = self._search_regex
+        self._search_regex = None
+        if text not in (None, ''):
+            self._search_regex = QRegularExpression(text, QRegularExpression.CaseInsensitiveOption)
+
+        document = self.document()
+        if document is None:
+            return
+        blocks = {}
+        for regex in (old_regex, self._search_regex):
+            if regex is None:
+                continue
+            cursor = document.find(regex, 0)
+            while not cursor.isNull():
+                block = cursor.block()
+                blocks[block.blockNumber()] = block
+                cursor = document.find(regex, block.position() + block.length())
+        for block in blocks.values():
+            self.rehighlightBlock(block)
 
     def highlightBlock(self, text):
-        for pattern, frmt in self.highlight_rules:
-            expression = QRegExp(pattern)
-            index = expression.indexIn(text)
-            while index >= 0:
-                length = expression.matchedLength()
-                self.setFormat(index, length, frmt)
-                index = expression.indexIn(text, index + length)
-
-        self.setCurrentBlockState(0)
+        start = 0
+        state = self.STATE_DEFAULT
+
+        if self.previousBlockState() == self.STATE_IN_QUOTE:
+            match = self._quote_end_regex.match(text)
+            if match.hasMatch():
+                start = match.capturedEnd()
+            else:
+                start = len(text)
+                state = self.STATE_IN_QUOTE
+            self.setFormat(0, start, self.quote_format)
+
+        if state == self.STATE_DEFAULT:
+            tokens = self._token_regex.globalMatch(text, start)
+            while tokens.hasNext():
+                match = tokens.next()
+                for name, frmt in self._token_formats:
+                    index = match.capturedStart(name)
+                    if index >= 0:
+                        self.setFormat(index, match.capturedLength(name), frmt)
+                        break
+                if match.capturedStart('quote') >= 0 and match.capturedStart('closed') < 0:
+                    state = self.STATE_IN_QUOTE
+
+        if self._search_regex is not None:
+            matches = self._search_regex.globalMatch(text)
+            while matches.hasNext():
+                match = matches.next()
+                if match.capturedLength() > 0:
+                    self.setFormat(match.capturedStart(), match.capturedLength(), self.search_format)
+
+        self.setCurrentBlockState(state)
 
 
 class FindDialog(qtw.QDialog):
@@ -101,24 +466,97 @@ class FindDialog(qtw.QDialog):
 
         self._txt_find = qtw.QLineEdit()
         self._btn_close = qtw.QPushButton('Close')
+        # Searching waits until typing pauses instead of rehighlighting on every keystroke.
+        self._find_timer = QTimer(self)
+        self._find_timer.setSingleShot(True)
+        self._find_timer.setInterval(150)
 
         self._root_layout = qtw.QVBoxLayout(self)
         self._root_layout.addWidget(self._txt_find)
         self._root_layout.addWidget(self._btn_close)
 
-        self._txt_find.textChanged.connect(self._find)
+        self._txt_find.textChanged.connect(self._find_timer.start)
+        self._find_timer.timeout.connect(self._find)
         self._btn_close.clicked.connect(self.close)
         self._txt_find.setFocus()
 
     def closeEvent(self, event):
         self._txt_find.setText('')
+        self._find_timer.stop()
         self._find_area.find(None)
-        self._find_area.rehighlight()
 
     def _find(self):
         text = re.escape(self._txt_find.text())
         self._find_area.find(text)
-        self._find_area.rehighlight()
+
+
+class DiagnosticsDialog(qtw.QDialog):
+    """Lists the latest timed operations, newest first, with their phases, rows, bytes and peak memory."""
+
+    COLUMNS = ('Started', 'Operation', 'Total (ms)', 'Phases (ms)', 'Rows', 'KB', 'Peak MB')
+
+    def __init__(self, parent=None):
+        super().__init__(parent, Qt.WindowSystemMenuHint | Qt.WindowTitleHint | Qt.WindowCloseButtonHint)
+
+        self.setWindowTitle('Diagnostics')
+        self.resize(900, 400)
+
+        self._chk_recording = qtw.QCheckBox('Record Timings')
+        self._tbl_operations = qtw.QTableWidget(0, len(self.COLUMNS))
+        self._btn_export = qtw.QPushButton('Export Log...')
+        self._btn_clear = qtw.QPushButton('Clear')
+        self._btn_close = qtw.QPushButton('Close')
+
+        self._layout_buttons = qtw.QHBoxLayout()
+        self._layout_buttons.addWidget(self._chk_recording)
+        self._layout_buttons.addStretch()
+        self._layout_buttons.addWidget(self._btn_export)
+        self._layout_buttons.addWidget(self._btn_clear)
+        self._layout_buttons.addWidget(self._btn_close)
+        self._root_layout = qtw.QVBoxLayout(self)
+        self._root_layout.addWidget(self._tbl_operations)
+        self._root_layout.addLayout(self._layout_buttons)
+
+        self._tbl_operations.setHorizontalHeaderLabels(self.COLUMNS)
+        self._tbl_operations.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self._tbl_operations.verticalHeader().hide()
+        self._tbl_operations.horizontalHeader().setSectionResizeMode(3, qtw.QHeaderView.Stretch)
+        self._btn_close.clicked.connect(self.close)
+
+    def set_listener_recording(self, func):
+        self._chk_recording.toggled.connect(func)
+
+    def set_listener_export(self, func):
+        self._btn_export.clicked.connect(func)
+
+    def set_listener_clear(self, func):
+        self._btn_clear.clicked.connect(func)
+
+    @property
+    def recording(self) -> bool:
+        return self._chk_recording.isChecked()
+
+    @recording.setter
+    def recording(self, recording: bool):
+        self._chk_recording.blockSignals(True)
+        self._chk_recording.setChecked(recording)
+        self._chk_recording.blockSignals(False)
+
+    def set_operations(self, operations):
+        """Show ``operations`` (``utils.instrumentation.Operation``, oldest first)."""
+        self._tbl_operations.setRowCount(len(operations))
+        for row, operation in enumerate(reversed(operations)):
+            info = operation.to_dict()
+            counters = info['counters']
+            phases = ', '.join('{0} {1:.1f}'.format(name, ms) for name, ms in info['phases_ms'].items())
+            size = counters.get('bytes')
+            cells = (info['started'][11:], info['name'], '{0:.1f}'.format(info['duration_ms']), phases,
+                     counters.get('rows', ''), '' if size is None else '{0:.1f}'.format(size / 1024),
+                     counters.get('peak_mb', ''))
+            for col, text in enumerate(cells):
+                self._tbl_operations.setItem(row, col, qtw.QTableWidgetItem(str(text)))
+        self._tbl_operations.resizeColumnsToContents()
+
 
 if __name__ == '__main__':
     import sys
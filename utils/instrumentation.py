@@ -0,0 +1,255 @@
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; operations are then recorded without peak memory.
+    resource = None
+
+
+def format_seconds(seconds) -> str:
+    return '{0:.0f} ms'.format(seconds * 1000) if seconds < 1 else '{0:.2f} s'.format(seconds)
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class Operation(object):
+    """One timed operation: its total ``duration`` in seconds, time per ``phases`` and ``counters`` (rows, bytes)."""
+
+    __slots__ = ('name', 'started', 'duration', 'phases', 'counters')
+
+    def __init__(self, name, counters=None):
+        self.name = name
+        self.started = time.time()
+        self.duration = 0.0
+        self.phases = OrderedDict()
+        self.counters = OrderedDict(counters or {})
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> str:
+        """e.g. ``query 1.20 s: network 800 ms, decode 250 ms, clean 120 ms; 2000 rows, 1.5 MB``."""
+        parts = ['{0} {1}'.format(self.name, format_seconds(self.duration))]
+        if self.phases:
+            parts[0] += ':'
+            parts.append(', '.join('{0} {1}'.format(name, format_seconds(seconds))
+                                   for name, seconds in self.phases.items()))
+        counters = []
+        if 'rows' in self.counters:
+            counters.append('{0} rows'.format(self.counters['rows']))
+        if 'bytes' in self.counters:
+            counters.append('{0:.1f} MB'.format(self.counters['bytes'] / 1024 / 1024))
+        if counters:
+            parts[-1] += ';'
+            parts.append(', '.join(counters))
+        return ' '.join(parts)
+
+    def to_dict(self) -> OrderedDict:
+        return OrderedDict([
+            ('name', self.name),
+            ('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))),
+            ('duration_ms', round(self.duration * 1000, 3)),
+            ('phases_ms', OrderedDict((name, round(seconds * 1000, 3)) for name, seconds in self.phases.items())),
+            ('counters', self.counters),
+        ])
+
+
+class _Span(object):
+    __slots__ = ('instrumentation', 'operation', 'start')
+
+    def __init__(self, instrumentation, operation):
+        self.instrumentation = instrumentation
+        self.operation = operation
+
+    def __enter__(self):
+        self.instrumentation._stack().append(self.operation)
+        self.start = time.perf_counter()
+        return self.operation
+
+    def __exit__(self, *exc_info):
+        self.operation.duration = time.perf_counter() - self.start
+        self.instrumentation._stack().pop()
+        self.instrumentation.record(self.operation)
+        return False
+
+
+class _Phase(object):
+    __slots__ = ('operation', 'name', 'start')
+
+    def __init__(self, operation, name):
+        self.operation = operation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.operation
+
+    def __exit__(self, *exc_info):
+        self.operation.add_phase(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan(object):
+    """Stands in for spans and phases while instrumentation is off, so callers pay for a single method call."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Instrumentation(object):
+    """Latency, row, byte and memory figures for connector calls and view updates.
+
+    ``operation(name)`` times a whole operation and ``phase(name)`` a part of the operation running on the same
+    thread; ``count`` adds to its counters. Finished operations are kept in ``history`` (the last ``history_size``),
+    passed to every hook from ``add_hook`` on the thread that ran them and, with a ``log_path``, appended to that file
+    as JSON lines. While ``enabled`` is off every call returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=False, history_size=50, log_path=None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.history = deque(maxlen=history_size)
+        self._hooks = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_hook(self, func):
+        self._hooks.append(func)
+
+    def remove_hook(self, func):
+        if func in self._hooks:
+            self._hooks.remove(func)
+
+    def operation(self, name, **counters):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, Operation(name, counters))
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        operation = self.current()
+        return _NULL_SPAN if operation is None else _Phase(operation, name)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            operation = self.current()
+            if operation is not None:
+                operation.count(name, value)
+
+    def current(self):
+        """The innermost operation running on this thread, or ``None``."""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def operations(self) -> list:
+        """The kept operations, oldest first."""
+        with self._lock:
+            return list(self.history)
+
+    def last(self, *names):
+        """The most recent finished operation called one of ``names``, or ``None``."""
+        with self._lock:
+            for operation in reversed(self.history):
+                if operation.name in names:
+                    return operation
+        return None
+
+    def clear(self):
+        with self._lock:
+            self.history.clear()
+
+    def export(self, path):
+        """Write the kept operations to ``path`` as JSON lines."""
+        with open(path, 'w') as file:
+            file.writelines(json.dumps(operation.to_dict()) + '\n' for operation in self.operations())
+
+    def response_hook(self, response, *args, **kwargs):
+        """``requests`` response hook adding the time to the response headers and the body size on the wire."""
+        if not self.enabled:
+            return
+        operation = self.current()
+        if operation is None:
+            return
+        operation.add_phase('network', response.elapsed.total_seconds())
+        length = response.headers.get('Content-Length')
+        if length is not None:
+            operation.count('bytes', int(length))
+
+    def record(self, operation):
+        """Keep a finished ``operation``, pass it to the hooks and log it."""
+        # The library call includes the network time; what is left is reading and decoding the body.
+        phases = operation.phases
+        if 'fetch' in phases and 'network' in phases:
+            network = phases.pop('network')
+            operation.phases = OrderedDict()
+            for name, seconds in phases.items():
+                if name == 'fetch':
+                    operation.phases['network'] = network
+                    operation.phases['decode'] = max(seconds - network, 0.0)
+                else:
+                    operation.phases[name] = seconds
+        memory = peak_memory_mb()
+        if memory is not None:
+            operation.counters['peak_mb'] = memory
+        with self._lock:
+            self.history.append(operation)
+        for hook in list(self._hooks):
+            hook(operation)
+        if self.log_path:
+            with self._lock, open(self.log_path, 'a') as file:
+                file.write(json.dumps(operation.to_dict()) + '\n')
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+class StartupTimer(object):
+    """Times the phases of a launch, up to a usable main window, as a ``startup`` operation.
+
+    ``mark(phase)`` ends the current phase. Time the user spends in the login dialog is dropped with ``skip`` and only
+    the login call itself, timed by the dialog, is added with ``add``.
+    """
+
+    def __init__(self, launched: float):
+        self.operation = Operation('startup')
+        self._phase_start = launched
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.operation.add_phase(phase, now - self._phase_start)
+        self._phase_start = now
+
+    def add(self, phase, seconds):
+        self.operation.add_phase(phase, seconds)
+
+    def skip(self):
+        self._phase_start = time.perf_counter()
+
+    def finish(self, phase) -> Operation:
+        self.mark(phase)
+        self.operation.duration = sum(self.operation.phases.values())
+        return self.operation
@@ -0,0 +1,160 @@
+import re
+from bisect import bisect_left
+
+_WORD_START = re.compile(r'(?:^|(?<=_)|(?<=[a-z0-9])(?=[A-Z]))[A-Za-z0-9]')
+
+
+def name_initials(name: str) -> str:
+    """First letter of every word of an API name, split on underscores and camel case (``Sample_Data__c``: ``sdc``)."""
+    return ''.join(match.group(0) for match in _WORD_START.finditer(name)).lower()
+
+
+class NameIndex(object):
+    """Precomputed lowercase names and initials for fast, fuzzy filtering of a fixed list of names."""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self._lower = [name.lower() for name in self.names]
+        self._initials = [name_initials(name) for name in self.names]
+
+    def matcher(self, text: str):
+        """Return a ``row -> bool`` predicate accepting names that contain ``text``, start their initials with it (camel
+        case matching) or contain its characters in order (fuzzy matching)."""
+        text = text.strip().lower()
+        if not text:
+            return lambda row: True
+        fuzzy = re.compile('.*?'.join(re.escape(char) for char in text)).search
+        lower = self._lower
+        initials = self._initials
+
+        def matches(row):
+            return text in lower[row] or initials[row].startswith(text) or fuzzy(lower[row]) is not None
+
+        return matches
+
+    def filter(self, text: str) -> list:
+        matches = self.matcher(text)
+        return [name for row, name in enumerate(self.names) if matches(row)]
+
+
+class PrefixIndex(object):
+    """Sorted, case-insensitive word list answering prefix lookups with a binary search."""
+
+    def __init__(self, words):
+        pairs = sorted((word.lower(), word) for word in set(words))
+        self._keys = [key for key, _ in pairs]
+        self._words = [word for _, word in pairs]
+
+    def __len__(self):
+        return len(self._words)
+
+    @property
+    def words(self) -> list:
+        return self._words
+
+    def lookup(self, prefix: str, limit: int = 50) -> list:
+        prefix = prefix.lower()
+        keys = self._keys
+        start = bisect_left(keys, prefix)
+        end = min(start + limit, len(keys))
+        matches = []
+        for i in range(start, end):
+            if not keys[i].startswith(prefix):
+                break
+            matches.append(self._words[i])
+        return matches
+
+
+_TOKEN_BEFORE_CURSOR = re.compile(r'[\w.]*$')
+_TABLE_POSITION = re.compile(r'\bfrom\s+\w*$', re.IGNORECASE)
+# String literals, parentheses and FROMs, in the order they appear.
+_FROM_TOKENS = re.compile(r"'(?:[^'\\]|\\.)*'|(?P<open>\()|(?P<close>\))|\bfrom\s+(?P<table>\w+)", re.IGNORECASE)
+
+
+def query_table(query_text: str):
+    """The sObject named after the top-level FROM of ``query_text``, as typed, or ``None``.
+
+    FROMs of subqueries, such as ``(SELECT Id FROM Contacts)`` in the SELECT list, and of string literals are skipped.
+    The scan stops at the top-level FROM, so a long WHERE clause after it costs nothing on each keystroke.
+    """
+    depth = 0
+    for match in _FROM_TOKENS.finditer(query_text):
+        if match.group('open'):
+            depth += 1
+        elif match.group('close'):
+            depth = max(depth - 1, 0)
+        elif match.group('table') and not depth:
+            return match.group('table')
+    return None
+
+
+class SOQLCompletionIndex(object):
+    """sObject, field and relationship path suggestions for a SOQL editor.
+
+    Tables are known up front; the fields of a table are added with ``set_fields`` once it has been described.
+    ``complete`` reports a table whose fields are still missing so the caller can describe it in the background.
+    """
+
+    def __init__(self):
+        self._tables = PrefixIndex([])
+        self._table_names = {}
+        self._fields = {}
+        self._relationships = {}
+        self._all_fields = None
+
+    def set_tables(self, table_names):
+        self._tables = PrefixIndex(table_names)
+        self._table_names = {name.lower(): name for name in table_names}
+
+    def table_name(self, name: str):
+        """Return the canonical spelling of table ``name``, or None if there is no such table."""
+        return self._table_names.get(name.lower())
+
+    def has_fields(self, table_name: str) -> bool:
+        return table_name.lower() in self._fields
+
+    def set_fields(self, table_name: str, fields: dict):
+        """Index the describe ``fields`` of a table by field name, including the names of its relationships."""
+        names = list(fields)
+        relationships = {}
+        for field in fields.values():
+            if field.get('relationshipName') and field.get('referenceTo'):
+                names.append(field['relationshipName'])
+                relationships[field['relationshipName'].lower()] = field['referenceTo'][0]
+        self._fields[table_name.lower()] = PrefixIndex(names)
+        self._relationships[table_name.lower()] = relationships
+        self._all_fields = None
+
+    def complete(self, text_before_cursor: str, query_text: str, limit: int = 50):
+        """Return ``(prefix, candidates, missing_table)`` for the word being typed at the end of ``text_before_cursor``.
+
+        ``prefix`` is the part of the word the candidates replace: the whole word for tables, the segment after the
+        last dot for fields and relationship paths such as ``Account.Owner.Na``.
+        """
+        token = _TOKEN_BEFORE_CURSOR.search(text_before_cursor).group(0)
+        if _TABLE_POSITION.search(text_before_cursor):
+            return token, self._tables.lookup(token, limit), None
+
+        *path, prefix = token.split('.')
+        table_name = query_table(query_text)
+        table_name = self.table_name(table_name) if table_name else None
+        if table_name is None:
+            if path:
+                return prefix, [], None
+            return prefix, self._all_field_index().lookup(prefix, limit), None
+
+        for relationship in path:
+            if not self.has_fields(table_name):
+                return prefix, [], table_name
+            table_name = self._relationships[table_name.lower()].get(relationship.lower())
+            if table_name is None:
+                return prefix, [], None
+        if not self.has_fields(table_name):
+            return prefix, [], table_name
+        return prefix, self._fields[table_name.lower()].lookup(prefix, limit), None
+
+    def _all_field_index(self):
+        # Used before the query names a table; rebuilt only after new fields were added.
+        if self._all_fields is None:
+            self._all_fields = PrefixIndex(word for index in self._fields.values() for word in index.words)
+        return self._all_fields
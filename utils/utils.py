@@ -1,6 +1,14 @@
 import json
 import os
 
+try:
+    import keyring
+except ImportError:
+    # Without it sessions are not kept between launches.
+    keyring = None
+
+KEYRING_SERVICE = 'SalesForce Viewer'
+
 
 def load_config(path=None):
     empty_value = {
@@ -27,8 +35,66 @@ def load_config(path=None):
         return data
 
 
+def cache_dir(path=None):
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.sforce_viewer_cache')
+    return path
+
+
 def save_config(logins: dict, path=None):
     if path is None:
         path = os.path.join(os.path.expanduser('~'), '.sforce_viewer.json')
     with open(path, 'w') as json_file:
-        json.dump(logins, json_file, indent=4, sort_keys=True)
\ No newline at end of file
+        json.dump(logins, json_file, indent=4, sort_keys=True)
+
+
+def session_storage_available() -> bool:
+    """Whether the system keyring can keep session ids; they are never written to the config file."""
+    if keyring is None:
+        return False
+    try:
+        # The fail and null backends, used when the system has no keyring, have a priority of 0 or less.
+        return keyring.get_keyring().priority > 0
+    except Exception:
+        return False
+
+
+def save_session(logins: dict, name: str, session_id: str, instance_url: str, path=None):
+    """Remember the Salesforce session of saved login ``name`` so the next launch can skip logging in.
+
+    The session id goes to the system keyring; without one the session is not kept.
+    """
+    if not session_storage_available():
+        return
+    try:
+        keyring.set_password(KEYRING_SERVICE, name, session_id)
+    except Exception as ex:
+        raise Exception('Could not save the session in the system keyring: {0}'.format(ex))
+    logins[name]['session'] = {'instance_url': instance_url}
+    save_config(logins, path)
+
+
+def load_session(logins: dict, name: str):
+    """Return the ``(session_id, instance_url)`` saved for login ``name``, or ``(None, None)``."""
+    session = logins.get(name, {}).get('session')
+    if not session or not session_storage_available():
+        return None, None
+    try:
+        session_id = keyring.get_password(KEYRING_SERVICE, name)
+    except Exception as ex:
+        raise Exception('Could not read the saved session from the system keyring: {0}'.format(ex))
+    if not session_id:
+        return None, None
+    return session_id, session['instance_url']
+
+
+def delete_session(logins: dict, name: str):
+    """Forget the session of saved login ``name``, e.g. before the login is replaced."""
+    session = logins.get(name, {}).pop('session', None)
+    if not session or not session_storage_available():
+        return
+    try:
+        if keyring.get_password(KEYRING_SERVICE, name) is not None:
+            keyring.delete_password(KEYRING_SERVICE, name)
+    except Exception as ex:
+        raise Exception('Could not remove the saved session from the system keyring: {0}'.format(ex))
@@ -0,0 +1,53 @@
+import traceback
+
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+
+class WorkerSignals(QObject):
+    result = pyqtSignal(object)
+    error = pyqtSignal(str)
+    progress = pyqtSignal(object)
+
+
+class Worker(QRunnable):
+    """Runs ``func(*args, **kwargs)`` on a thread pool and reports back through ``signals``.
+
+    If ``report_progress`` is set, ``func`` also receives a ``progress`` keyword argument it can call to emit
+    ``signals.progress`` from the worker thread. If ``report_cancelled`` is set, it receives a ``cancelled`` callable it
+    can poll to stop early. Nothing is emitted once the worker has been cancelled.
+    """
+
+    def __init__(self, func, *args, report_progress=False, report_cancelled=False, **kwargs):
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self.cancelled = False
+
+        if report_progress:
+            self.kwargs['progress'] = self._emit_progress
+        if report_cancelled:
+            self.kwargs['cancelled'] = self.is_cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def _emit_progress(self, value):
+        if not self.cancelled:
+            self.signals.progress.emit(value)
+
+    def run(self):
+        try:
+            result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            print(traceback.format_exc())
+            if not self.cancelled:
+                self.signals.error.emit(str(e))
+            return
+
+        if not self.cancelled:
+            self.signals.result.emit(result)
@@ -1,7 +1,9 @@
+import sys
+import time
+
 import PyQt5.QtWidgets as qtw
 from PyQt5.QtCore import Qt
 
-from models.salesforce_connector import SForceConnector
 from utils import utils
 
 
@@ -11,6 +13,10 @@ class LoginWindow(qtw.QDialog):
         super().__init__(parent)
 
         self.sf_con = None
+        # The saved login the connector was opened with, whose session is kept for the next launch.
+        self._login_name = None
+        # Seconds the last successful login took, for the startup timing.
+        self.login_seconds = None
         self.saved_logins = saved_logins
 
         self.saved_logins[''] = {
@@ -74,6 +80,12 @@ class LoginWindow(qtw.QDialog):
         security_token = self.txt_security_token.text()
         name = '{0} - {1}'.format('SANDBOX' if sandbox else 'PROD', username)
 
+        # The session of the login being replaced was for its old credentials.
+        try:
+            utils.delete_session(self.saved_logins, name)
+        except Exception as ex:
+            qtw.QMessageBox.warning(self, 'Error', str(ex))
+
         self.saved_logins[name] = {
             'username': username,
             'password': password,
@@ -96,15 +108,55 @@ class LoginWindow(qtw.QDialog):
         self.txt_security_token.setText(credentials['security_token'])
 
     def _handle_login(self):
-        username = self.txt_username.text()
-        password = self.txt_password.text()
-        environment = True if self.cmb_environment.currentText() == 'Sandbox' else False
+        credentials = {
+            'username': self.txt_username.text(),
+            'password': self.txt_password.text(),
+            'sandbox': True if self.cmb_environment.currentText() == 'Sandbox' else False,
+            'security_token': self.txt_security_token.text()
+        }
+        # A session is only reused with exactly the credentials it was saved for.
+        name = next((name for name, saved in self.saved_logins.items()
+                     if name and all(saved.get(key) == value for key, value in credentials.items())), None)
+        session_id, instance_url = None, None
+        try:
+            if name:
+                session_id, instance_url = utils.load_session(self.saved_logins, name)
+        except Exception as ex:
+            # Logging in with the password still works.
+            qtw.QMessageBox.warning(self, 'Error', str(ex))
+
+        # simple_salesforce is slow to import, so it is loaded on first use rather than before the dialog can show.
+        from models.salesforce_connector import SForceConnector
 
         try:
-            self.sf_con = SForceConnector(username, password, environment)
-            self.accept()
+            start = time.perf_counter()
+            self.sf_con = SForceConnector(credentials['username'], credentials['password'], credentials['sandbox'],
+                                          credentials['security_token'], session_id=session_id,
+                                          instance_url=instance_url)
+            self.login_seconds = time.perf_counter() - start
         except Exception as ex:
             qtw.QMessageBox.warning(self, 'Error', str(ex))
+            return
+        self._login_name = name
+        self.remember_session()
+        self.accept()
+
+    def remember_session(self, quiet=False):
+        """Save the connector's session for its saved login if it changed, e.g. after logging in again on expiry.
+
+        With ``quiet``, used while the application shuts down, failures are printed instead of shown in a dialog.
+        """
+        if self.sf_con is None or self._login_name is None:
+            return
+        session = (self.sf_con.session_id, self.sf_con.instance_url)
+        try:
+            if utils.load_session(self.saved_logins, self._login_name) != session:
+                utils.save_session(self.saved_logins, self._login_name, *session)
+        except Exception as ex:
+            if quiet:
+                print('Exception: {0}'.format(ex), file=sys.stderr)
+            else:
+                qtw.QMessageBox.warning(self, 'Error', str(ex))
 
     def get_login(self):
         return self.sf_con
\ No newline at end of file
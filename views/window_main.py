@@ -2,34 +2,34 @@ from functools import partial
 
 import PyQt5.QtGui as qtg
 import PyQt5.QtWidgets as qtw
-from PyQt5.QtCore import QEvent
+from PyQt5.QtCore import QByteArray, QEvent, QMimeData, QStringListModel, QTimer
 from PyQt5.QtCore import Qt
 
-from utils.custom_widgets import SOQLHighlighter, ResultsTable, FindDialog
+from models.result_store import ResultStore
+from utils.custom_widgets import SOQLHighlighter, ResultsTable, FindDialog, TableFilterProxyModel, DiagnosticsDialog
 
 
-def _table_selection_to_text(table: ResultsTable, include_headers=False):
-    if not table.selectedRanges():
-        return
+# Copies of more cells than this also offer to export the selection to a file instead.
+LARGE_COPY_CELLS = 200000
+# Hide the export offer after this many milliseconds.
+EXPORT_OFFER_TIMEOUT = 10000
 
-    selected = table.selectedRanges()[0]
 
-    top_row = selected.topRow()
-    bottom_row = selected.bottomRow()
-    left_col = selected.leftColumn()
-    right_col = selected.rightColumn()
+def _selection_to_mime_data(store: ResultStore, selection, include_headers=False):
+    """Clipboard data for a ``ResultsTable.selected_cells`` ``selection`` of ``store``, or ``None`` if it is empty.
 
-    rows = []
-    if include_headers:
-        rows.append([table.horizontalHeaderItem(i).text() for i in range(left_col, right_col + 1)])
-
-    for row in range(top_row, bottom_row + 1):
-        columns = []
-        for col in range(left_col, right_col + 1):
-            columns.append(table.item(row, col).text().replace('\t', ' '))
-        rows.append(columns)
-    text = '\n'.join('\t'.join(cols) for cols in rows)
-    return text
+    The text is appended to a UTF-8 buffer a chunk at a time rather than joined into one string, and is only decoded
+    if another application asks for it.
+    """
+    rows, cols, selected = selection
+    if not rows:
+        return None
+    data = QByteArray()
+    for chunk in store.iter_text(rows, cols, include_headers, selected=selected):
+        data.append(chunk.encode('utf-8'))
+    mime_data = QMimeData()
+    mime_data.setData('text/plain', data)
+    return mime_data
 
 
 class MainWindow(qtw.QMainWindow):
@@ -45,6 +45,8 @@ class MainWindow(qtw.QMainWindow):
         self._root_layout = qtw.QHBoxLayout()
         self._btn_query = qtw.QPushButton('Run Query')
         self._btn_query_more = qtw.QPushButton('Query More')
+        self._btn_cancel = qtw.QPushButton('Cancel')
+        self._btn_bulk_export = qtw.QPushButton('Bulk Export')
         self._frm_nw = qtw.QFrame()
         self._frm_ne = qtw.QFrame()
         self._frm_buttons = qtw.QFrame()
@@ -53,13 +55,24 @@ class MainWindow(qtw.QMainWindow):
         self._layout_buttons = qtw.QHBoxLayout()
         self._txt_query = qtw.QTextEdit()
         self._tbl_s = ResultsTable()
+        self._frm_results = qtw.QFrame()
+        self._layout_results = qtw.QVBoxLayout()
+        self._txt_results_filter = qtw.QLineEdit()
+        self._results_filter_timer = QTimer(self)
         self._splitter_h = qtw.QSplitter(Qt.Horizontal)
         self._splitter_v = qtw.QSplitter(Qt.Vertical)
-        self._lst_tables = qtw.QListWidget()
+        self._lst_tables = qtw.QListView()
+        self._tables_model = TableFilterProxyModel(self)
         self._txt_filter = qtw.QLineEdit()
+        self._filter_timer = QTimer(self)
         self._syntax_highlighter = SOQLHighlighter(self._txt_query)
         self._status_bar = qtw.QStatusBar()
         self._lbl_status = qtw.QLabel(self)
+        self._lbl_cache_status = qtw.QLabel(self)
+        self._lbl_timing_status = qtw.QLabel(self)
+        self._prg_query = qtw.QProgressBar(self)
+        self._btn_export_selection = qtw.QPushButton('Export To File Instead', self)
+        self._export_offer_timer = QTimer(self)
 
         # --- ARRANGE ELEMENTS ---
 
@@ -69,6 +82,13 @@ class MainWindow(qtw.QMainWindow):
         self._layout_nw.addWidget(self._txt_filter)
         self._layout_nw.addWidget(self._lst_tables)
         self._txt_filter.setPlaceholderText('Filter Tables')
+        self._lst_tables.setModel(self._tables_model)
+        self._lst_tables.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self._lst_tables.setUniformItemSizes(True)
+        # Filtering waits until typing pauses.
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(150)
+        self._txt_filter.textChanged.connect(self._filter_timer.start)
 
         # Top Right
         self._frm_ne.setFrameShape(qtw.QFrame.StyledPanel)
@@ -77,19 +97,49 @@ class MainWindow(qtw.QMainWindow):
         self._layout_ne.addLayout(self._layout_buttons)
         self._layout_buttons.addWidget(self._btn_query)
         self._layout_buttons.addWidget(self._btn_query_more)
+        self._layout_buttons.addWidget(self._btn_cancel)
+        self._layout_buttons.addWidget(self._btn_bulk_export)
         self._txt_query.setFrameShape(qtw.QFrame.StyledPanel)
+        self._btn_query.setToolTip('Hold Shift to bypass the query cache')
         self._btn_query_more.setDisabled(True)
+        self._btn_cancel.setDisabled(True)
+        self._btn_bulk_export.setDisabled(True)
+        self._btn_bulk_export.setToolTip('Export every result of a large query to CSV through the Bulk API')
 
         # Bottom
+        self._frm_results.setLayout(self._layout_results)
+        self._layout_results.setContentsMargins(0, 0, 0, 0)
+        self._layout_results.addWidget(self._txt_results_filter)
+        self._layout_results.addWidget(self._tbl_s)
+        self._txt_results_filter.setPlaceholderText('Search Results (e.g. smith Status=Open Amount>=1000)')
+        self._txt_results_filter.setToolTip('Words match the start of words in any column. Column:text searches one '
+                                            'column; =, !=, <, <=, >, >= compare a column\'s values.')
+        self._txt_results_filter.setClearButtonEnabled(True)
+        self._results_filter_timer.setSingleShot(True)
+        self._results_filter_timer.setInterval(250)
+        self._txt_results_filter.textChanged.connect(self._results_filter_timer.start)
         self._tbl_s.setFrameShape(qtw.QFrame.StyledPanel)
         self.setStatusBar(self._status_bar)
+        self._status_bar.addPermanentWidget(self._prg_query)
+        self._status_bar.addPermanentWidget(self._lbl_timing_status)
+        self._status_bar.addPermanentWidget(self._lbl_cache_status)
         self._status_bar.addPermanentWidget(self._lbl_status)
+        self._prg_query.setRange(0, 0)
+        self._prg_query.setMaximumWidth(150)
+        self._prg_query.hide()
+        self._status_bar.addPermanentWidget(self._btn_export_selection)
+        self._btn_export_selection.setFlat(True)
+        self._btn_export_selection.hide()
+        self._btn_export_selection.clicked.connect(self._btn_export_selection.hide)
+        self._export_offer_timer.setSingleShot(True)
+        self._export_offer_timer.setInterval(EXPORT_OFFER_TIMEOUT)
+        self._export_offer_timer.timeout.connect(self._btn_export_selection.hide)
 
         # Splitters
         self._splitter_h.addWidget(self._frm_nw)
         self._splitter_h.addWidget(self._frm_ne)
         self._splitter_v.addWidget(self._splitter_h)
-        self._splitter_v.addWidget(self._tbl_s)
+        self._splitter_v.addWidget(self._frm_results)
         self._splitter_h.setSizes([100, 50])
         self._splitter_v.setSizes([100, 50])
 
@@ -101,6 +151,10 @@ class MainWindow(qtw.QMainWindow):
         # Finalize
         self.setWindowTitle('SalesForce Viewer')
 
+        self._tbl_s.model().sorting.connect(self._show_sorting)
+        self._tbl_s.model().filtered.connect(self._show_filtered)
+        self._tbl_s.model().filter_failed.connect(self._show_filter_failed)
+
         # Install Event Filters
         self._txt_query.installEventFilter(self)
         self._tbl_s.installEventFilter(self)
@@ -108,10 +162,25 @@ class MainWindow(qtw.QMainWindow):
 
         # Event Functions
         self._event_callbacks = {}
+        self._load_all_enabled = False
+        self._idle_button_states = []
 
         # Other
         self._clipboard = qtg.QGuiApplication.clipboard()
         self._find_dialog = FindDialog(self._syntax_highlighter)
+        self._diagnostics_dialog = DiagnosticsDialog(self)
+        self._diagnostics_shortcut = qtw.QShortcut(qtg.QKeySequence('Ctrl+Shift+D'), self)
+
+        # Completion
+        self._completion_model = QStringListModel(self)
+        self._completer = qtw.QCompleter(self._completion_model, self)
+        self._completer.setWidget(self._txt_query)
+        self._completer.setCompletionMode(qtw.QCompleter.UnfilteredPopupCompletion)
+        self._completer.setCaseSensitivity(Qt.CaseInsensitive)
+        self._completer.activated[str].connect(self._insert_completion)
+        self._completion_prefix = ''
+        self._suppress_completion = False
+        self._txt_query.textChanged.connect(self.refresh_completion)
 
     def set_listener_run_query(self, func):
         self._btn_query.clicked.connect(func)
@@ -121,12 +190,56 @@ class MainWindow(qtw.QMainWindow):
         self._btn_query_more.clicked.connect(func)
         self._event_callbacks['query_more'] = func
 
+    def set_listener_cancel_query(self, func):
+        self._btn_cancel.clicked.connect(func)
+        self._event_callbacks['cancel_query'] = func
+
+    def set_listener_bulk_export(self, func):
+        self._btn_bulk_export.clicked.connect(func)
+        self._event_callbacks['bulk_export'] = func
+
+    def set_listener_export_results(self, func):
+        self._event_callbacks['export_results'] = func
+
+    def set_listener_export_selection(self, func):
+        self._btn_export_selection.clicked.connect(func)
+        self._event_callbacks['export_selection'] = func
+
+    def set_listener_load_all(self, func):
+        self._event_callbacks['load_all'] = func
+
+    def set_listener_export_shown_rows(self, func):
+        self._event_callbacks['export_shown_rows'] = func
+
+    def set_listener_filter_results(self, func):
+        self._results_filter_timer.timeout.connect(func)
+        self._event_callbacks['filter_results'] = func
+
+    def set_listener_show_diagnostics(self, func):
+        self._diagnostics_shortcut.activated.connect(func)
+        self._event_callbacks['show_diagnostics'] = func
+
+    def set_listener_record_diagnostics(self, func):
+        self._diagnostics_dialog.set_listener_recording(func)
+
+    def set_listener_export_diagnostics(self, func):
+        self._diagnostics_dialog.set_listener_export(func)
+
+    def set_listener_clear_diagnostics(self, func):
+        self._diagnostics_dialog.set_listener_clear(func)
+
+    def set_listener_complete(self, func):
+        self._event_callbacks['complete'] = func
+
     def set_listener_table_selected(self, func):
         self._lst_tables.doubleClicked.connect(func)
         self._event_callbacks['table_selected'] = func
 
+    def set_listener_reload_tables(self, func):
+        self._event_callbacks['reload_tables'] = func
+
     def set_listener_filter_tables(self, func):
-        self._txt_filter.textChanged.connect(func)
+        self._filter_timer.timeout.connect(func)
         self._event_callbacks['filter_tables'] = func
 
     def eventFilter(self, source, event):
@@ -148,6 +261,16 @@ class MainWindow(qtw.QMainWindow):
                 self._event_callbacks['table_selected']()
                 return True
 
+        # Right Click on Table List
+        elif source == self._lst_tables and event.type() == QEvent.ContextMenu:
+            menu = qtw.QMenu(self)
+            reload_tables = qtw.QAction('Reload Tables', self)
+            menu.addAction(reload_tables)
+
+            reload_tables.triggered.connect(self._event_callbacks['reload_tables'])
+
+            menu.popup(qtg.QCursor.pos())
+
         # Key Press Event on Results Table
         elif source == self._tbl_s and event.type() == QEvent.KeyPress:
             if event.modifiers() & Qt.ControlModifier:
@@ -164,22 +287,82 @@ class MainWindow(qtw.QMainWindow):
             select_all = qtw.QAction('Select All (Ctrl+A)', self)
             copy_no_headers = qtw.QAction('Copy Cells (Ctrl+C)', self)
             copy_headers = qtw.QAction('Copy Cells With Headers', self)
+            load_all = qtw.QAction('Load All Results In Parallel', self)
+            export_shown_rows = qtw.QAction('Export Shown Rows...', self)
+            export_results = qtw.QAction('Export All Query Results...', self)
             menu.addAction(select_all)
             menu.addAction(copy_no_headers)
             menu.addAction(copy_headers)
+            menu.addSeparator()
+            menu.addAction(load_all)
+            menu.addAction(export_shown_rows)
+            menu.addAction(export_results)
+            if 'show_diagnostics' in self._event_callbacks:
+                show_diagnostics = qtw.QAction('Diagnostics (Ctrl+Shift+D)', self)
+                menu.addSeparator()
+                menu.addAction(show_diagnostics)
+                show_diagnostics.triggered.connect(self._event_callbacks['show_diagnostics'])
 
             select_all.triggered.connect(source.selectAll)
             copy_no_headers.triggered.connect(partial(self.copy_selected_cells, False))
             copy_headers.triggered.connect(partial(self.copy_selected_cells, True))
+            load_all.triggered.connect(self._event_callbacks['load_all'])
+            load_all.setEnabled(not self.query_running and self.query_more_enabled and self.load_all_enabled)
+            export_shown_rows.triggered.connect(self._event_callbacks['export_shown_rows'])
+            export_shown_rows.setEnabled(not self.query_running and bool(self.results_filter))
+            export_results.triggered.connect(self._event_callbacks['export_results'])
+            export_results.setEnabled(not self.query_running and self._tbl_s.model().rowCount() > 0)
 
             menu.popup(qtg.QCursor.pos())
 
         return qtw.QMainWindow.eventFilter(self, source, event)
 
     def copy_selected_cells(self, include_headers=False):
-        self._clipboard.setText(_table_selection_to_text(self._tbl_s, include_headers), mode=self._clipboard.Clipboard)
+        selection = self._tbl_s.selected_cells()
+        mime_data = _selection_to_mime_data(self._tbl_s.store, selection, include_headers)
+        if mime_data is None:
+            return
+        self._clipboard.setMimeData(mime_data, mode=self._clipboard.Clipboard)
         self.temp_status_text = 'Cells Copied To Clipboard'
 
+        rows, cols, _ = selection
+        if 'export_selection' in self._event_callbacks and len(rows) * len(cols) > LARGE_COPY_CELLS:
+            self._btn_export_selection.show()
+            self._export_offer_timer.start()
+
+    @property
+    def selected_cells(self):
+        """The results store with the store rows and columns of the selected cells."""
+        rows, cols, _ = self._tbl_s.selected_cells()
+        return self._tbl_s.store, rows, cols
+
+    @property
+    def shown_cells(self):
+        """The results store with the store rows shown through the results filter and every column."""
+        store = self._tbl_s.store
+        return store, self._tbl_s.shown_rows(), list(range(len(store.headers)))
+
+    @property
+    def results_filter_text(self):
+        return self._txt_results_filter.text()
+
+    @property
+    def results_filter(self):
+        return self._tbl_s.model().filter_text
+
+    @results_filter.setter
+    def results_filter(self, text):
+        self._tbl_s.set_filter(text)
+        if text.strip():
+            self.temp_status_text = 'Searching Results...'
+
+    def _show_filtered(self, shown):
+        if self.results_filter:
+            self.temp_status_text = 'Showing {0} / {1} Rows'.format(shown, len(self._tbl_s.store))
+
+    def _show_filter_failed(self, message):
+        self.temp_status_text = message
+
     @property
     def filter_text(self):
         return self._txt_filter.text()
@@ -190,19 +373,32 @@ class MainWindow(qtw.QMainWindow):
 
     @property
     def selected_table(self):
-        return self._lst_tables.currentItem().text()
+        return self._lst_tables.currentIndex().data()
 
     @property
     def tables(self):
-        return [item.text() for item in self._lst_tables.items()]
+        """The table names shown, i.e. those passing the table filter."""
+        model = self._tables_model
+        return [model.index(row, 0).data() for row in range(model.rowCount())]
+
+    @property
+    def all_tables(self):
+        """Every loaded table name, whether or not the table filter shows it."""
+        return self._tables_model.names
 
     @tables.setter
     def tables(self, table_names: list):
-        while self._lst_tables.count() > 0:
-            self._lst_tables.takeItem(0)
-        for name in table_names:
-            self._lst_tables.addItem(qtw.QListWidgetItem(name))
-        self.temp_status_text = 'Available Tables: {0}'.format(self._lst_tables.count())
+        self._tables_model.names = table_names
+        self.temp_status_text = 'Available Tables: {0}'.format(self._tables_model.rowCount())
+
+    @property
+    def table_filter(self):
+        return self._tables_model.filter_text
+
+    @table_filter.setter
+    def table_filter(self, text):
+        self._tables_model.filter_text = text
+        self.temp_status_text = 'Available Tables: {0}'.format(self._tables_model.rowCount())
 
     @property
     def query_text(self):
@@ -210,9 +406,49 @@ class MainWindow(qtw.QMainWindow):
 
     @query_text.setter
     def query_text(self, text):
-        self._txt_query.setText(text)
+        self._suppress_completion = True
+        try:
+            self._txt_query.setText(text)
+        finally:
+            self._suppress_completion = False
+        self._completer.popup().hide()
         self.temp_status_text = 'Query Text Updated'
 
+    def refresh_completion(self):
+        """Offer completions for the word at the cursor, asking the 'complete' listener for candidates."""
+        popup = self._completer.popup()
+        if self._suppress_completion or 'complete' not in self._event_callbacks or not self._txt_query.hasFocus():
+            popup.hide()
+            return
+
+        cursor = self._txt_query.textCursor()
+        text_before_cursor = cursor.block().text()[:cursor.positionInBlock()]
+        if not text_before_cursor or not (text_before_cursor[-1].isalnum() or text_before_cursor[-1] in '_.'):
+            popup.hide()
+            return
+
+        prefix, candidates = self._event_callbacks['complete'](text_before_cursor, self.query_text)
+        if not candidates or candidates == [prefix]:
+            popup.hide()
+            return
+
+        self._completion_prefix = prefix
+        self._completion_model.setStringList(candidates)
+        popup.setCurrentIndex(self._completer.completionModel().index(0, 0))
+        rect = self._txt_query.cursorRect()
+        rect.setWidth(popup.sizeHintForColumn(0) + popup.verticalScrollBar().sizeHint().width())
+        self._completer.complete(rect)
+
+    def _insert_completion(self, completion):
+        cursor = self._txt_query.textCursor()
+        cursor.movePosition(qtg.QTextCursor.Left, qtg.QTextCursor.KeepAnchor, len(self._completion_prefix))
+        self._suppress_completion = True
+        try:
+            cursor.insertText(completion)
+        finally:
+            self._suppress_completion = False
+        self._txt_query.setTextCursor(cursor)
+
     @property
     def status_text(self):
         return self._lbl_status.text()
@@ -221,6 +457,46 @@ class MainWindow(qtw.QMainWindow):
     def status_text(self, text):
         self._lbl_status.setText(text)
 
+    @property
+    def cache_status_text(self):
+        return self._lbl_cache_status.text()
+
+    @cache_status_text.setter
+    def cache_status_text(self, text):
+        self._lbl_cache_status.setText(text)
+
+    @property
+    def timing_status_text(self):
+        return self._lbl_timing_status.text()
+
+    @timing_status_text.setter
+    def timing_status_text(self, text):
+        self._lbl_timing_status.setText(text)
+
+    def show_diagnostics(self):
+        self._diagnostics_dialog.show()
+        self._diagnostics_dialog.raise_()
+
+    @property
+    def diagnostics_visible(self) -> bool:
+        return self._diagnostics_dialog.isVisible()
+
+    @property
+    def diagnostics_recording(self) -> bool:
+        return self._diagnostics_dialog.recording
+
+    @diagnostics_recording.setter
+    def diagnostics_recording(self, recording: bool):
+        self._diagnostics_dialog.recording = recording
+
+    def set_diagnostics(self, operations):
+        self._diagnostics_dialog.set_operations(operations)
+
+    @property
+    def force_refresh_requested(self) -> bool:
+        """Whether Shift is held, asking Run Query to skip the query cache."""
+        return bool(qtg.QGuiApplication.keyboardModifiers() & Qt.ShiftModifier)
+
     @property
     def temp_status_text(self):
         return self._status_bar.currentMessage()
@@ -237,6 +513,46 @@ class MainWindow(qtw.QMainWindow):
     def query_more_enabled(self, enabled: bool):
         self._btn_query_more.setEnabled(enabled)
 
+    @property
+    def query_running(self) -> bool:
+        return self._btn_cancel.isEnabled()
+
+    @query_running.setter
+    def query_running(self, running: bool):
+        if running == self.query_running:
+            return
+        # Query More and Bulk Export get back their previous state unless the controller sets them afterwards.
+        if running:
+            self._idle_button_states = [(btn, btn.isEnabled()) for btn in (self._btn_query_more, self._btn_bulk_export)]
+            for btn, _ in self._idle_button_states:
+                btn.setEnabled(False)
+        else:
+            for btn, enabled in self._idle_button_states:
+                btn.setEnabled(enabled)
+        self._btn_query.setEnabled(not running)
+        self._btn_cancel.setEnabled(running)
+        self._prg_query.setVisible(running)
+
+    @property
+    def load_all_enabled(self) -> bool:
+        return self._load_all_enabled
+
+    @load_all_enabled.setter
+    def load_all_enabled(self, enabled: bool):
+        self._load_all_enabled = enabled
+
+    @property
+    def bulk_export_enabled(self) -> bool:
+        return self._btn_bulk_export.isEnabled()
+
+    @bulk_export_enabled.setter
+    def bulk_export_enabled(self, enabled: bool):
+        self._btn_bulk_export.setEnabled(enabled)
+
+    def ask_save_path(self, title, file_filter):
+        path, _ = qtw.QFileDialog.getSaveFileName(self, title, '', file_filter)
+        return path
+
     @property
     def error_message(self):
         return self._error_message.text()
@@ -246,6 +562,18 @@ class MainWindow(qtw.QMainWindow):
         self._error_message.setText(text)
         self._error_message.show()
 
-    def update_results_table(self, headers: list, rows: list):
-        self._tbl_s.set_data(headers, rows)
-        self.temp_status_text = 'Results Updated: {0} Columns, {1} Rows'.format(len(headers), len(rows))
+    def update_results_table(self, store: ResultStore):
+        self._tbl_s.set_store(store)
+        self.temp_status_text = 'Results Updated: {0} Columns, {1} Rows'.format(len(store.headers), len(store))
+
+    def set_results_column_types(self, column_types: dict):
+        self._tbl_s.set_column_types(column_types)
+
+    def _show_sorting(self, sorting: bool):
+        self.temp_status_text = 'Sorting Results...' if sorting else 'Results Sorted'
+
+    def append_results_table(self, store: ResultStore):
+        # rowCount() only counts the rows shown through the results filter.
+        added = len(store) - self._tbl_s.model().loaded_row_count
+        self._tbl_s.sync_rows()
+        self.temp_status_text = 'Results Updated: {0} Rows Added'.format(added)